@@ -0,0 +1,286 @@
+import os
+import stat
+import sys
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+from render_template import YAML_LOADER
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Checks the whole user config file (config_FlashPipe.yml) in a single pass, before anything is created, and reports
+# all its errors at once with their line in the file (instead of stopping at the first one). The rules of each key are
+# declared in CONFIG_SCHEMA. The paths given in the config file (GSF, FastQ and Index Sorting directories, and the
+# STAR index, GTF and IMGT files of the species) are checked at the same time in a pool of threads (slow network
+# filesystems), so that a job is never sent to the cluster with a reference missing.
+# 1. Function locate_keys : Gives the line of each key (and of each species) in the config file.
+# 2. Function check_value : Checks the value of a key against its rule (type, allowed values, range).
+# 3. Function check_paths : Checks the existence and the type (file or directory) of the paths, in parallel.
+# 4. Function validate_config : Checks all the keys of the config file, returns the errors and the warnings.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+def is_yes(value):
+    '''
+    Returns True if a yes_no value means yes (boolean True, or yes / true as text, as read by verify_parameters).
+    '''
+    if isinstance(value, str):
+        return value.strip().lower() in YES_VALUES
+    return value is True
+
+def index_sort_enabled(config):
+    '''
+    Returns True if the Index Sorting analysis is enabled in the config.
+    '''
+    return is_yes(config.get("index_sort_analysis"))
+
+def repertoire_enabled(config):
+    '''
+    Returns True if a BCR/TCR repertoire tool is selected in the config.
+    '''
+    return config.get("tools_bcr_tcr_analysis") not in (False, None, "FALSE")
+
+# Rules of the keys of the config file :
+# type : choice (value in values), yes_no, name (single name), list (comma separated names), int / number (between minimum
+#        and maximum), file / directory (existing path), absolute_path, species_file / species_directory (one path per species,
+#        the one of the selected species must exist)
+# required : False for the expert keys having a default value (config files created before these options)
+# when : the key is only checked (and required) when this condition on the config is True
+CONFIG_SCHEMA = {
+    "species": {'type': "choice", 'values': ["human", "mouse"]},
+    "experience_name": {'type': "name"},
+    "plate_names": {'type': "list"},
+    "method_analysis": {'type': "choice", 'values': ["single-cell", "minibulk"]},
+    "gsf_file": {'type': "file"},
+    "metadata_analysis": {'type': "yes_no"},
+    "fastq_directories": {'type': "directory"},
+    "tools_bcr_tcr_analysis": {'type': "choice", 'values': ["airrflow", "trust4", False]},
+    "bcr_repertoire_analysis": {'type': "yes_no", 'when': repertoire_enabled},
+    "tcr_repertoire_analysis": {'type': "yes_no", 'when': repertoire_enabled},
+    "index_sort_analysis": {'type': "yes_no"},
+    "index_sort": {'type': "directory", 'when': index_sort_enabled},
+    "not_fluorescent": {'type': "list", 'when': index_sort_enabled},
+    "outdir_temp": {'type': "absolute_path"},
+    "merge_lanes": {'type': "yes_no", 'required': False},
+    "preflight_reads": {'type': "int", 'minimum': 1, 'required': False},
+    "preflight_min_barcode_hit_rate": {'type': "number", 'minimum': 0, 'maximum': 1, 'required': False},
+    "plate_max_threads": {'type': "int", 'minimum': 1, 'required': False},
+    "plate_max_mem_mb": {'type': "int", 'minimum': 1, 'required': False},
+    "trust4_shards": {'type': "int", 'minimum': 1, 'maximum': 96, 'required': False},
+    "zumis_keep_bam": {'type': "yes_no", 'required': False},
+    "fastq_watch": {'type': "yes_no", 'required': False},
+    "fastq_integrity": {'type': "yes_no", 'required': False},
+    "star_index": {'type': "species_directory"},
+    "gtf_file": {'type': "species_file"},
+    "trust4_imgt_BCR_TCR": {'type': "species_file", 'when': repertoire_enabled},
+    "trust4_imgt_VDJ": {'type': "species_file", 'when': repertoire_enabled}
+}
+# Separators forbidden in the lists of the config file (the separator must be ",")
+FORBIDDEN_SEPARATORS = [":", ";", "/", ".", "?"]
+# Values accepted for the yes_no keys when they are given as text
+YES_NO_VALUES = ["yes", "no", "true", "false"]
+YES_VALUES = ["yes", "true"]
+# Maximum number of paths checked at the same time
+PATH_CHECK_THREADS = 16
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function locate_keys : Gives the line of each key in the config file.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def locate_keys(config_text):
+    '''
+    Returns a dictionary key -> line number (starting at 1) of the keys of the config file, and (key, species) -> line
+    number for the values given by species.
+
+    config_text: Content of the config file.
+    '''
+    locations = {}
+    root = yaml.compose(config_text, Loader=YAML_LOADER)
+    if not isinstance(root, yaml.MappingNode):
+        return locations
+    for key_node, value_node in root.value:
+        locations[key_node.value] = key_node.start_mark.line + 1
+        if isinstance(value_node, yaml.MappingNode):
+            for sub_key_node, _ in value_node.value:
+                locations[(key_node.value, sub_key_node.value)] = sub_key_node.start_mark.line + 1
+    return locations
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function check_value : Checks the value of a key against its rule.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def check_value(key, value, rule, config):
+    '''
+    Checks the value of a key (not empty) against its rule (see CONFIG_SCHEMA). Returns the error message, or None if
+    the value is correct. The paths are only checked to be absolute or relative, their existence is checked by check_paths.
+
+    key: Key of the config file.
+    value: Value given in the config file.
+    rule: Rule of the key.
+    config: Whole config (species selected for the species_file / species_directory keys).
+    '''
+    value_type = rule['type']
+    if value_type == "choice":
+        if value not in rule['values']:
+            return f"'{value}' is not allowed, possible values : {', '.join('no' if allowed is False else allowed for allowed in rule['values'])}."
+    elif value_type == "yes_no":
+        if not isinstance(value, bool) and not (isinstance(value, str) and value.strip().lower() in YES_NO_VALUES):
+            return f"'{value}' is not allowed, possible values : yes or no."
+    elif value_type in ("name", "list"):
+        if not isinstance(value, str):
+            return f"'{value}' should be {'a name' if value_type == 'name' else 'a comma separated list of names'}."
+        if value_type == "name" and "," in value:
+            return f"'{value}' should be a single name."
+        if any(separator in value for separator in FORBIDDEN_SEPARATORS):
+            return f"'{value}' contains a wrong separator, put ',' to separate the different names."
+        names = [name.strip() for name in value.split(',')]
+        if "" in names:
+            return f"'{value}' contains an empty name."
+        duplicates = sorted({name for name in names if names.count(name) > 1})
+        if duplicates:
+            return f"'{value}' contains the same name several times ({', '.join(duplicates)})."
+    elif value_type in ("int", "number"):
+        # YAML reads yes/no as booleans, which are also integers in Python
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (value_type == "int" and not float(value).is_integer()):
+            return f"'{value}' should be {'an integer' if value_type == 'int' else 'a number'}."
+        if ('minimum' in rule and value < rule['minimum']) or ('maximum' in rule and value > rule['maximum']):
+            return f"'{value}' should be between {rule.get('minimum')} and {rule.get('maximum')}."
+    elif value_type in ("file", "directory", "absolute_path"):
+        if not isinstance(value, str):
+            return f"'{value}' should be a path."
+        if value_type == "absolute_path" and not os.path.isabs(value):
+            return f"'{value}' should be an absolute path."
+    elif value_type in ("species_file", "species_directory"):
+        if not isinstance(value, dict):
+            return "one path per species should be given (species: path)."
+        species = config.get("species")
+        if species in CONFIG_SCHEMA["species"]['values'] and not isinstance(value.get(species), str):
+            return f"no path given for the species {species}."
+    return None
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function check_paths : Checks the existence and the type of the paths, in parallel.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def stat_path(path, base_dirs):
+    '''
+    Returns the mode of a path (os.stat), or None if it does not exist. A relative path is searched in each of base_dirs.
+
+    path: Path given in the config file.
+    base_dirs: Directories of the relative paths.
+    '''
+    candidates = [path] if os.path.isabs(path) else [os.path.join(base_dir, path) for base_dir in base_dirs]
+    for candidate in candidates:
+        try:
+            return os.stat(candidate).st_mode
+        except OSError:
+            continue
+    return None
+
+def check_paths(path_checks, base_dirs, threads=PATH_CHECK_THREADS):
+    '''
+    Checks the paths in a pool of threads (one os.stat per path : the latency of a network filesystem is paid once for
+    all the paths). Returns the list of (key, location, message) of the paths missing or of the wrong type.
+
+    path_checks: List of (key, location, path, kind), kind being "file" or "directory".
+    base_dirs: Directories of the relative paths.
+    threads: Maximum number of paths checked at the same time.
+    '''
+    if not path_checks:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(threads, len(path_checks)))) as executor:
+        modes = list(executor.map(lambda check: stat_path(check[2], base_dirs), path_checks))
+
+    errors = []
+    for (key, location, path, kind), mode in zip(path_checks, modes):
+        if mode is None:
+            errors.append((key, location, f"the {kind} {path} does not exist."))
+        elif kind == "directory" and not stat.S_ISDIR(mode):
+            errors.append((key, location, f"{path} is not a directory."))
+        elif kind == "file" and not stat.S_ISREG(mode):
+            errors.append((key, location, f"{path} is not a file."))
+    return errors
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function validate_config : Checks all the keys of the config file.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def format_issue(config_path, key, line, message):
+    '''
+    Returns the message of an error or a warning, with its location in the config file.
+    '''
+    location = f"{config_path}, line {line}" if line else config_path
+    return f"{location} ({key}) : {message}"
+
+def validate_config(config_path, experience_path=None, base_dirs=None, threads=PATH_CHECK_THREADS):
+    '''
+    Checks all the keys of the config file against CONFIG_SCHEMA in a single pass, and the paths it gives in parallel.
+    Returns the list of errors and the list of warnings (unknown keys), as messages with the line of the key.
+    Nothing is modified (the values are normalised afterwards by verify_empty_values_config_file).
+
+    config_path: Path to the config file (config_FlashPipe.yml).
+    experience_path: Path to the experiment directory, whose name must be the experience_name (optional).
+    base_dirs: Directories of the relative paths (default: the experiment directory).
+    threads: Maximum number of paths checked at the same time.
+    '''
+    with open(config_path, 'r') as file:
+        config_text = file.read()
+    try:
+        config = yaml.load(config_text, Loader=YAML_LOADER)
+        locations = locate_keys(config_text)
+    except yaml.YAMLError as e:
+        return [f"{config_path} : the file is not a valid YAML file ({e})."], []
+    if not isinstance(config, dict):
+        return [f"{config_path} : the file should contain one 'key: value' per line."], []
+    if base_dirs is None:
+        base_dirs = [experience_path] if experience_path else []
+
+    issues = []
+    path_checks = []
+    for key, rule in CONFIG_SCHEMA.items():
+        if 'when' in rule and not rule['when'](config):
+            continue
+        value = config.get(key)
+        if value is None or value == "":
+            if key in config:
+                issues.append((key, locations.get(key), "the section is empty, please provide a value."))
+            elif rule.get('required', True):
+                issues.append((key, None, "the section is missing in the config file."))
+            continue
+
+        error = check_value(key, value, rule, config)
+        if error:
+            issues.append((key, locations.get(key), error))
+        elif rule['type'] in ("file", "directory"):
+            path_checks.append((key, locations.get(key), value, rule['type']))
+        elif rule['type'] in ("species_file", "species_directory") and config.get("species") in value:
+            species = config.get("species")
+            path_checks.append((f"{key}: {species}", locations.get((key, species), locations.get(key)), value[species],
+                                rule['type'].partition('_')[2]))
+        elif rule['type'] == "name" and experience_path and os.path.basename(os.path.normpath(experience_path)) != value:
+            issues.append((key, locations.get(key), f"'{value}' is different from the experiment directory ({os.path.basename(os.path.normpath(experience_path))})."))
+
+    issues += check_paths(path_checks, base_dirs, threads)
+    issues.sort(key=lambda issue: issue[1] or 0)
+    errors = [format_issue(config_path, key, line, message) for key, line, message in issues]
+    warnings = [format_issue(config_path, key, locations.get(key), "unknown key, it is not used by FlashPipe.")
+                for key in config if key not in CONFIG_SCHEMA]
+    return errors, warnings
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog -w EXPERIENCE_DIR [-t TEMPLATE_PATH] [-j THREADS]")
+    parser.add_option("-w", "--working_dir", dest="working_dir", help="Experiment directory (containing 01_Reference/config_FlashPipe.yml)", metavar="EXPERIENCE_DIR")
+    parser.add_option("-t", "--template_path", dest="template_path", default=None,
+                      help="Template directory (01_Template) : the relative paths (IMGT files) are also searched in the experiment of the template", metavar="TEMPLATE_PATH")
+    parser.add_option("-j", "--threads", dest="threads", type="int", default=PATH_CHECK_THREADS, help="Number of paths checked at the same time", metavar="THREADS")
+    (options, args) = parser.parse_args()
+
+    if not options.working_dir:
+        print("Error: You must provide the experiment directory.")
+        parser.print_help()
+        sys.exit(1)
+
+    base_dirs = [options.working_dir] + ([os.path.join(options.template_path, "{{experience_name}}")] if options.template_path else [])
+    errors, warnings = validate_config(os.path.join(options.working_dir, "01_Reference", "config_FlashPipe.yml"), options.working_dir,
+                                       base_dirs=base_dirs, threads=options.threads)
+    for warning in warnings:
+        print(f"WARNING: {warning}")
+    for error in errors:
+        print(f"ERROR: {error}")
+    print(f"{len(errors)} errors, {len(warnings)} warnings.")
+    sys.exit(1 if errors else 0)
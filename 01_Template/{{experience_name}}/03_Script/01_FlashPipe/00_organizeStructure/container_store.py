@@ -0,0 +1,346 @@
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+import sys
+from optparse import OptionParser
+from copy_engine import file_digest
+from staging_area import reflink
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Store of the containers (Singularity images, zUMIs archive) shared by all the experiments, in which each file is
+# kept once under the SHA-256 of its content. The 02_Container directory of an experiment only contains links to the
+# files of the store (hardlinks, or symbolic links when the experiment is on another filesystem), so the staging does
+# not copy the images anymore and the disk use does not grow with the number of experiments.
+# Store layout : objects/<2 first characters>/<sha256> (read-only files), hash_cache.json (hashes of the source files),
+# refs/<experiment>.json (files linked in each experiment), .lock (lock of the store, shared by the processes).
+# 1. Class ContainerStore :
+#    1.1 Lock of the store and hash of the source files (cached by path, size, modification time and inode).
+#    1.2 Method add_file : Adds a file to the store (cloned when the filesystem allows it, copied otherwise).
+#    1.3 Method link_containers : Links the containers of the template in an experiment and records its references.
+#    1.4 Method collect_garbage : Removes the files of the store not referenced by an experiment anymore.
+# 2. Command line : lists the files of the store (--list) or removes the unreferenced ones (--gc, --dry_run).
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Environment variable giving the path to the store (default: 00_ContainerStore, next to the template directory)
+STORE_ENVIRONMENT_VARIABLE = "FLASHPIPE_CONTAINER_STORE"
+STORE_DIRECTORY_NAME = "00_ContainerStore"
+# Version of the files of the store (hash cache and references)
+STORE_VERSION = 1
+
+def default_store_path(template_path):
+    '''
+    Returns the path to the container store : FLASHPIPE_CONTAINER_STORE if defined, 00_ContainerStore next to the
+    template directory otherwise (shared by all the experiments staged with this template).
+
+    template_path: Path to the template directory (01_Template).
+    '''
+    return os.environ.get(STORE_ENVIRONMENT_VARIABLE) or os.path.join(os.path.dirname(os.path.abspath(template_path)), STORE_DIRECTORY_NAME)
+
+def write_json(data, file_path):
+    '''
+    Writes a JSON file in a temporary file then renames it (never truncated by an interrupted run).
+
+    data: JSON serializable data.
+    file_path: Path to the JSON file.
+    '''
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, file_path)
+
+def read_json(file_path, default):
+    '''
+    Reads a JSON file of the store. Returns default if it does not exist, cannot be read or has another version.
+
+    file_path: Path to the JSON file.
+    default: Value returned when the file cannot be used.
+    '''
+    try:
+        with open(file_path, 'r') as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return default
+    return data if data.get('version') == STORE_VERSION else default
+
+def links_to(link_path, object_path):
+    '''
+    Checks if link_path is a link to object_path : symbolic link to it, or hardlink (same inode).
+
+    link_path: Path to the file of the experiment.
+    object_path: Path to the file of the store.
+    '''
+    if os.path.islink(link_path):
+        return os.readlink(link_path) == object_path
+    try:
+        return os.path.isfile(link_path) and os.path.samefile(link_path, object_path)
+    except OSError:
+        return False
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Class ContainerStore : Store of the containers shared by all the experiments.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+class ContainerStore:
+    '''
+    Content addressed store of the containers. All the methods modifying the store take its lock, so that several
+    stagings (threads of a batch, or processes) can use the same store at the same time.
+
+    store_path: Path to the store directory (created if it does not exist).
+    '''
+
+    def __init__(self, store_path):
+        self.store_path = os.path.abspath(store_path)
+        self.path_objects = os.path.join(self.store_path, "objects")
+        self.path_refs = os.path.join(self.store_path, "refs")
+        self.path_hash_cache = os.path.join(self.store_path, "hash_cache.json")
+        self.path_lock = os.path.join(self.store_path, ".lock")
+
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.1 Lock of the store and hash of the source files.
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    @contextlib.contextmanager
+    def locked(self):
+        '''
+        Context manager holding the lock of the store (flock : each call opens the lock file, so the threads of a
+        process also wait for each other). The lock is released when the process dies.
+        '''
+        import fcntl
+
+        os.makedirs(self.store_path, exist_ok=True)
+        with open(self.path_lock, 'a') as lock_file:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+    def object_path(self, digest):
+        '''
+        Returns the path to the file of the store with this content hash.
+
+        digest: SHA-256 of the content of the file.
+        '''
+        return os.path.join(self.path_objects, digest[:2], digest)
+
+    def file_hash(self, file_path, hash_cache):
+        '''
+        Returns the SHA-256 of a source file. The hash is kept in hash_cache with the size, modification time and
+        inode of the file, so that a file is only read again when it has been replaced or modified.
+        Returns the hash and True if it has been computed (not found in the cache).
+
+        file_path: Path to the source file.
+        hash_cache: Dictionary path -> [size, modification time, inode, hash] (modified).
+        '''
+        stat = os.stat(file_path)
+        key = [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+        cached = hash_cache.get(file_path)
+        if cached is not None and cached[:3] == key:
+            return cached[3], False
+        digest = file_digest(file_path)
+        hash_cache[file_path] = key + [digest]
+        return digest, True
+
+    def read_hash_cache(self):
+        '''
+        Returns the cached hashes of the source files (path -> [size, modification time, inode, hash]).
+        '''
+        return read_json(self.path_hash_cache, {}).get('files', {})
+
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.2 Method add_file : Adds a file to the store.
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    def add_file(self, file_path, digest):
+        '''
+        Adds a file to the store under its content hash, if not already there. The file is cloned (copy-on-write)
+        when the filesystem allows it and copied otherwise : it is never hardlinked to the source, so that a
+        modification of the template does not modify the store. The file of the store is read-only.
+        Returns the number of bytes written (0 if the file was already in the store).
+
+        file_path: Path to the source file.
+        digest: SHA-256 of the content of the file (see file_hash).
+        '''
+        object_path = self.object_path(digest)
+        if os.path.isfile(object_path):
+            return 0
+        os.makedirs(os.path.dirname(object_path), exist_ok=True)
+        tmp_path = f"{object_path}.{os.getpid()}.tmp"
+        bytes_written = 0
+        try:
+            reflink(file_path, tmp_path)
+        except (OSError, ImportError):
+            shutil.copyfile(file_path, tmp_path)
+            bytes_written = os.path.getsize(tmp_path)
+        os.chmod(tmp_path, 0o444)
+        os.replace(tmp_path, object_path)
+        return bytes_written
+
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.3 Method link_containers : Links the containers of the template in an experiment.
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    def ref_path(self, container_dir):
+        '''
+        Returns the path to the references of an experiment (one file per 02_Container directory).
+
+        container_dir: 02_Container directory of the experiment.
+        '''
+        key = hashlib.sha256(os.path.abspath(container_dir).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.path_refs, f"{key}.json")
+
+    def link_containers(self, source_dir, container_dir):
+        '''
+        Adds the files of source_dir (02_Container of the template) to the store and links them in container_dir
+        (02_Container of the experiment) : hardlink to the file of the store, or symbolic link when the experiment is
+        on another filesystem. A file of the experiment already linked to the right file of the store is not touched;
+        an older copy is replaced by the link. The files linked are recorded as references of the experiment.
+        Returns a report : files, files_linked, files_hashed, bytes_copied, links (list of (link path, file of the store)).
+
+        source_dir: Directory of the containers in the template.
+        container_dir: Directory of the containers in the experiment.
+        '''
+        report = {'files': 0, 'files_linked': 0, 'files_hashed': 0, 'bytes_copied': 0, 'links': []}
+        references = {}
+        with self.locked():
+            hash_cache = self.read_hash_cache()
+            for root, dirs, file_names in os.walk(source_dir):
+                dirs.sort()
+                for file_name in sorted(file_names):
+                    file_path = os.path.join(root, file_name)
+                    relative_path = os.path.relpath(file_path, source_dir)
+                    digest, hashed = self.file_hash(file_path, hash_cache)
+                    report['files_hashed'] += hashed
+                    report['bytes_copied'] += self.add_file(file_path, digest)
+
+                    object_path = self.object_path(digest)
+                    link_path = os.path.join(container_dir, relative_path)
+                    if not links_to(link_path, object_path):
+                        os.makedirs(os.path.dirname(link_path), exist_ok=True)
+                        tmp_path = f"{link_path}.{os.getpid()}.tmp"
+                        try:
+                            os.link(object_path, tmp_path)
+                        except OSError:
+                            os.symlink(object_path, tmp_path)
+                        os.replace(tmp_path, link_path)
+                        report['files_linked'] += 1
+                    references[relative_path] = digest
+                    report['files'] += 1
+                    report['links'].append((link_path, object_path))
+
+            if report['files_hashed']:
+                write_json({'version': STORE_VERSION, 'files': hash_cache}, self.path_hash_cache)
+            os.makedirs(self.path_refs, exist_ok=True)
+            write_json({'version': STORE_VERSION, 'container_dir': os.path.abspath(container_dir), 'files': references},
+                       self.ref_path(container_dir))
+        return report
+
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.4 Method collect_garbage : Removes the files of the store not referenced anymore.
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    def referenced_digests(self, dry_run=False):
+        '''
+        Returns the hashes of the files still linked by an experiment, and the number of experiments referencing them.
+        The references of the files not linked anymore (experiment deleted, or container updated) are removed.
+
+        dry_run: If True, the references are not modified.
+        '''
+        referenced = {}
+        if not os.path.isdir(self.path_refs):
+            return referenced
+        for ref_name in sorted(os.listdir(self.path_refs)):
+            ref_path = os.path.join(self.path_refs, ref_name)
+            if not ref_name.endswith(".json"):
+                continue
+            ref = read_json(ref_path, None)
+            files = {}
+            if ref is not None:
+                files = {relative_path: digest for relative_path, digest in ref['files'].items()
+                         if links_to(os.path.join(ref['container_dir'], relative_path), self.object_path(digest))}
+            for digest in set(files.values()):
+                referenced[digest] = referenced.get(digest, 0) + 1
+            if dry_run or (ref is not None and files == ref['files']):
+                continue
+            if files:
+                write_json(dict(ref, files=files), ref_path)
+            else:
+                os.remove(ref_path)
+        return referenced
+
+    def collect_garbage(self, dry_run=False):
+        '''
+        Removes the files of the store which are not linked by any experiment, except the ones of the current
+        template (source files of the hash cache still unchanged), which would be added again at the next staging.
+        Returns a report : files_kept, files_removed, bytes_freed (bytes of the files removed which had no other link).
+
+        dry_run: If True, only reports what would be removed.
+        '''
+        report = {'files_kept': 0, 'files_removed': 0, 'bytes_freed': 0}
+        if not os.path.isdir(self.path_objects):
+            return report
+        with self.locked():
+            referenced = self.referenced_digests(dry_run)
+            hash_cache = self.read_hash_cache()
+            sources = {}
+            for file_path, cached in hash_cache.items():
+                try:
+                    stat = os.stat(file_path)
+                except OSError:
+                    continue
+                if cached[:3] == [stat.st_size, stat.st_mtime_ns, stat.st_ino]:
+                    sources[file_path] = cached
+            if not dry_run and len(sources) != len(hash_cache):
+                write_json({'version': STORE_VERSION, 'files': sources}, self.path_hash_cache)
+            kept = set(referenced) | {cached[3] for cached in sources.values()}
+
+            for root, _, file_names in os.walk(self.path_objects):
+                for file_name in file_names:
+                    if file_name in kept:
+                        report['files_kept'] += 1
+                        continue
+                    object_path = os.path.join(root, file_name)
+                    stat = os.stat(object_path)
+                    report['files_removed'] += 1
+                    # A file still hardlinked elsewhere (experiment not recorded) keeps its blocks
+                    report['bytes_freed'] += stat.st_size if stat.st_nlink == 1 else 0
+                    if not dry_run:
+                        os.remove(object_path)
+        return report
+
+    def list_files(self):
+        '''
+        Returns the list of (hash, size, number of experiments referencing it) of the files of the store.
+        '''
+        referenced = self.referenced_digests(dry_run=True)
+        files = []
+        if os.path.isdir(self.path_objects):
+            for root, _, file_names in os.walk(self.path_objects):
+                for file_name in sorted(file_names):
+                    files.append((file_name, os.path.getsize(os.path.join(root, file_name)), referenced.get(file_name, 0)))
+        return files
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Command line
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog (-s STORE_PATH | -t TEMPLATE_PATH) (--list | --gc [--dry_run])")
+    parser.add_option("-s", "--store", dest="store", default=None, help="Path to the container store", metavar="STORE_PATH")
+    parser.add_option("-t", "--template_path", dest="template_path", default=None,
+                      help=f"Path to the template, to use its default store ({STORE_ENVIRONMENT_VARIABLE}, or {STORE_DIRECTORY_NAME} next to the template)", metavar="TEMPLATE_PATH")
+    parser.add_option("--list", dest="list", action="store_true", default=False, help="List the files of the store and the number of experiments linking them")
+    parser.add_option("--gc", dest="gc", action="store_true", default=False, help="Remove the files of the store not linked by any experiment")
+    parser.add_option("--dry_run", dest="dry_run", action="store_true", default=False, help="With --gc, only report the files that would be removed")
+    (options, args) = parser.parse_args()
+
+    if not (options.store or options.template_path) or not (options.list or options.gc):
+        print("Error: You must provide the store (or the template) and an action (--list or --gc).")
+        parser.print_help()
+        sys.exit(1)
+
+    store = ContainerStore(options.store or default_store_path(options.template_path))
+    if options.list:
+        for digest, size, experiments in store.list_files():
+            print(f"{digest}  {size / 1024 ** 2:10.1f} MB  {experiments} experiment(s)")
+    if options.gc:
+        report = store.collect_garbage(dry_run=options.dry_run)
+        action = "would be removed" if options.dry_run else "removed"
+        print(f"{report['files_removed']} files {action} ({report['bytes_freed'] / 1024 ** 2:.1f} MB freed), {report['files_kept']} files kept.")
@@ -0,0 +1,152 @@
+import hashlib
+import os
+import re
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# 1. Function index_plate_files : Lists a directory once and groups its files by plate name.
+# 2. Function is_copy_up_to_date : Checks if a destination file is identical to its source (size, modification time and content hash).
+# 3. Function copy_file : Copies one file (atomically), unless the destination is already up to date.
+# 4. Function copy_files_in_parallel : Copies a list of files in a pool of threads and reports the files and bytes copied.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Size of the blocks read to compute the hash of a file
+HASH_BUFFER_SIZE = 1024 * 1024
+# Maximum number of copies at the same time (copies are limited by the file system, not the CPU)
+MAX_COPY_THREADS = 8
+# Regex of the Index Sorting files : a plate name followed by something (example: P1_H9C0U2GX_indexsort.csv)
+INDEX_SORT_PATTERN = re.compile(r'^(?P<plate_name>.*)_.*\.csv$')
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function index_plate_files : Groups the files of a directory by plate.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def index_plate_files(source_dir, pattern=INDEX_SORT_PATTERN):
+    '''
+    Lists source_dir once (os.scandir) and returns a dictionary plate name -> list of file paths (sorted by name).
+    Only the files matching pattern (with a plate_name group) are kept.
+
+    source_dir: Directory to index.
+    pattern: Compiled regex with a plate_name group.
+    '''
+    plate_files = {}
+    with os.scandir(source_dir) as entries:
+        for entry in entries:
+            match = pattern.match(entry.name)
+            if match and entry.is_file():
+                plate_files.setdefault(match.group('plate_name'), []).append(entry.path)
+
+    for file_paths in plate_files.values():
+        file_paths.sort()
+    return plate_files
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function is_copy_up_to_date : Checks if a destination file is identical to its source.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def file_digest(file_path):
+    '''
+    Returns the SHA-256 hash of the content of a file (read by blocks).
+
+    file_path: Path to the file.
+    '''
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(HASH_BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def is_copy_up_to_date(source_file, destination_file):
+    '''
+    Checks if destination_file is an up to date copy of source_file : same size, same modification time
+    (kept by the copy) and same content hash. The hashes are only computed when the size and the time match.
+
+    source_file: Path to the source file.
+    destination_file: Path to the copy.
+    '''
+    if not os.path.isfile(destination_file):
+        return False
+
+    source_stat = os.stat(source_file)
+    destination_stat = os.stat(destination_file)
+    if source_stat.st_size != destination_stat.st_size or source_stat.st_mtime_ns != destination_stat.st_mtime_ns:
+        return False
+
+    return file_digest(source_file) == file_digest(destination_file)
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function copy_file : Copies one file, unless it is already up to date.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def copy_file(source_file, destination_file):
+    '''
+    Copies source_file to destination_file (content, permissions and modification time), in a temporary file
+    renamed at the end so that an interrupted copy never leaves a truncated file.
+    Returns the number of bytes copied (None if the destination was already up to date).
+
+    source_file: Path to the source file.
+    destination_file: Path to the copy.
+    '''
+    if is_copy_up_to_date(source_file, destination_file):
+        return None
+
+    tmp_path = f"{destination_file}.{os.getpid()}.tmp"
+    try:
+        shutil.copy2(source_file, tmp_path)
+        os.replace(tmp_path, destination_file)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return os.path.getsize(destination_file)
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function copy_files_in_parallel : Copies a list of files in a pool of threads.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def copy_files_in_parallel(copy_jobs, threads=None):
+    '''
+    Copies several files at the same time (see copy_file); the destination directories are created if needed.
+    A failing copy does not stop the others : the errors are returned in the report.
+    Returns a report dictionary : files_copied, files_skipped, bytes_copied, errors (list of messages).
+
+    copy_jobs: List of tuples (source_file, destination_file).
+    threads: Maximum number of threads (default: one per file, limited to MAX_COPY_THREADS).
+    '''
+    report = {'files_copied': 0, 'files_skipped': 0, 'bytes_copied': 0, 'errors': []}
+    if not copy_jobs:
+        return report
+
+    for destination_dir in {os.path.dirname(destination_file) for _, destination_file in copy_jobs}:
+        if destination_dir:
+            os.makedirs(destination_dir, exist_ok=True)
+
+    def run_copy(copy_job):
+        source_file, destination_file = copy_job
+        try:
+            return copy_file(source_file, destination_file), None
+        except OSError as e:
+            return None, f"Error when copying file {source_file} : {e}"
+
+    if threads is None:
+        threads = min(len(copy_jobs), MAX_COPY_THREADS)
+    if threads <= 1:
+        results = [run_copy(copy_job) for copy_job in copy_jobs]
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(executor.map(run_copy, copy_jobs))
+
+    for bytes_copied, error in results:
+        if error:
+            report['errors'].append(error)
+        elif bytes_copied is None:
+            report['files_skipped'] += 1
+        else:
+            report['files_copied'] += 1
+            report['bytes_copied'] += bytes_copied
+    return report
+
+def format_copy_report(report):
+    '''
+    Returns a one line summary of a copy report.
+
+    report: Report dictionary returned by copy_files_in_parallel.
+    '''
+    return f"{report['files_copied']} files copied ({report['bytes_copied'] / 1024 ** 2:.2f} MB), {report['files_skipped']} files already up to date."
@@ -1,17 +1,20 @@
+import csv
+import io
 import yaml
 import os
-import re
-import shutil
-import sys
-import pandas as pd
+from fastq_catalog import open_fastq_catalog, save_fastq_catalog, update_fastq_catalog, catalog_fastq_files
+from merge_fastq_lanes import merge_fastq_lanes_in_parallel
+from render_template import write_file_if_changed, YAML_LOADER
+from copy_engine import index_plate_files, is_copy_up_to_date, copy_files_in_parallel, format_copy_report
 
 # ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
 # General code description :
+# 0. FlashPipeError : Exception raised by the functions when the structure cannot be generated.
 # 1. open_file_yml : opens a YAML file.
 # 2. Function replace_value_config_template_copier : Replaces values present in copier.yml to define project directories and files.
-# 3. Identify the path of each read (1 or 2) for each plate in the “template” config file (copier.yml) and create the symlink.
-# 4. Function Copy_index_sort : Copies the Index Sorting (of the plates supplied in the FlashPipe Config file) and 
-# 5. Function copy_gsf : Copies the GSF file into the new directories.
+# 3. Identify the path of each read (1 or 2) for each plate in the “template” config file (copier.yml) and create the symlink (using the FastQ catalog, lanes are merged).
+# 4. Function Copy_index_sort : Copies the Index Sorting (of the plates supplied in the FlashPipe Config file), in parallel and only if changed.
+# 5. Function copy_gsf : Copies the GSF file into the new directories (only if changed).
 # 6. Function verify_method : Checks whether the parameter for the method is correct (single-cell or minibulk).
 # 7. Function verify_parameter : Check if the provided paramter has the right type of value.
 # 8. Function verify_name_experience_path_and_config_file : Checks if the experiment name given in the config file matches the one retrieved by the directory path
@@ -20,8 +23,22 @@ import pandas as pd
 # 11. Function verify_empty_values_config_file : Checks that all mandarity sections in the user config file (yaml) are not empty.*
 # 12. Checks the parameter airrflow, to adapt the option for the launch
 # 13. Function to generate the tsv file containing the information required by Airrflow
+# 14. Function verify_number_parameter : Checks that a numeric parameter is a number within the allowed range.
+# 15. Functions read_table / format_table : Reads and writes small CSV/TSV files (without pandas, whose import is longer than the staging itself).
 # ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
 
+# YAML dumper written in C (libyaml) when PyYAML was built with it (the loader is defined in render_template.py)
+YAML_DUMPER = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 0. FlashPipeError : Exception raised when the structure cannot be generated.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+class FlashPipeError(Exception):
+    '''
+    Error in the config file or in the input files, which stops the generation of the structure.
+    The message is the one displayed to the user.
+    '''
+
 # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
 # ## 1. open_file_yml function: opens a YAML file and returns its contents.
 # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
@@ -32,7 +49,7 @@ def open_file_yml(file_config_user_path):
     file_config_user_path: Path to the YAML config file
     '''
     with open(file_config_user_path, 'r') as file: 
-        return yaml.safe_load(file)
+        return yaml.load(file, Loader=YAML_LOADER)
 
 # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
 # ## 2. Function replace_value_config_template_copier: Replaces default values in copier.yml with those in the dictionary.
@@ -53,78 +70,152 @@ def replace_value_config_template_copier(config_path, dict_new_values):
             # The variable to be applied to the key (e.g. “barcode”) will be replaced by the value (values) present in our dictionary.
             data[key]['default'] = value
 
-    # Save changes to file
-    with open(config_path, 'w') as file:
-        yaml.dump(data, file, default_flow_style=False, allow_unicode=True)
+    # Save changes to file (in a new file renamed over the old one: the file may be a hardlink to the template, which must not be modified)
+    tmp_config_path = f"{config_path}.{os.getpid()}.tmp"
+    with open(tmp_config_path, 'w') as file:
+        yaml.dump(data, file, Dumper=YAML_DUMPER, default_flow_style=False, allow_unicode=True)
+    os.replace(tmp_config_path, config_path)
 
 # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
 # ## 3. Identify the path of each read (1 or 2) for each plate in the “template” config file (copier.yml) and create the symlink.
 # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
-def prepare_fastq_symlinks_and_paths(source_dir, output_dir, plates_list):
+def resolve_fastq_files(source_dir, output_dir, plates_list, catalog_path=None, merge_lanes=True, watch=False):
     """
-    Identifies fastq files (R1 and R2) by plate, creates symbolic links, and returns the paths to these links for each read (for the template file).
-
-    dir_entry: Source directory containing the files.
+    Identifies fastq files (R1 and R2) by plate, without creating anything (the catalog is updated in memory only).
+    The fastq files are retrieved from a catalog of the sequencing run (see fastq_catalog.py), loaded from catalog_path
+    so that only the directories that changed since the last run are re-scanned.
+    When a plate was sequenced on several lanes, the lanes of each read are merged in a single file (see merge_fastq_lanes.py)
+    and the path to this file is used instead of the symbolic link.
+    Returns the updated catalog and a dictionary plate -> {'read1', 'read2' (paths used by the workflow),
+    'sources' (fastq files of the catalog), 'links' (list of (file_path, link_path)), 'merge_jobs' (list of (lane_files, merged_path)),
+    'lanes' (read type -> lane -> path of the fastq file in the source directory)}.
+    In watch mode (see fastq_watch.py), the files may still be written : a missing read or lane is not an error, read1 and
+    read2 are the fixed paths {plate}_R1.fastq.gz / _R2 (linked or merged when the plate is ready) and nothing is linked here.
+
+    source_dir: Source directory containing the files.
     output_dir: Output directory where symbolic links will be created.
     plates_list: List of plates to be taken into account when creating links.
+    catalog_path: Path to the JSON file where the catalog of the fastq files is kept (None to always scan the whole directory).
+    merge_lanes: If False, a plate with several lanes is an error (instead of merging its lanes).
+    watch: If True, the plates whose files are not all written yet are accepted (watch mode of the FastQ files).
     """
-    
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
+    # Dictionary to track files found by plate, and by lane for each read
+    found_reads = {plate: {'R1': {}, 'R2': {}} for plate in plates_list}
+    plate_fastq = {plate: {'read1': None, 'read2': None, 'sources': [], 'links': [], 'merge_jobs': [], 'lanes': {'R1': {}, 'R2': {}}}
+                   for plate in plates_list}
+
+    # Load the catalog of the previous run and only re-scan the directories modified since
+    catalog = open_fastq_catalog(catalog_path, source_dir)
+    catalog, rescanned = update_fastq_catalog(source_dir, catalog)
+    print(f"FastQ catalog : {rescanned} of {len(catalog['directories'])} directories scanned.")
+
+    # Browse files of the catalog
+    for fastq in catalog_fastq_files(catalog):
+        matched_plate_name = fastq['plate_name']
+        read_type = fastq['read_type']
+
+        if matched_plate_name in plates_list:
+            link_path = os.path.join(output_dir, fastq['name'])
+            # Files without lane number in their name are stored with an empty lane
+            lane = fastq['lane'] or ''
+            # Keeping only one of the files would silently lose the reads of the other ones
+            if lane in found_reads[matched_plate_name][read_type]:
+                raise FlashPipeError(f"ERROR : Several {read_type} files found for plate '{matched_plate_name}' (lane '{lane or 'none'}') : "
+                                     f"{os.path.basename(found_reads[matched_plate_name][read_type][lane])} and {fastq['name']}")
+            found_reads[matched_plate_name][read_type][lane] = link_path
+            plate_fastq[matched_plate_name]['lanes'][read_type][lane] = fastq['path']
+            plate_fastq[matched_plate_name]['sources'].append(fastq)
+            plate_fastq[matched_plate_name]['links'].append((fastq['path'], link_path))
+
+    # In watch mode, the files are linked (or merged) by fastq_watch.py when the plate is ready
+    if watch:
+        for plate in plates_list:
+            plate_fastq[plate]['read1'] = os.path.join(output_dir, f"{plate}_R1.fastq.gz")
+            plate_fastq[plate]['read2'] = os.path.join(output_dir, f"{plate}_R2.fastq.gz")
+            plate_fastq[plate]['links'] = []
+        return catalog, plate_fastq
 
-    # Initialize array of Read1 and Read2 fastq files
-    fastq_files_read1 = []
-    fastq_files_read2 = []
+    # Check that each plate has an R1 and an R2 (on the same lanes)
+    for plate, reads in found_reads.items():
+        if not reads['R1'] or not reads['R2']:
+            raise FlashPipeError(f"ERROR : R1 or R2 files missing for '{plate}' plate")
+        if sorted(reads['R1']) != sorted(reads['R2']):
+            raise FlashPipeError(f"ERROR : R1 and R2 files of '{plate}' plate are not on the same lanes (R1: {sorted(reads['R1'])}, R2: {sorted(reads['R2'])})")
 
-    # Regex to identify FastQ Read1 and Read2 files.
-    r1_pattern = re.compile(r'^(?P<plate_name>.*)_.*_R1_.*\.fastq.gz$')
-    r2_pattern = re.compile(r'^(?P<plate_name>.*)_.*_R2_.*\.fastq.gz$')
+        if len(reads['R1']) == 1:
+            plate_fastq[plate]['read1'] = next(iter(reads['R1'].values()))
+            plate_fastq[plate]['read2'] = next(iter(reads['R2'].values()))
+            continue
 
-    # Dictionary to track files found by plate
-    found_reads = {plate: {'R1': None, 'R2': None} for plate in plates_list}
+        if not merge_lanes:
+            raise FlashPipeError(f"ERROR : '{plate}' plate was sequenced on several lanes ({', '.join(sorted(reads['R1']))}) and the lanes merge is disabled.")
 
-    # Browse files in the source directory
-    for root, dirs, files in os.walk(source_dir):
-        for file in files:
-            if not file.endswith('.fastq.gz'):
-                continue
+        # The lanes are merged in the same order for R1 and R2, so that the reads stay paired.
+        # The source files are read (not the symbolic links, which may still point to a previous fastq_directories).
+        for read_type, read_key in (('R1', 'read1'), ('R2', 'read2')):
+            lane_files = [plate_fastq[plate]['lanes'][read_type][lane] for lane in sorted(reads[read_type])]
+            merged_path = os.path.join(output_dir, f"{plate}_merged_{read_type}.fastq.gz")
+            plate_fastq[plate]['merge_jobs'].append((lane_files, merged_path))
+            plate_fastq[plate][read_key] = merged_path
 
-            file_path = os.path.join(root, file)
-            link_path = os.path.join(output_dir, file)
+    return catalog, plate_fastq
 
-            r1_match = r1_pattern.match(file)
-            r2_match = r2_pattern.match(file)
+def link_file(source_path, link_path):
+    '''
+    Creates (or replaces) the symbolic link link_path to source_path, atomically.
+    '''
+    if os.path.islink(link_path) and os.readlink(link_path) == source_path:
+        return
+    tmp_path = f"{link_path}.{os.getpid()}.tmp"
+    if os.path.lexists(tmp_path):
+        os.remove(tmp_path)
+    os.symlink(source_path, tmp_path)
+    os.replace(tmp_path, link_path)
+
+def link_fastq_files(plate_fastq, output_dir, plates_list=None, processes=None):
+    """
+    Creates the symbolic links to the fastq files and merges the lanes, for the plates resolved by resolve_fastq_files.
 
-            matched_plate_name = None
-            read_type = None
+    plate_fastq: Dictionary returned by resolve_fastq_files.
+    output_dir: Output directory where symbolic links are created.
+    plates_list: Plates to process (default: all the plates of plate_fastq).
+    processes: Maximum number of processes used to merge the lanes.
+    """
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
 
-            if r1_match:
-                matched_plate_name = r1_match.group('plate_name')
-                read_type = 'R1'
-            elif r2_match:
-                matched_plate_name = r2_match.group('plate_name')
-                read_type = 'R2'
+    merge_jobs = []
+    for plate in (plates_list if plates_list is not None else plate_fastq):
+        for file_path, link_path in plate_fastq[plate]['links']:
+            # Creating symbolic link (a link to another file, from a previous fastq_directories, is replaced)
+            try:
+                link_file(file_path, link_path)
+            except Exception as e:
+                print(f"Error creating {link_path} symbolic link: {e}")
+        merge_jobs.extend(plate_fastq[plate]['merge_jobs'])
 
-            if matched_plate_name in plates_list and read_type:
-                found_reads[matched_plate_name][read_type] = link_path
+    merge_fastq_lanes_in_parallel(merge_jobs, processes=processes)
 
-                # Creating symbolic link
-                try:
-                    os.symlink(file_path, link_path)
-                except FileExistsError:
-                    print(f"The {link_path} symbolic link already exists.") # Link_name n'existe pas dans cette fonction...
-                except Exception as e:
-                    print(f"Error creating {link_path} symbolic link: {e}") # Link_name n'existe pas dans cette fonction...
+def prepare_fastq_symlinks_and_paths(source_dir, output_dir, plates_list, catalog_path=None, merge_lanes=True, processes=None):
+    """
+    Identifies fastq files (R1 and R2) by plate, creates symbolic links, and returns the paths to these links for each read (for the template file).
+    See resolve_fastq_files and link_fastq_files; the catalog is saved in catalog_path for the next runs.
 
-    # Check that each plate has an R1 and an R2
-    for plate, reads in found_reads.items():
-        if not reads['R1'] or not reads['R2']:
-            print(f"ERROR : R1 or R2 files missing for '{plate}' plate")
-            sys.exit()
+    source_dir: Source directory containing the files.
+    output_dir: Output directory where symbolic links will be created.
+    plates_list: List of plates to be taken into account when creating links.
+    catalog_path: Path to the JSON file where the catalog of the fastq files is kept (no catalog is saved if None).
+    merge_lanes: If False, a plate with several lanes is an error (instead of merging its lanes).
+    processes: Maximum number of processes used to merge the lanes.
+    """
+    catalog, plate_fastq = resolve_fastq_files(source_dir, output_dir, plates_list, catalog_path=catalog_path, merge_lanes=merge_lanes)
+    if catalog_path:
+        save_fastq_catalog(catalog, catalog_path)
 
-        fastq_files_read1.append(reads['R1'])
-        fastq_files_read2.append(reads['R2'])
+    link_fastq_files(plate_fastq, output_dir, processes=processes)
 
+    fastq_files_read1 = [plate_fastq[plate]['read1'] for plate in plates_list]
+    fastq_files_read2 = [plate_fastq[plate]['read2'] for plate in plates_list]
     return fastq_files_read1, fastq_files_read2
 
 # ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
@@ -132,46 +223,34 @@ def prepare_fastq_symlinks_and_paths(source_dir, output_dir, plates_list):
 # ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
 def copy_index_sort(source_dir, destination_dir, plates_list=None):
     '''
-    Copies files to a destination directory.
+    Copies the Index Sorting files to a destination directory.
     If plates_list is supplied, only the specified plates will be copied.
+    The source directory is listed once, and the files are copied in parallel.
+    A file is skipped only if the destination has the same size, modification time and content hash.
+    Returns the copy report (files and bytes copied).
 
     source_dir: Source directory containing the files to be copied.
     destination_dir: Destination directory for copied files.
     plates_list: List of plates to be processed for index_sort files.
     '''
-    # Create destination directory if it doesn't exist
-    if not os.path.exists(destination_dir):
-        os.makedirs(destination_dir)
+    # Index the .csv files with a plate name followed by something, in a single pass on the directory
+    plate_files = index_plate_files(source_dir)
 
-    # Definition of regular expression for .csv files with a plate name followed by something
-    csv_pattern = re.compile(r'^(?P<plate_name>.*)_.*\.csv$')
-
-    # If plates_list is provided, only the .csv files corresponding to the plates are copied
     if plates_list:
-        for plate in plates_list:
-            found = False  # Flag to check if at least one file was found for this plate
-            for file_name in os.listdir(source_dir):
-                # Check if the file matches the pattern and the plate name
-                match = csv_pattern.match(file_name)
-                if match and match.group('plate_name') == plate:
-                    found = True
-                    # Retrieves plate IndexSort file (path)
-                    csv_file = os.path.join(source_dir, file_name)
-                    # Create the output path, to make sure it doesn't already exist.
-                    dest_file = os.path.join(destination_dir, file_name)
-                    if os.path.exists(dest_file):
-                        print(f"Skipped: File already exists in destination : {dest_file}")
-                        continue
-                    elif os.path.exists(csv_file):
-                        try:
-                            shutil.copy2(csv_file, destination_dir)
-                        except Exception as e:
-                            print(f"Error when copying file {csv_file}: {e}")
-                    else:
-                        print(f"The file {csv_file} does not exist.")
-            if not found:
-                print(f"ERROR: No indexsort file found for plate : {plate}")
-                sys.exit()
+        missing_plates = [plate for plate in plates_list if plate not in plate_files]
+        if missing_plates:
+            raise FlashPipeError("\n".join(f"ERROR: No indexsort file found for plate : {plate}" for plate in missing_plates))
+        source_files = [file_path for plate in plates_list for file_path in plate_files[plate]]
+    else:
+        source_files = [file_path for plate in sorted(plate_files) for file_path in plate_files[plate]]
+
+    copy_jobs = [(source_file, os.path.join(destination_dir, os.path.basename(source_file))) for source_file in source_files]
+    report = copy_files_in_parallel(copy_jobs)
+    if report['errors']:
+        raise FlashPipeError("\n".join(f"ERROR: {error}" for error in report['errors']))
+
+    print(f"Index Sorting : {format_copy_report(report)}")
+    return report
 
 # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
 # ## 5. copy_gsf : Copies the GSF file into the new directories.
@@ -180,38 +259,44 @@ def copy_index_sort(source_dir, destination_dir, plates_list=None):
 def copy_gsf(source_file, destination_dir):
     '''
     Copies a single file (typically a GSF file) to a destination directory.
-    If a file with the same name already exists in the target directory, it will be renamed
+    If the file is already in the target directory with the same size, modification time and content, nothing is done.
+    If a different file with the same name already exists in the target directory, it will be renamed
     by adding the suffix "_old" before the new file is copied.
+    Returns the copy report (files and bytes copied).
 
     Arguments :
     - source_file : path to the source file to be copied.
     - destination_dir : destination directory.
     '''
     if not os.path.exists(source_file) :
-        print("WARNING: The GSF file supplied does not exist.")
-        sys.exit()
-    elif os.path.isfile(source_file):
-        # Recovers only the file name from the source path.
-        # Rebuilds the complete path in the destination directory.
-        file_name = os.path.basename(source_file)
-        file_output_template = os.path.join(destination_dir, file_name)
-        # Checks that the source file is not already located in the destination directory.
-        if file_output_template != source_file:
-            # If a file with the same name already exists in the destination,
-            # rename it by adding the suffix “_old” before overwriting the file.
-            if os.path.exists(file_output_template):
-                base, ext = os.path.splitext(file_output_template)
-                old_file = base + "_old" + ext
-                os.rename(file_output_template, old_file)
-
-            shutil.copy(source_file, file_output_template)
-        # If the source file is already present in the same location with the same name,
-        # no action is required (avoids copying a file onto itself).
-        elif os.path.exists(file_output_template):
-            print( "WARNING: Using already existing GSF file")
-    else:
-        print("ERROR:", source_file, "is not a file.")
-        sys.exit()
+        raise FlashPipeError(f"ERROR: The GSF file supplied does not exist ({source_file}).")
+    elif not os.path.isfile(source_file):
+        raise FlashPipeError(f"ERROR: {source_file} is not a file.")
+
+    # Recovers only the file name from the source path.
+    # Rebuilds the complete path in the destination directory.
+    file_name = os.path.basename(source_file)
+    file_output_template = os.path.join(destination_dir, file_name)
+
+    # If the source file is already present in the same location with the same name,
+    # no action is required (avoids copying a file onto itself).
+    if os.path.exists(file_output_template) and os.path.samefile(source_file, file_output_template):
+        print( "WARNING: Using already existing GSF file")
+        return copy_files_in_parallel([])
+
+    # If a different file with the same name already exists in the destination,
+    # rename it by adding the suffix “_old” before overwriting the file.
+    if os.path.exists(file_output_template) and not is_copy_up_to_date(source_file, file_output_template):
+        base, ext = os.path.splitext(file_output_template)
+        old_file = base + "_old" + ext
+        os.replace(file_output_template, old_file)
+
+    report = copy_files_in_parallel([(source_file, file_output_template)])
+    if report['errors']:
+        raise FlashPipeError("\n".join(f"ERROR: {error}" for error in report['errors']))
+
+    print(f"GSF : {format_copy_report(report)}")
+    return report
 
 # ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
 # ## 6. Function verify_method : Checks whether the parameter for the method is correct (single-cell or minibulk).
@@ -226,8 +311,7 @@ def verify_method(parameter, indexsort):
     '''
     # If it's not single-cell or minibulk then there's an error
     if parameter != "single-cell" and parameter != "minibulk" :
-        print("ERROR : The method (single-cell or minibulk) is erroneous (check the config file for the correct term).")
-        sys.exit()
+        raise FlashPipeError("ERROR : The method (single-cell or minibulk) is erroneous (check the config file for the correct term).")
     else : 
         print("You selected method: ", parameter)    
         
@@ -254,12 +338,10 @@ def verify_parameters(parameter, name_params):
         elif parameter_lower in ['no', 'false']:
             parameter = False
         else:
-            print(f"ERROR: Invalid string value '{parameter}' for {name_params}. Should be 'yes' or 'no'.")
-            sys.exit()
+            raise FlashPipeError(f"ERROR: Invalid string value '{parameter}' for {name_params}. Should be 'yes' or 'no'.")
 
     elif not isinstance(parameter, bool):
-        print(f"ERROR: Unexpected type for {name_params}: {type(parameter)}. Expected bool or 'yes'/'no' as string.")
-        sys.exit()
+        raise FlashPipeError(f"ERROR: Unexpected type for {name_params}: {type(parameter)}. Expected bool or 'yes'/'no' as string.")
 
     # Now handle as boolean
     if parameter:
@@ -281,8 +363,7 @@ def verify_name_experience_path_and_config_file(path_experience, name_experience
     name_experience_config: Name of experiment given in config (Config_flashpipe) file by user
     '''
     if os.path.basename(path_experience) != name_experience_config :
-        print("ERROR : Path to experiment (",os.path.basename(path_experience) ,") is different from that given in config file (", name_experience_config, ").", sep = "")
-        sys.exit()
+        raise FlashPipeError(f"ERROR : Path to experiment ({os.path.basename(path_experience)}) is different from that given in config file ({name_experience_config}).")
 
 # ••••••••••••••••••••••••••••••••••••••••••••••••••••
 # ## 9. Checks if the provided file exists.
@@ -294,8 +375,7 @@ def verify_file_exist(file_path):
     file_path: Path to file (check for existence)
     '''
     if not os.path.isfile(file_path) :
-        print("ERROR: The file does not exist (", file_path ,"). (Can be cause by the project or experience name).", sep = "")
-        sys.exit()
+        raise FlashPipeError(f"ERROR: The file does not exist ({file_path}). (Can be cause by the project or experience name).")
 
 # ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
 # ## 10. Check that the separators in the file are "," and not something else.
@@ -308,8 +388,7 @@ def verify_separator_in_config_file(file_config_flashpipe_option, str_split):
     str_split: List containing possible separators set by the user (example: ; / | etc...)
     '''
     if any(char in file_config_flashpipe_option for char in str_split):
-        print("ERROR: The separator you put in the config file (", file_config_flashpipe_option, ") are not good. \nPut ',' to separate the different names.", sep="")
-        sys.exit()
+        raise FlashPipeError(f"ERROR: The separator you put in the config file ({file_config_flashpipe_option}) are not good. \nPut ',' to separate the different names.")
 
 # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
 # ## 11. Checks that all mandarity sections in the user config file (yaml) are not empty.
@@ -320,7 +399,7 @@ def verify_empty_values_config_file(file_config_flashpipe):
     
     file_config_flashpipe: The yaml file to be checked
     '''
-    acc = 0
+    errors = []
     skip_keys = set()
 
     # If index_sort_analysis is set to False, the checks for certain keys are ignored.
@@ -344,11 +423,10 @@ def verify_empty_values_config_file(file_config_flashpipe):
         if key in skip_keys:
             continue
         if file_config_flashpipe[key] is None:
-            acc += 1
-            print("ERROR: Section (", key ,") is empty in the config file. \nPlease provide at least 1 elements.", sep = "")
+            errors.append(f"ERROR: Section ({key}) is empty in the config file. \nPlease provide at least 1 elements.")
 
-    if acc > 0:
-        sys.exit()
+    if errors:
+        raise FlashPipeError("\n".join(errors))
 
 # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
 # ## 12. Checks the parameter airrflow, to adapt the option for the launch
@@ -390,7 +468,7 @@ def generate_airrflow_samplesheet(path_airrflow_reference, plates_list, fastq_fi
         bcr_key: Variable for detecting the value contained in BCR.
         tcr_key: Variable for detecting the value contained in TCR.
     '''
-    df_template = pd.read_csv(path_airrflow_reference, sep="\t")
+    columns, _ = read_table(path_airrflow_reference, sep="\t")
     
     # Determine value for method (single-cell or minibulk)
     method_analysis = file_config_flashpipe.get(method_key)
@@ -424,7 +502,59 @@ def generate_airrflow_samplesheet(path_airrflow_reference, plates_list, fastq_fi
         }
         rows.append(row)
 
-    # Create the DataFrame and save
-    df_output = pd.DataFrame(rows, columns=df_template.columns)
-    df_output.to_csv(path_airrflow_reference, sep="\t", index=False)
+    # Save with the columns of the template (only if the samplesheet changed, to keep its modification time for Snakemake)
+    write_file_if_changed(path_airrflow_reference, format_table(columns, rows, sep="\t").encode('utf-8'))
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 14. Checks that a numeric parameter is a number within the allowed range.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def verify_number_parameter(parameter, name_params, number_type=float, minimum=None, maximum=None):
+    '''
+    Checks that the parameter is a number (int or float) between minimum and maximum (included), and returns it.
+
+    parameter: Value given in the config file.
+    name_params: Name of the parameter (for the error message).
+    number_type: Type expected (int or float).
+    minimum: Minimal value allowed (optional).
+    maximum: Maximal value allowed (optional).
+    '''
+    # YAML reads yes/no as booleans, which are also integers in Python
+    if isinstance(parameter, bool) or not isinstance(parameter, (int, float)) or \
+            (number_type is int and not float(parameter).is_integer()):
+        raise FlashPipeError(f"ERROR: Invalid value '{parameter}' for {name_params}. Should be a number ({number_type.__name__}).")
+
+    if (minimum is not None and parameter < minimum) or (maximum is not None and parameter > maximum):
+        raise FlashPipeError(f"ERROR: Invalid value '{parameter}' for {name_params}. Should be between {minimum} and {maximum}.")
+
+    return number_type(parameter)
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 15. Functions read_table / format_table : Reads and writes small CSV/TSV files.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def read_table(file_path, sep=","):
+    '''
+    Reads a CSV/TSV file with a header line.
+    Returns the list of column names and the list of rows (one dictionary column -> value per line, values are strings).
+
+    file_path: Path to the file.
+    sep: Column separator.
+    '''
+    with open(file_path, 'r', newline='') as file:
+        reader = csv.DictReader(file, delimiter=sep)
+        rows = list(reader)
+        return list(reader.fieldnames or []), rows
 
+def format_table(columns, rows, sep=","):
+    '''
+    Returns the content of a CSV/TSV file (header line, then one line per row), as written by pandas to_csv(index=False) :
+    the values missing in a row are empty, the keys that are not in columns are ignored.
+
+    columns: List of column names (in the order of the file).
+    rows: List of dictionaries column -> value.
+    sep: Column separator.
+    '''
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=columns, delimiter=sep, restval='', extrasaction='ignore', lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows)
+    return output.getvalue()
@@ -0,0 +1,201 @@
+import json
+import os
+import re
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# 1. Function parse_fastq_file_name : Retrieves the plate name, the lane and the read type (R1 or R2) from a FastQ file name.
+# 2. Function open_fastq_catalog : Loads a FastQ catalog previously saved (or an empty one).
+# 3. Function save_fastq_catalog : Writes the FastQ catalog on disk (atomically).
+# 4. Function update_fastq_catalog : Browses the sequencing run with os.scandir and only re-scans the directories that changed
+#    (the files of the other directories are only stat again).
+# 5. Function catalog_fastq_files : Lists all the FastQ files known by the catalog.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Version of the catalog format (a catalog with another version is rebuilt from scratch)
+# 2 : lane number also read after the read type (_R1_L001)
+# 3 : plate names of the files with the lane before the read type parsed as before the lanes (P1_S1_L001_R1 -> P1_S1)
+CATALOG_VERSION = 3
+
+# Regex to identify FastQ Read1 and Read2 files.
+# The lane patterns are tested first, so that the lane number is not kept in the plate name. The lane is written before
+# the read type by bcl2fastq (P1_H9C0U2GX_S1_L001_R1_001.fastq.gz), or after it (P1_H9C0U2GX_S9_R1_L001.fastq.gz).
+# The plate name is the same as with FASTQ_PATTERN (the field before the read type is dropped) : only the lane token is
+# removed, so P1_H9C0U2GX_S1_L001_R1_001.fastq.gz gives the plate P1_H9C0U2GX_S1 and P1_H9C0U2GX_S9_R1_L001.fastq.gz P1_H9C0U2GX.
+FASTQ_LANE_PATTERN = re.compile(r'^(?P<plate_name>.*)_L(?P<lane>\d{3})_(?P<read_type>R[12])_.*\.fastq\.gz$')
+FASTQ_READ_LANE_PATTERN = re.compile(r'^(?P<plate_name>.*)_[^_]*_(?P<read_type>R[12])_L(?P<lane>\d{3})(_.*)?\.fastq\.gz$')
+FASTQ_PATTERN = re.compile(r'^(?P<plate_name>.*)_.*_(?P<read_type>R[12])_.*\.fastq\.gz$')
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function parse_fastq_file_name : Retrieves the plate name, the lane and the read type of a file.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def parse_fastq_file_name(file_name):
+    '''
+    Retrieves the plate name, the lane and the read type (R1 or R2) from a FastQ file name.
+    Returns None if the file is not a FastQ Read1 or Read2 file.
+
+    file_name: Name of the file (example: P1_H9C0U2GX_S1_L001_R1_001.fastq.gz)
+    '''
+    for lane_pattern in (FASTQ_LANE_PATTERN, FASTQ_READ_LANE_PATTERN):
+        match = lane_pattern.match(file_name)
+        if match:
+            return match.group('plate_name'), match.group('lane'), match.group('read_type')
+
+    match = FASTQ_PATTERN.match(file_name)
+    if match:
+        return match.group('plate_name'), None, match.group('read_type')
+
+    return None
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function open_fastq_catalog : Loads a FastQ catalog previously saved.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def open_fastq_catalog(catalog_path, source_dir):
+    '''
+    Loads the FastQ catalog saved in catalog_path.
+    An empty catalog is returned if the file does not exist, cannot be read, or was built for another source directory.
+
+    catalog_path: Path to the JSON catalog file.
+    source_dir: Directory containing the FastQ files (fastq_directories in the config file).
+    '''
+    empty_catalog = {'version': CATALOG_VERSION, 'source_dir': source_dir, 'directories': {}}
+
+    if not catalog_path or not os.path.isfile(catalog_path):
+        return empty_catalog
+
+    try:
+        with open(catalog_path, 'r') as file:
+            catalog = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"WARNING: The FastQ catalog {catalog_path} cannot be read, it will be rebuilt ({e}).")
+        return empty_catalog
+
+    # A catalog built with another format or for another sequencing run is not reused.
+    if catalog.get('version') != CATALOG_VERSION or catalog.get('source_dir') != source_dir:
+        return empty_catalog
+
+    return catalog
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function save_fastq_catalog : Writes the FastQ catalog on disk.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def save_fastq_catalog(catalog, catalog_path):
+    '''
+    Writes the FastQ catalog in a temporary file then renames it, so that an interrupted run never leaves a truncated catalog.
+
+    catalog: Catalog dictionary (as returned by update_fastq_catalog).
+    catalog_path: Path to the JSON catalog file.
+    '''
+    catalog_dir = os.path.dirname(catalog_path)
+    if catalog_dir and not os.path.exists(catalog_dir):
+        os.makedirs(catalog_dir)
+
+    tmp_path = f"{catalog_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(catalog, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, catalog_path)
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function update_fastq_catalog : Browses the sequencing run and only re-scans the directories that changed.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def scan_fastq_directory(dir_path):
+    '''
+    Lists the sub-directories and the FastQ files of a single directory (one os.scandir call).
+
+    dir_path: Directory to scan.
+    '''
+    subdirs = []
+    files = []
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+                continue
+            if not entry.name.endswith('.fastq.gz'):
+                continue
+            parsed = parse_fastq_file_name(entry.name)
+            if parsed is None:
+                continue
+            plate_name, lane, read_type = parsed
+            # The stat is already cached by os.scandir on most systems (no extra call on NFS)
+            stat = entry.stat(follow_symlinks=True)
+            files.append({
+                'name': entry.name,
+                'path': entry.path,
+                'plate_name': plate_name,
+                'lane': lane,
+                'read_type': read_type,
+                'size': stat.st_size,
+                'mtime': stat.st_mtime_ns
+            })
+    return sorted(subdirs), sorted(files, key=lambda fastq: fastq['name'])
+
+def restat_fastq_files(files):
+    '''
+    Updates the size and modification time of the files of a directory taken from the catalog (one os.stat per file) :
+    a file rewritten or appended in place does not change the modification time of its directory.
+    The measures made on a file that changed ('bytes_per_read') are dropped. Returns False if a file cannot be accessed.
+
+    files: Files of the directory (entries of the catalog).
+    '''
+    for fastq in files:
+        try:
+            stat = os.stat(fastq['path'])
+        except OSError:
+            return False
+        if fastq['size'] != stat.st_size or fastq['mtime'] != stat.st_mtime_ns:
+            fastq['size'] = stat.st_size
+            fastq['mtime'] = stat.st_mtime_ns
+            fastq.pop('bytes_per_read', None)
+    return True
+
+def update_fastq_catalog(source_dir, catalog):
+    '''
+    Updates the catalog with the content of source_dir.
+    A directory whose modification time did not change since the last run is not listed again:
+    its files and sub-directories are taken from the catalog (the sub-directories are checked and the files stat again).
+    Returns the updated catalog and the number of directories that have been (re)scanned.
+
+    source_dir: Directory containing the FastQ files (fastq_directories in the config file).
+    catalog: Catalog dictionary (as returned by open_fastq_catalog).
+    '''
+    previous_directories = catalog.get('directories', {})
+    directories = {}
+    rescanned = 0
+
+    # Iterative browse (instead of os.walk) to be able to skip the listing of the unchanged directories.
+    pending = [source_dir]
+    while pending:
+        dir_path = pending.pop()
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime_ns
+        except OSError as e:
+            print(f"WARNING: Cannot access the directory {dir_path} : {e}")
+            continue
+
+        known = previous_directories.get(dir_path)
+        if known is not None and known.get('mtime') == dir_mtime and restat_fastq_files(known['files']):
+            directories[dir_path] = known
+        else:
+            subdirs, files = scan_fastq_directory(dir_path)
+            directories[dir_path] = {'mtime': dir_mtime, 'subdirs': subdirs, 'files': files}
+            rescanned += 1
+
+        pending.extend(directories[dir_path]['subdirs'])
+
+    catalog['directories'] = directories
+    return catalog, rescanned
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 5. Function catalog_fastq_files : Lists all the FastQ files known by the catalog.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def catalog_fastq_files(catalog):
+    '''
+    Returns the list of FastQ files of the catalog (one dictionary per file, ordered by path).
+
+    catalog: Catalog dictionary.
+    '''
+    fastq_files = []
+    for dir_path in sorted(catalog.get('directories', {})):
+        fastq_files.extend(catalog['directories'][dir_path]['files'])
+    return fastq_files
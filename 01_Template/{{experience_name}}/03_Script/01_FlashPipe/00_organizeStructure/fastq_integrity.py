@@ -0,0 +1,226 @@
+import hashlib
+import json
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from create_folder_structure_function import FlashPipeError
+from fastq_watch import members_complete
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Integrity check of the FastQ files (fastq_integrity in the config file), run before the FastQ files are linked :
+# a truncated or corrupted .fastq.gz is reported at the staging instead of failing zUMIs/STAR hours later.
+# Each file is read once with large sequential reads : its MD5 checksum is computed and its gzip stream is decompressed
+# up to the trailer of the last member (CRC and size checked by zlib). The files are checked in a process pool.
+# The MD5 checksums are compared with the checksum files of the sequencer (md5sum format) when they are present.
+# The results are kept in a ledger (00_RawData/fastq_integrity.json) with the size and modification time of each file :
+# the files that did not change are never read again at the next stagings.
+# 1. Function verify_fastq_file : Computes the checksum of a FastQ file and checks its gzip stream.
+# 2. Function read_sequencer_checksums : Reads the checksum files of the sequencer in a directory.
+# 3. Function open_integrity_ledger / save_integrity_ledger : Loads / writes the ledger of the files already checked.
+# 4. Function verify_fastq_integrity : Checks the FastQ files of the plates, only reading the new or modified ones.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Size of the blocks read from the FastQ files (large sequential reads are better on NFS)
+INTEGRITY_BUFFER_SIZE = 16 * 1024 * 1024
+# Version of the ledger format (a ledger written with another format is not reused)
+LEDGER_VERSION = 1
+# Line of a checksum file in the md5sum format : checksum, then the file name (preceded by '*' in binary mode)
+CHECKSUM_LINE = re.compile(r'^([0-9a-fA-F]{32})\s+\*?(.+)$')
+# Checksum files written by the sequencers / sequencing platforms
+CHECKSUM_EXTENSIONS = ('.md5', '.md5sum')
+CHECKSUM_NAMES = ('md5sum.txt', 'md5sums.txt', 'md5sums', 'checksums.md5')
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function verify_fastq_file : Computes the checksum of a FastQ file and checks its gzip stream.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def verify_fastq_file(file_path):
+    '''
+    Reads the file once : computes its MD5 checksum and decompresses its gzip members (the decompressed data is not kept).
+    Returns {'md5': hexadecimal checksum, 'gzip_complete': True if all the gzip members are complete and not corrupted}.
+
+    file_path: Path to the FastQ file (.fastq.gz).
+    '''
+    digest = hashlib.md5()
+
+    def read_blocks(file):
+        for block in iter(lambda: file.read(INTEGRITY_BUFFER_SIZE), b''):
+            digest.update(block)
+            yield block
+
+    with open(file_path, 'rb') as file:
+        blocks = read_blocks(file)
+        gzip_complete = members_complete(blocks)
+        # A corrupted member stops the decompression : the end of the file is still read for the checksum
+        for _ in blocks:
+            pass
+
+    return {'md5': digest.hexdigest(), 'gzip_complete': gzip_complete}
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function read_sequencer_checksums : Reads the checksum files of the sequencer in a directory.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def read_sequencer_checksums(dir_path):
+    '''
+    Reads the checksum files of a directory (md5sum format : one "checksum  file name" per line, or a single checksum in
+    {file name}.md5). Returns a dictionary path of the file relative to dir_path -> MD5 checksum (lower case).
+
+    dir_path: Directory to search.
+    '''
+    checksums = {}
+    try:
+        entries = [entry for entry in os.scandir(dir_path)
+                   if entry.is_file() and (entry.name.endswith(CHECKSUM_EXTENSIONS) or entry.name.lower() in CHECKSUM_NAMES)]
+    except OSError:
+        return checksums
+
+    for entry in entries:
+        try:
+            with open(entry.path, 'r') as file:
+                lines = file.read().splitlines()
+        except (OSError, UnicodeDecodeError) as e:
+            print(f"WARNING: The checksum file {entry.path} cannot be read ({e}).")
+            continue
+        for line in lines:
+            line = line.strip()
+            match = CHECKSUM_LINE.match(line)
+            if match:
+                checksums[os.path.normpath(match.group(2).strip())] = match.group(1).lower()
+            # {file name}.md5 containing only the checksum
+            elif re.fullmatch(r'[0-9a-fA-F]{32}', line) and entry.name.endswith(CHECKSUM_EXTENSIONS):
+                checksums[os.path.splitext(entry.name)[0]] = line.lower()
+    return checksums
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function open_integrity_ledger / save_integrity_ledger : Loads / writes the ledger of the files checked.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def open_integrity_ledger(ledger_path):
+    '''
+    Loads the ledger saved in ledger_path : {'version', 'files': path -> {'size', 'mtime', 'md5', 'gzip_complete'}}.
+    An empty ledger is returned if the file does not exist, cannot be read or was written with another format.
+
+    ledger_path: Path to the JSON ledger file.
+    '''
+    empty_ledger = {'version': LEDGER_VERSION, 'files': {}}
+
+    if not os.path.isfile(ledger_path):
+        return empty_ledger
+
+    try:
+        with open(ledger_path, 'r') as file:
+            ledger = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"WARNING: The FastQ integrity ledger {ledger_path} cannot be read, the FastQ files will be checked again ({e}).")
+        return empty_ledger
+
+    if ledger.get('version') != LEDGER_VERSION:
+        return empty_ledger
+
+    return ledger
+
+def save_integrity_ledger(ledger, ledger_path):
+    '''
+    Writes the ledger in a temporary file then renames it, so that an interrupted run never leaves a truncated ledger.
+
+    ledger: Ledger dictionary (as returned by open_integrity_ledger).
+    ledger_path: Path to the JSON ledger file.
+    '''
+    ledger_dir = os.path.dirname(ledger_path)
+    if ledger_dir and not os.path.exists(ledger_dir):
+        os.makedirs(ledger_dir)
+
+    tmp_path = f"{ledger_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(ledger, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, ledger_path)
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function verify_fastq_integrity : Checks the FastQ files of the plates, only reading the new ones.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def verify_fastq_integrity(plate_fastq, plates_list, ledger_path, processes=None):
+    '''
+    Checks the gzip stream of the FastQ files of the plates and compares their MD5 checksum with the checksum files of the
+    sequencer (in the directory of the file or in its parent directory). Only the files that are not in the ledger with the
+    same size and modification time are read, in a process pool. The ledger is saved even if a file is corrupted.
+    Returns {'files': number of files checked, 'read': number of files read, 'compared': number of files compared with
+    a checksum of the sequencer}. Raises FlashPipeError listing all the corrupted files.
+
+    plate_fastq: Dictionary plate -> FastQ files (as returned by resolve_fastq_files).
+    plates_list: Plates to check.
+    ledger_path: Path to the JSON ledger file (kept in the raw data directory of the experiment).
+    processes: Maximum number of processes (default: one per file to read, limited to the number of CPUs).
+    '''
+    ledger = open_integrity_ledger(ledger_path)
+    errors = []
+
+    # The files are stat again : the catalog does not see a file rewritten in a directory that did not change
+    sources = []
+    for plate in plates_list:
+        for fastq in plate_fastq[plate]['sources']:
+            try:
+                stat = os.stat(fastq['path'])
+            except OSError as e:
+                errors.append(f"{fastq['path']} : cannot be read ({e})")
+                continue
+            sources.append({'path': fastq['path'], 'size': stat.st_size, 'mtime': stat.st_mtime_ns})
+
+    # Files new or modified since the last check
+    to_read = []
+    for fastq in sources:
+        entry = ledger['files'].get(fastq['path'])
+        if entry is None or entry['size'] != fastq['size'] or entry['mtime'] != fastq['mtime']:
+            to_read.append(fastq)
+
+    if to_read:
+        if processes is None:
+            processes = min(len(to_read), os.cpu_count() or 1)
+        if processes <= 1 or len(to_read) == 1:
+            results = []
+            for fastq in to_read:
+                try:
+                    results.append(verify_fastq_file(fastq['path']))
+                except OSError as e:
+                    results.append(e)
+        else:
+            with ProcessPoolExecutor(max_workers=processes) as executor:
+                futures = [executor.submit(verify_fastq_file, fastq['path']) for fastq in to_read]
+                results = [future.exception() or future.result() for future in futures]
+
+        for fastq, result in zip(to_read, results):
+            # A file that cannot be read is not recorded : it is read again at the next staging
+            if isinstance(result, BaseException):
+                errors.append(f"{fastq['path']} : cannot be read ({result})")
+                continue
+            ledger['files'][fastq['path']] = {'size': fastq['size'], 'mtime': fastq['mtime'], **result}
+        save_integrity_ledger(ledger, ledger_path)
+
+    # The checksums of the sequencer are compared at each run (a checksum file can be added after the FastQ files)
+    checksum_dirs = {}
+    compared = 0
+    for fastq in sources:
+        entry = ledger['files'].get(fastq['path'])
+        if entry is None:
+            continue
+        if not entry['gzip_complete']:
+            errors.append(f"{fastq['path']} : truncated or corrupted gzip stream")
+            continue
+
+        file_dir = os.path.dirname(fastq['path'])
+        expected = None
+        for dir_path in (file_dir, os.path.dirname(file_dir)):
+            if dir_path not in checksum_dirs:
+                checksum_dirs[dir_path] = read_sequencer_checksums(dir_path)
+            expected = checksum_dirs[dir_path].get(os.path.relpath(fastq['path'], dir_path))
+            if expected is not None:
+                break
+        if expected is None:
+            continue
+        compared += 1
+        if expected != entry['md5']:
+            errors.append(f"{fastq['path']} : MD5 checksum {entry['md5']} differs from the checksum of the sequencer {expected}")
+
+    if errors:
+        raise FlashPipeError("ERROR: The following FastQ files are not complete or are corrupted, "
+                             "copy them again from the sequencer :\n" + "\n".join(errors))
+
+    return {'files': len(sources), 'read': len(to_read), 'compared': compared}
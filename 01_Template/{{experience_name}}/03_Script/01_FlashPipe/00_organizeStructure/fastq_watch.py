@@ -0,0 +1,318 @@
+import json
+import os
+import sys
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+from create_folder_structure_function import FlashPipeError, link_file, open_file_yml, resolve_fastq_files, verify_parameters
+from merge_fastq_lanes import merge_fastq_lanes
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Watch mode of the FastQ files (fastq_watch in the config file) : the structure can be generated while the sequencing
+# run is still being demultiplexed. A plate is ready as soon as its R1 and R2 files (all lanes) are complete : not modified
+# since stable_seconds and ending with a complete gzip member (the CRC and size of the gzip trailer are checked).
+# The FastQ files of a ready plate are then linked (or their lanes merged) under a fixed name
+# (00_RawData/00_RNA/{plate}_R1.fastq.gz / _R2) and a readiness marker ({plate}_ready.json) is written. The zUMIs and
+# TRUST4 jobs of the plate depend on the marker : the first plates are analysed while the next ones are still written.
+# The structure generation marks the plates already complete, the fastq_ready rule of the workflow waits for the others.
+# 1. Function gzip_trailer_ok : Checks that a gzip file ends with a complete member.
+# 2. Function plate_status : Checks if the FastQ files of a plate are complete.
+# 3. Function publish_plate : Links (or merges) the FastQ files of a ready plate and writes its readiness marker.
+# 4. Function mark_ready_plates : Marks all the plates that are complete (one pass, no wait).
+# 5. Function wait_for_plate : Waits until a plate is complete, by polling the FastQ directory.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Time (seconds) without modification after which a FastQ file is considered as written
+STABLE_SECONDS = 120
+# Time (seconds) between two scans of the FastQ directory, and maximum wait of a plate (hours)
+POLL_INTERVAL = 60
+WAIT_TIMEOUT_HOURS = 48
+# Name of the readiness marker of a plate (in the FastQ directory of the experiment, 00_RawData/00_RNA)
+MARKER_NAME = "{plate_name}_ready.json"
+# End of file block of the BGZF files (blocked gzip) : a complete file always ends with it
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+# Header of a gzip member (magic number and deflate method)
+GZIP_MEMBER_HEADER = b"\x1f\x8b\x08"
+# Size of the end of the file in which the last gzip member is searched
+TAIL_SIZE = 4 * 1024 * 1024
+# Size of the blocks read when the whole file has to be decompressed (last member larger than TAIL_SIZE)
+BUFFER_SIZE = 1024 * 1024
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function gzip_trailer_ok : Checks that a gzip file ends with a complete member.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def members_complete(blocks):
+    '''
+    Returns True if the compressed data is a sequence of complete gzip members (each one decompressed up to its trailer,
+    whose CRC and size are checked by zlib). The decompressed data is not kept.
+
+    blocks: Iterable of blocks of compressed data, starting at the header of a member.
+    '''
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    try:
+        for data in blocks:
+            while data:
+                # Start of the next member (concatenated lanes, BGZF blocks)
+                if decompressor.eof:
+                    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+                decompressor.decompress(data)
+                data = decompressor.unused_data if decompressor.eof else b''
+    except zlib.error:
+        return False
+    return decompressor.eof
+
+def gzip_trailer_ok(file_path, tail_size=TAIL_SIZE):
+    '''
+    Returns True if the gzip file ends with a complete member. A BGZF file is complete when it ends with the BGZF end of
+    file block. Otherwise the last member is searched in the last tail_size bytes and decompressed up to its trailer;
+    the whole file is only decompressed when its last member is larger than tail_size (file written in a single member).
+
+    file_path: Path to the gzip file.
+    tail_size: Size of the end of the file read.
+    '''
+    size = os.path.getsize(file_path)
+    with open(file_path, 'rb') as file:
+        file.seek(max(0, size - tail_size))
+        tail = file.read()
+    if tail.endswith(BGZF_EOF):
+        return True
+
+    # The first header found may be bytes of a compressed block : the next ones are tried
+    position = tail.find(GZIP_MEMBER_HEADER)
+    while position != -1:
+        if members_complete([tail[position:]]):
+            return True
+        position = tail.find(GZIP_MEMBER_HEADER, position + 1)
+    if size <= tail_size:
+        return False
+    with open(file_path, 'rb') as file:
+        return members_complete(iter(lambda: file.read(BUFFER_SIZE), b''))
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function plate_status : Checks if the FastQ files of a plate are complete.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def describe_sources(lanes):
+    '''
+    Returns the list of [path, size, mtime] of the FastQ files of a plate (all lanes, R1 then R2), read again on disk
+    (the sizes kept in the FastQ catalog are the ones of the last scan of their directory).
+
+    lanes: Dictionary read type (R1/R2) -> lane -> path of the FastQ file (see resolve_fastq_files).
+    '''
+    sources = []
+    for read_type in ("R1", "R2"):
+        for lane in sorted(lanes[read_type]):
+            stat = os.stat(lanes[read_type][lane])
+            sources.append([lanes[read_type][lane], stat.st_size, stat.st_mtime_ns])
+    return sources
+
+def file_status(source, stable_seconds, now):
+    '''
+    Returns None if a FastQ file is complete, or the reason why it is not.
+
+    source: [path, size, mtime] of the file (see describe_sources).
+    stable_seconds: Time without modification after which the file is considered as written.
+    now: Current time (seconds).
+    '''
+    path, size, mtime = source
+    if now - mtime / 1e9 < stable_seconds:
+        return f"{os.path.basename(path)} is being written"
+    if not gzip_trailer_ok(path):
+        return f"{os.path.basename(path)} does not end with a complete gzip member"
+    return None
+
+def plate_status(lanes, stable_seconds=STABLE_SECONDS):
+    '''
+    Checks if the FastQ files of a plate are complete : R1 and R2 on the same lanes, each file not modified since
+    stable_seconds and ending with a complete gzip member (files checked in parallel).
+    Returns the sources of the plate (see describe_sources) and None if the plate is ready, or the reason why it is not.
+
+    lanes: Dictionary read type (R1/R2) -> lane -> path of the FastQ file (see resolve_fastq_files).
+    stable_seconds: Time without modification after which a file is considered as written.
+    '''
+    if not lanes['R1'] or not lanes['R2']:
+        return [], "R1 or R2 files missing"
+    if sorted(lanes['R1']) != sorted(lanes['R2']):
+        return [], f"R1 and R2 files not on the same lanes yet (R1: {sorted(lanes['R1'])}, R2: {sorted(lanes['R2'])})"
+
+    sources = describe_sources(lanes)
+    now = time.time()
+    with ThreadPoolExecutor(max_workers=len(sources)) as executor:
+        reasons = [reason for reason in executor.map(lambda source: file_status(source, stable_seconds, now), sources) if reason]
+    return sources, (reasons[0] if reasons else None)
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function publish_plate : Links the FastQ files of a ready plate and writes its readiness marker.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def marker_path(output_dir, plate_name):
+    '''
+    Returns the path to the readiness marker of a plate.
+
+    output_dir: FastQ directory of the experiment (00_RawData/00_RNA).
+    plate_name: Name of the plate.
+    '''
+    return os.path.join(output_dir, MARKER_NAME.format(plate_name=plate_name))
+
+def is_marker_current(output_dir, plate_name, lanes):
+    '''
+    Returns True if the readiness marker of the plate exists and was written for the current FastQ files (same paths,
+    sizes and modification times) : the files of the plate are not checked again.
+
+    output_dir: FastQ directory of the experiment (00_RawData/00_RNA).
+    plate_name: Name of the plate.
+    lanes: Dictionary read type (R1/R2) -> lane -> path of the FastQ file.
+    '''
+    try:
+        with open(marker_path(output_dir, plate_name), 'r') as file:
+            marker = json.load(file)
+        return marker.get('sources') == describe_sources(lanes)
+    except (OSError, ValueError):
+        return False
+
+def is_plate_pending(output_dir, plate_name, lanes, stable_seconds=STABLE_SECONDS):
+    '''
+    Returns True if the FastQ files of a plate are still being written, without reading them (used to plan the resources
+    of the plate before mark_ready_plates) : no current readiness marker, and R1 or R2 missing, not on the same lanes or
+    modified since less than stable_seconds.
+
+    output_dir: FastQ directory of the experiment (00_RawData/00_RNA).
+    plate_name: Name of the plate.
+    lanes: Dictionary read type (R1/R2) -> lane -> path of the FastQ file.
+    stable_seconds: Time without modification after which a file is considered as written.
+    '''
+    if not lanes['R1'] or not lanes['R2'] or sorted(lanes['R1']) != sorted(lanes['R2']):
+        return True
+    if is_marker_current(output_dir, plate_name, lanes):
+        return False
+    now = time.time()
+    return any(now - mtime / 1e9 < stable_seconds for _, _, mtime in describe_sources(lanes))
+
+def publish_plate(plate_name, plate_fastq, sources, output_dir, merge_lanes=True):
+    '''
+    Links the R1 and R2 files of a ready plate under the paths used by the workflow (read1 and read2), or merges their
+    lanes in these files, then writes the readiness marker of the plate (written last : the marker means that the files
+    are in place). Raises a FlashPipeError if the plate has several lanes and the lanes merge is disabled.
+
+    plate_name: Name of the plate.
+    plate_fastq: Entry of the plate returned by resolve_fastq_files (watch mode).
+    sources: Sources of the plate (see describe_sources).
+    output_dir: FastQ directory of the experiment (00_RawData/00_RNA).
+    merge_lanes: If False, a plate with several lanes is an error.
+    '''
+    lanes = plate_fastq['lanes']
+    if len(lanes['R1']) > 1 and not merge_lanes:
+        raise FlashPipeError(f"ERROR : '{plate_name}' plate was sequenced on several lanes ({', '.join(sorted(lanes['R1']))}) and the lanes merge is disabled.")
+
+    for read_type, read_key in (('R1', 'read1'), ('R2', 'read2')):
+        lane_files = [lanes[read_type][lane] for lane in sorted(lanes[read_type])]
+        if len(lane_files) == 1:
+            link_file(lane_files[0], plate_fastq[read_key])
+        else:
+            # A link left by a previous run with a single lane is replaced by the merged file
+            if os.path.islink(plate_fastq[read_key]):
+                os.remove(plate_fastq[read_key])
+            merge_fastq_lanes(lane_files, plate_fastq[read_key])
+
+    marker = {
+        'plate_name': plate_name,
+        'read1': plate_fastq['read1'],
+        'read2': plate_fastq['read2'],
+        'sources': sources,
+        'ready_at': time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+    path = marker_path(output_dir, plate_name)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(marker, file, indent=1)
+    os.replace(tmp_path, path)
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function mark_ready_plates : Marks all the plates that are complete.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def mark_ready_plates(plate_fastq, plates_list, output_dir, merge_lanes=True, stable_seconds=STABLE_SECONDS):
+    '''
+    Checks the FastQ files of each plate once (no wait) and publishes the plates that are complete (see publish_plate).
+    A plate whose marker was written for the same files is not checked again.
+    Returns a dictionary plate -> None if the plate is ready, or the reason why it is not.
+
+    plate_fastq: Dictionary returned by resolve_fastq_files (watch mode).
+    plates_list: Plates to check.
+    output_dir: FastQ directory of the experiment (00_RawData/00_RNA).
+    merge_lanes: If False, a plate with several lanes is an error.
+    stable_seconds: Time without modification after which a file is considered as written.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    statuses = {}
+    for plate in plates_list:
+        lanes = plate_fastq[plate]['lanes']
+        if lanes['R1'] and lanes['R2'] and is_marker_current(output_dir, plate, lanes):
+            statuses[plate] = None
+            continue
+        sources, reason = plate_status(lanes, stable_seconds)
+        if reason is None:
+            publish_plate(plate, plate_fastq[plate], sources, output_dir, merge_lanes)
+        statuses[plate] = reason
+    return statuses
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 5. Function wait_for_plate : Waits until a plate is complete.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def wait_for_plate(experience_path, plate_name, interval=POLL_INTERVAL, timeout_hours=WAIT_TIMEOUT_HOURS, stable_seconds=STABLE_SECONDS):
+    '''
+    Waits until the FastQ files of a plate are complete, then publishes the plate (see publish_plate). The FastQ
+    directory of the config file is scanned every interval seconds : with the FastQ catalog of the experiment, only the
+    directories modified since the staging are listed again (the catalog is not saved, several plates wait at the same time).
+    Raises a FlashPipeError if the plate is not complete after timeout_hours.
+
+    experience_path: Path to the experiment directory.
+    plate_name: Name of the plate.
+    interval: Time (seconds) between two scans.
+    timeout_hours: Maximum wait (hours).
+    stable_seconds: Time without modification after which a file is considered as written.
+    '''
+    experience_path = os.path.abspath(experience_path)
+    config = open_file_yml(os.path.join(experience_path, '01_Reference/config_FlashPipe.yml'))
+    merge_lanes = verify_parameters(config.get("merge_lanes", True), "merge_lanes") == "TRUE"
+    output_dir = os.path.join(experience_path, '00_RawData/00_RNA')
+    catalog_path = os.path.join(experience_path, '00_RawData/fastq_catalog.json')
+
+    deadline = time.monotonic() + timeout_hours * 3600
+    previous_reason = None
+    while True:
+        _, plate_fastq = resolve_fastq_files(config.get("fastq_directories"), output_dir, [plate_name],
+                                             catalog_path=catalog_path, merge_lanes=merge_lanes, watch=True)
+        reason = mark_ready_plates(plate_fastq, [plate_name], output_dir, merge_lanes, stable_seconds)[plate_name]
+        if reason is None:
+            print(f"Plate {plate_name} : ready.")
+            return
+        if reason != previous_reason:
+            print(f"Plate {plate_name} : waiting, {reason}.")
+            previous_reason = reason
+        if time.monotonic() > deadline:
+            raise FlashPipeError(f"ERROR : The FastQ files of '{plate_name}' plate are not complete after {timeout_hours} hours ({reason}).")
+        time.sleep(interval)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog -w EXPERIENCE_DIR -p PLATE [-i INTERVAL] [--timeout HOURS] [-s STABLE_SECONDS]")
+    parser.add_option("-w", "--working_dir", dest="working_dir", help="Experiment directory", metavar="EXPERIENCE_DIR")
+    parser.add_option("-p", "--plate_name", dest="plate_name", help="Name of the plate to wait for", metavar="PLATE")
+    parser.add_option("-i", "--interval", dest="interval", type="int", default=POLL_INTERVAL,
+                      help=f"Time between two scans of the FastQ directory, in seconds (default: {POLL_INTERVAL})", metavar="INTERVAL")
+    parser.add_option("--timeout", dest="timeout", type="float", default=WAIT_TIMEOUT_HOURS,
+                      help=f"Maximum wait, in hours (default: {WAIT_TIMEOUT_HOURS})", metavar="HOURS")
+    parser.add_option("-s", "--stable_seconds", dest="stable_seconds", type="int", default=STABLE_SECONDS,
+                      help=f"Time without modification after which a FastQ file is considered as written (default: {STABLE_SECONDS})", metavar="STABLE_SECONDS")
+    (options, args) = parser.parse_args()
+
+    if not options.working_dir or not options.plate_name:
+        print("Error: You must provide the experiment directory and the plate name.")
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        wait_for_plate(options.working_dir, options.plate_name, interval=options.interval, timeout_hours=options.timeout,
+                       stable_seconds=options.stable_seconds)
+    except FlashPipeError as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,813 @@
+import os
+import subprocess
+import time
+from concurrent.futures import ThreadPoolExecutor
+from render_template import TemplateRenderer, write_file_if_changed
+from staging_area import staged_template
+from copy_engine import index_plate_files
+from staging_manifest import describe_file, describe_tree, open_manifest, save_manifest, plan_actions, update_manifest
+from fastq_catalog import save_fastq_catalog
+from staging_profiler import StagingProfiler
+from resource_planner import plan_resources, RESOURCE_KEYS
+from index_sort_table import write_index_sort_table
+from gsf_metadata_table import can_read_gsf, write_gsf_metadata_table
+from fastq_watch import is_plate_pending, marker_path, mark_ready_plates
+from fastq_integrity import verify_fastq_integrity
+from container_store import ContainerStore, default_store_path
+from config_schema import validate_config, FORBIDDEN_SEPARATORS
+from create_folder_structure_function import FlashPipeError, open_file_yml, verify_empty_values_config_file, verify_separator_in_config_file, verify_file_exist, replace_value_config_template_copier, verify_parameters, resolve_fastq_files, link_fastq_files, verify_method, verify_number_parameter, copy_index_sort, copy_gsf, airrflow_parameter, generate_airrflow_samplesheet, read_table
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# 1. Class FlashPipeProject : Generates the structure of one experiment (one method per step of the staging) :
+#    1.1 Retrieves the paths required for the project (existing and the one who will be created).
+#    1.2 Loads and reads the configuration file created by the user (Config_FlashPipe), and checks all its keys and paths
+#        in a single pass (see config_schema.py).
+#    1.3 Retrieves plate names and FastQ files to iterate over each plate and each read1 and read2,
+#        and plans the threads/memory/runtime of the jobs of each plate from the size of its FastQ files (see resource_planner.py).
+#    1.4 Selects reference files according to species defined in config.
+#    1.5 Creates a dictionary with the values from the config file for the copier.yml file.
+#    1.6 Renders the template (in-process, or with Copier) to create the necessary directories and files,
+#        and links the containers from the store shared by the experiments (see container_store.py).
+#    1.7 Copy Index Sorting and GSF files, and builds the Index Sorting table of all the plates read by the QC (see index_sort_table.py)
+#        and the table of the metadata of the GSF (see gsf_metadata_table.py).
+#    1.8 Calls the function to generate the file containing the analysis information for Airrflow.
+#    1.9 Check if every file is correctly copied/created or not.
+#    Each step is measured by the profiler when enabled (--profile : wall time, files, bytes read/written, system calls).
+#    1.10 Records the actions run in the staging manifest, to be able to plan (and apply) only the actions
+#         required when the config or the inputs change (see staging_manifest.py).
+# 2. Function stage_experiments : Generates the structure of several experiments at the same time,
+#    with a single load of the template, and returns one result per experiment (no exit on failure).
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# •••••••••••••••••
+### Keys of the user config file (config_FlashPipe.yml)
+EXPERIENCE_NAME_FILE = "experience_name"
+PLATE_NAMES_FILE = "plate_names"
+GSF_FILE = "gsf_file"
+FASTQ_DIRECORIES_FILE = "fastq_directories"
+INDEX_SORT_FILE = "index_sort"
+NOT_FLUORESCENT = "not_fluorescent"
+SPECIES_FILE = "species"
+STAR_INDEX_FILE = "star_index"
+GTF_FILE = "gtf_file"
+OUTDIR_TEMP_FILE = "outdir_temp"
+TRUST4_IMGT_BCR_TCR = "trust4_imgt_BCR_TCR"
+TRUST4_IMGT_VDJ = "trust4_imgt_VDJ"
+METHOD = "method_analysis"
+INDEXSORT = "index_sort_analysis"
+BCR = "bcr_repertoire_analysis"
+TCR = "tcr_repertoire_analysis"
+METADATA = "metadata_analysis"
+TOOLS_BCR_TCR_ANALYSIS = "tools_bcr_tcr_analysis"
+MERGE_LANES = "merge_lanes"
+PREFLIGHT_READS = "preflight_reads"
+PREFLIGHT_MIN_BARCODE_HIT_RATE = "preflight_min_barcode_hit_rate"
+PLATE_MAX_THREADS = "plate_max_threads"
+PLATE_MAX_MEM_MB = "plate_max_mem_mb"
+TRUST4_SHARDS = "trust4_shards"
+ZUMIS_KEEP_BAM = "zumis_keep_bam"
+FASTQ_WATCH = "fastq_watch"
+FASTQ_INTEGRITY = "fastq_integrity"
+# •••••••••••••••••
+
+# Default values of the expert parameters (config files created before these options do not contain them)
+DEFAULT_PREFLIGHT_READS = 10000
+DEFAULT_PREFLIGHT_MIN_BARCODE_HIT_RATE = 0.5
+DEFAULT_PLATE_MAX_THREADS = 32
+DEFAULT_PLATE_MAX_MEM_MB = 128000
+DEFAULT_TRUST4_SHARDS = 1
+# The reads of a well are never split between shards : at most one shard per well of a 96 wells plate
+MAX_TRUST4_SHARDS = 96
+
+# Engines available to render the template
+RENDERERS = ["native", "copier"]
+# Modes of staging : everything, only print the actions required, only run the actions required, only check the config file
+MODES = ["stage", "plan", "apply", "check"]
+# Config keys used by the Airrflow samplesheet
+SAMPLESHEET_KEYS = [PLATE_NAMES_FILE, SPECIES_FILE, METHOD, BCR, TCR]
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Class FlashPipeProject : Generates the structure of one experiment.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+class FlashPipeProject:
+    '''
+    Structure of one FlashPipe experiment (PROJECT_NAME/EXPERIMENT_NAME).
+    stage() runs all the steps; each step is also available as a method and stores its results as attributes.
+    The functions raise FlashPipeError when the config file or the input files are not correct.
+
+    experience_path: Path to the experiment directory (containing 01_Reference/config_FlashPipe.yml).
+    template_path: Path to the template directory (01_Template).
+    project_name: Name of the project (default: name of the parent directory of experience_path).
+    experience_name: Name of the experiment (default: name of experience_path).
+    renderer: Engine used to render the template : native (in-process) or copier (copier copy subprocess).
+    staging_dir: Directory in which the private copy of the template is created for the copier renderer.
+    template_renderer: TemplateRenderer already loaded, shared between several experiments (native renderer).
+    profiler: StagingProfiler measuring the phases of the staging (default: disabled).
+    container_store: Path to the container store shared by the experiments (default: see default_store_path).
+    '''
+
+    def __init__(self, experience_path, template_path, project_name=None, experience_name=None,
+                 renderer="native", staging_dir=None, template_renderer=None, profiler=None, container_store=None):
+        if renderer not in RENDERERS:
+            raise FlashPipeError(f"ERROR: Unknown renderer {renderer}, please choose one of : {', '.join(RENDERERS)}.")
+
+        # ## 1.1 Retrieves the paths for the project
+        self.experience_path = os.path.normpath(os.path.abspath(experience_path))
+        self.template_path = os.path.abspath(template_path)
+        self.project_name = project_name or os.path.basename(os.path.dirname(self.experience_path))
+        self.experience_name = experience_name or os.path.basename(self.experience_path)
+        self.renderer = renderer
+        self.staging_dir = staging_dir
+        self.template_renderer = template_renderer
+        self.profiler = profiler or StagingProfiler(enabled=False)
+        self.container_store = ContainerStore(container_store or default_store_path(self.template_path))
+
+        self.path_container_template = os.path.join(self.template_path, "{{experience_name}}/02_Container/")
+        self.path_project_flash_pipe = os.path.dirname(self.experience_path)
+        self.path_rawdata = os.path.join(self.experience_path, '00_RawData/')
+        self.path_reference = os.path.join(self.experience_path, '01_Reference/')
+        self.path_container = os.path.join(self.experience_path, '02_Container/')
+        self.path_workflow = os.path.join(self.experience_path, '04_Workflow/')
+        self.path_snakemake = os.path.join(self.path_workflow, '01_snakemake/')
+        self.path_output = os.path.join(self.experience_path, '05_Output/')
+        self.path_rna = os.path.join(self.path_rawdata, '00_RNA/')
+        self.path_index_sorting = os.path.join(self.path_rawdata, '01_IndexSort/')
+        self.path_index_sort_table = os.path.join(self.path_index_sorting, 'indexsort_table.tsv')
+        self.path_index_sort_schema = os.path.join(self.path_index_sorting, 'indexsort_schema.json')
+        self.path_fastq_catalog = os.path.join(self.path_rawdata, 'fastq_catalog.json')
+        self.path_fastq_integrity = os.path.join(self.path_rawdata, 'fastq_integrity.json')
+        self.path_manifest = os.path.join(self.path_reference, 'staging_manifest.json')
+        self.path_experiment_reference = os.path.join(self.path_reference, '00_Experiment/')
+        self.path_gsf_table = os.path.join(self.path_experiment_reference, 'gsf_metadata.tsv')
+        self.path_gsf_schema = os.path.join(self.path_experiment_reference, 'gsf_metadata_schema.json')
+        self.path_zumis_reference = os.path.join(self.path_reference, '01_zUMIs/')
+        self.path_airrflow_reference = os.path.join(self.path_reference, '02_airrflow/')
+        self.path_output_flashpipe = os.path.join(self.path_output, '01_FlashPipe/')
+        self.path_output_zumis = os.path.join(self.path_output_flashpipe, '01_zUMIs/')
+        self.path_output_airrflow = os.path.join(self.path_output_flashpipe, '02_airrflow/')
+        self.path_output_trust4 = os.path.join(self.path_output_flashpipe, '02_trust4/')
+        self.path_output_qc = os.path.join(self.path_output_flashpipe, '03_QC/')
+        self.path_output_analysis = os.path.join(self.path_output_flashpipe, '04_Analysis/')
+        self.file_config_flashpipe_path = os.path.join(self.path_reference, 'config_FlashPipe.yml')
+        self.path_profile = os.path.join(self.path_output_flashpipe, '00_Staging/staging_profile.json')
+
+        # Define the exact position of barcode and ERCC file for analysis (more precisely : zUMIs)
+        self.ercc_path = os.path.join(self.path_experiment_reference, 'ERCC_concentration.csv')
+        self.barcode_well_path = os.path.join(self.path_experiment_reference, 'cell_barcode_well.csv')
+        # Define a barcode path (without well ID) for zUMIs (this file is created by render()).
+        self.barcode_path = os.path.join(self.path_experiment_reference, "cell_barcode.txt")
+        # Path to the .tsv file copied by the template and filled in by generate_samplesheet()
+        self.csv_airrflow_path = os.path.join(self.path_airrflow_reference, "assembled_samplesheet.tsv")
+
+    def log(self, message):
+        '''
+        Displays a message prefixed by the project and experiment names (several experiments can be staged at the same time).
+
+        message: Message to display.
+        '''
+        print(f"[{self.project_name}/{self.experience_name}] {message}")
+
+    # ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.2 Loading the configuration file (config FlashPipe)
+    # ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    def load_config(self):
+        '''
+        Reads the user config file and checks all its keys (values, experiment name, paths of the inputs and of the references
+        of the species) in a single pass. Raises a FlashPipeError listing all the errors, with their line in the config file.
+        '''
+        self.log("Reading config file")
+
+        with self.profiler.phase("config_load") as record:
+            # Checks the existence of the file (i.e. checks that the project and experience names are correct)
+            verify_file_exist(self.file_config_flashpipe_path)
+            self.file_config_flashpipe = open_file_yml(self.file_config_flashpipe_path)
+            record['files'] = 1
+
+        with self.profiler.phase("config_validation") as record:
+            # The relative paths (IMGT files) are the files of the experiment, copied from the template
+            errors, warnings = validate_config(self.file_config_flashpipe_path, self.experience_path,
+                                               base_dirs=[self.experience_path, os.path.join(self.template_path, "{{experience_name}}")])
+            record.update(errors=len(errors), warnings=len(warnings))
+            for warning in warnings:
+                self.log(f"WARNING: {warning}")
+            if errors:
+                raise FlashPipeError("\n".join(f"ERROR: {error}" for error in errors) + f"\n{len(errors)} errors in the config file.")
+
+            # Set the values of the sections not used to FALSE (the config has been checked)
+            verify_empty_values_config_file(self.file_config_flashpipe)
+
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.3 Retrieves plate names and FastQ files to iterate over each plate and each read1 and read2.
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    def prepare_plates(self):
+        '''
+        Checks the analysis parameters, retrieves the plate names and the FastQ files of each plate (nothing is created, see link_fastq).
+        '''
+        config = self.file_config_flashpipe
+
+        with self.profiler.phase("parameters_validation"):
+            # Checking the separators in the various options in the config file.
+            verify_separator_in_config_file(config.get(PLATE_NAMES_FILE), FORBIDDEN_SEPARATORS)
+            verify_separator_in_config_file(config.get(NOT_FLUORESCENT), FORBIDDEN_SEPARATORS)
+
+            # Recovers plate names from configuration and cleans them up (deletes spaces).
+            self.plates_list = [plate.strip() for plate in config.get(PLATE_NAMES_FILE).split(',')]
+
+            # Check if the parameter are the type of True or False / Single-cell or Mini Bulk for the analysis
+            self.log("Parameters selection")
+            verify_method(config.get(METHOD), config.get(INDEXSORT))
+            self.indexsort = verify_parameters(config.get(INDEXSORT), INDEXSORT)
+            self.bcr = verify_parameters(config.get(BCR), BCR)
+            self.tcr = verify_parameters(config.get(TCR), TCR)
+            self.metadata = verify_parameters(config.get(METADATA), METADATA)
+            # Lanes merge is enabled by default (config files created before this option do not contain it)
+            self.merge_lanes = verify_parameters(config.get(MERGE_LANES, True), MERGE_LANES)
+            # Number of reads and barcode hit rate of the FastQ pre-flight check (preflight rule of the workflow)
+            self.preflight_reads = verify_number_parameter(config.get(PREFLIGHT_READS, DEFAULT_PREFLIGHT_READS), PREFLIGHT_READS,
+                                                           number_type=int, minimum=1)
+            self.preflight_min_barcode_hit_rate = verify_number_parameter(config.get(PREFLIGHT_MIN_BARCODE_HIT_RATE, DEFAULT_PREFLIGHT_MIN_BARCODE_HIT_RATE),
+                                                                          PREFLIGHT_MIN_BARCODE_HIT_RATE, minimum=0, maximum=1)
+            # Maximum threads and memory of the zUMIs and TRUST4 jobs of a plate (the jobs of the small plates use less)
+            self.plate_max_threads = verify_number_parameter(config.get(PLATE_MAX_THREADS, DEFAULT_PLATE_MAX_THREADS), PLATE_MAX_THREADS,
+                                                             number_type=int, minimum=1)
+            self.plate_max_mem_mb = verify_number_parameter(config.get(PLATE_MAX_MEM_MB, DEFAULT_PLATE_MAX_MEM_MB), PLATE_MAX_MEM_MB,
+                                                            number_type=int, minimum=1)
+            # Number of shards of the TRUST4 jobs of a plate (1 : one TRUST4 job on the whole plate)
+            self.trust4_shards = verify_number_parameter(config.get(TRUST4_SHARDS, DEFAULT_TRUST4_SHARDS), TRUST4_SHARDS,
+                                                         number_type=int, minimum=1, maximum=MAX_TRUST4_SHARDS)
+            # The BAM files of zUMIs are not kept by default (config files created before this option do not contain it)
+            self.zumis_keep_bam = verify_parameters(config.get(ZUMIS_KEEP_BAM, False), ZUMIS_KEEP_BAM)
+            # Watch mode of the FastQ files : the run can still be demultiplexed (see fastq_watch.py), disabled by default
+            self.fastq_watch = verify_parameters(config.get(FASTQ_WATCH, False), FASTQ_WATCH)
+            # Integrity check of the FastQ files before they are linked (see fastq_integrity.py), disabled by default
+            self.fastq_integrity = verify_parameters(config.get(FASTQ_INTEGRITY, False), FASTQ_INTEGRITY)
+
+            # Retrieve category data to be set aside for certain analysis data.
+            self.not_fluorescent_list = [categorial_term.strip() for categorial_term in config.get(NOT_FLUORESCENT).split(',')]
+
+        # Recover reads 1 and 2 from fastQ (the symbolic links are created by link_fastq).
+        # The fastq directory is indexed in a catalog kept in the raw data directory, so that the next runs only re-scan the modified directories.
+        with self.profiler.phase("fastq_scan") as record:
+            self.fastq_catalog, self.plate_fastq = resolve_fastq_files(config.get(FASTQ_DIRECORIES_FILE),
+                                                                       self.path_rna,
+                                                                       self.plates_list,
+                                                                       catalog_path=self.path_fastq_catalog,
+                                                                       merge_lanes=(self.merge_lanes == "TRUE"),
+                                                                       watch=(self.fastq_watch == "TRUE"))
+            record['directories'] = len(self.fastq_catalog['directories'])
+            record['files'] = sum(len(fastq['sources']) for fastq in self.plate_fastq.values())
+        self.fastq_files_read1 = [self.plate_fastq[plate]['read1'] for plate in self.plates_list]
+        self.fastq_files_read2 = [self.plate_fastq[plate]['read2'] for plate in self.plates_list]
+        # In watch mode, the sizes of the plates still being written are not known yet (see plan_resources)
+        self.pending_plates = []
+        if self.fastq_watch == "TRUE":
+            self.pending_plates = [plate for plate in self.plates_list if is_plate_pending(self.path_rna, plate, self.plate_fastq[plate]['lanes'])]
+
+        # Estimate the reads of each plate (the measures are kept in the FastQ catalog) and plan the resources of its jobs
+        with self.profiler.phase("resource_plan") as record:
+            self.plate_resources = plan_resources(self.plate_fastq, self.plates_list, self.plate_max_threads, self.plate_max_mem_mb,
+                                                  pending_plates=self.pending_plates)
+            record['plates'] = len(self.plate_resources)
+        for plate, resources in self.plate_resources.items():
+            self.log(f"Plate {plate} : ~{resources['reads']:,} reads, zUMIs {resources['zumis_threads']} threads / {resources['zumis_mem_mb']} MB, "
+                     f"TRUST4 {resources['trust4_threads']} threads / {resources['trust4_mem_mb']} MB")
+
+    def link_fastq(self, plates_list=None):
+        '''
+        Saves the FastQ catalog, checks the integrity of the FastQ files (if enabled), creates the symbolic links to the
+        FastQ files and merges the lanes of the plates.
+        In watch mode, only the plates whose FastQ files are complete are linked (with their readiness marker), the
+        fastq_ready rule of the workflow waits for the others.
+
+        plates_list: Plates to process (default: all the plates).
+        '''
+        plates = plates_list if plates_list is not None else self.plates_list
+        # In watch mode, the plates still being written are only checked by the fastq_ready rule (end of the gzip stream)
+        checked_plates = [plate for plate in plates if plate not in self.pending_plates]
+        if self.fastq_integrity == "TRUE" and checked_plates:
+            with self.profiler.phase("fastq_integrity") as record:
+                integrity = verify_fastq_integrity(self.plate_fastq, checked_plates, self.path_fastq_integrity)
+                record.update(integrity)
+            self.log(f"FastQ integrity : {integrity['files']} files complete ({integrity['read']} read, "
+                     f"{integrity['compared']} compared with the checksums of the sequencer)")
+
+        with self.profiler.phase("fastq_links") as record:
+            save_fastq_catalog(self.fastq_catalog, self.path_fastq_catalog)
+            if self.fastq_watch == "TRUE":
+                statuses = mark_ready_plates(self.plate_fastq, plates, self.path_rna, merge_lanes=(self.merge_lanes == "TRUE"))
+                for plate, reason in statuses.items():
+                    self.log(f"Plate {plate} : " + ("FastQ files ready" if reason is None else f"waiting for the FastQ files ({reason})"))
+                record['plates_ready'] = sum(reason is None for reason in statuses.values())
+            else:
+                link_fastq_files(self.plate_fastq, self.path_rna, plates_list=plates_list)
+            record['files'] = sum(len(self.plate_fastq[plate]['links']) for plate in plates)
+            record['merged_files'] = sum(len(self.plate_fastq[plate]['merge_jobs']) for plate in plates)
+
+    # ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.4 Selects reference files according to species defined in config.
+    # ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    def select_references(self):
+        '''
+        Selects the reference files (STAR index, GTF, TRUST4 IMGT files) of the species, and the Airrflow clonal parameter.
+        '''
+        config = self.file_config_flashpipe
+        self.species = config.get(SPECIES_FILE)
+        self.star_index = config.get(STAR_INDEX_FILE).get(self.species)
+        self.gtf_file = config.get(GTF_FILE).get(self.species)
+        self.trust4_imgt_BCR_TCR = config.get(TRUST4_IMGT_BCR_TCR).get(self.species)
+        self.trust4_imgt_VDJ = config.get(TRUST4_IMGT_VDJ).get(self.species)
+        self.gsf_file_path = os.path.join(self.path_experiment_reference, os.path.basename(config.get(GSF_FILE)))
+
+        # Select the parameter for the analysis for Airrflow
+        self.clonal_parameter_airrflow = airrflow_parameter(config)
+
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.5 Creates a dictionary with the values from the config file for the copier.yml file
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    def template_values(self):
+        '''
+        Returns the values replacing the default values of the template config file (copier.yml).
+        '''
+        config = self.file_config_flashpipe
+        return {
+            'experience_name': config.get(EXPERIENCE_NAME_FILE),
+            'barcode_file' : self.barcode_path,
+            'fastq_files_read1': ','.join(self.fastq_files_read1),
+            'fastq_files_read2': ','.join(self.fastq_files_read2),
+            'gtf_file': self.gtf_file,
+            'trust4_imgt_VDJ' : self.trust4_imgt_VDJ,
+            'trust4_imgt_BCR_TCR' : self.trust4_imgt_BCR_TCR,
+            'plate_names': ','.join(self.plates_list),
+            'star_index': self.star_index,
+            'gsf_file': self.gsf_file_path,
+            'index_sort': config.get(INDEX_SORT_FILE),
+            'species': self.species,
+            'ercc_concentration_file': self.ercc_path,
+            'outdir_temp' : config.get(OUTDIR_TEMP_FILE),
+            'project_name' : self.project_name,
+            'template_path' : self.template_path,
+            'path_project' : self.path_project_flash_pipe,
+            'not_fluorescent' : ','.join(self.not_fluorescent_list),
+            'method_analysis' : config.get(METHOD),
+            'index_sort_analysis' : self.indexsort,
+            'bcr_repertoire_analysis' : self.bcr,
+            'tcr_repertoire_analysis' : self.tcr,
+            'metadata_analysis' : self.metadata,
+            'airrflow_or_trust4' : config.get(TOOLS_BCR_TCR_ANALYSIS),
+            'path_output_airrflow' : self.path_output_airrflow,
+            'clonal_parameter_airrflow' : self.clonal_parameter_airrflow,
+            'preflight_reads' : self.preflight_reads,
+            'preflight_min_barcode_hit_rate' : self.preflight_min_barcode_hit_rate,
+            'trust4_shards' : self.trust4_shards,
+            'zumis_keep_bam' : self.zumis_keep_bam,
+            'fastq_watch' : self.fastq_watch,
+            # Estimated reads of each plate, kept with the resources for the runtime history (see runtime_history.py)
+            'plate_reads' : ','.join(str(self.plate_resources[plate]['reads']) for plate in self.plates_list),
+            # One comma separated list per resource, in the order of plate_names (example: zumis_threads: "4,12")
+            **{key: ','.join(str(self.plate_resources[plate][key]) for plate in self.plates_list) for key in RESOURCE_KEYS}
+        }
+
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.6 Renders the template to create the necessary directories and files.
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    def render(self):
+        '''
+        Renders the template in the project directory, links the containers and creates the barcode file for zUMIs.
+        The files produced are kept in self.rendered_files (for the manifest; not known with the copier renderer).
+        '''
+        values_config_flashpipe = self.template_values()
+        self.rendered_files = []
+
+        self.log("Create directories and files structure, might take few minutes...")
+        with self.profiler.phase("template_render") as record:
+            if self.renderer == "copier":
+                # Copy the template in a staging directory private to this run, to allow the modification of copier.yml
+                # without conflict between runs launched in parallel. The directory is deleted at the end, even if the run fails.
+                with staged_template(self.template_path, staging_dir=self.staging_dir) as staged_template_path:
+                    # Define the path to the template config file and replace the values with the custom ones
+                    file_copier_template_yml = os.path.join(staged_template_path, 'copier.yml')
+                    replace_value_config_template_copier(file_copier_template_yml, values_config_flashpipe)
+
+                    # Create the Copier command and launch it (its exit code and error output are kept in the profile trace)
+                    cmd = f'copier copy -f {staged_template_path} {self.path_project_flash_pipe}'
+                    copier_process = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+                    self.profiler.record_subprocess("copier", cmd, copier_process)
+                    record['returncode'] = copier_process.returncode
+                    if copier_process.returncode != 0:
+                        raise FlashPipeError(f"ERROR: Copier failed (exit code {copier_process.returncode}) :\n{copier_process.stderr.strip()}")
+            else:
+                # Render the template (loaded once, and shared between the experiments of a batch) with the values of the config file.
+                # Files whose content did not change are not rewritten.
+                # The Airrflow samplesheet is filled in later (generate_samplesheet) from the template file, so it is not overwritten once generated.
+                if self.template_renderer is None:
+                    self.template_renderer = TemplateRenderer(self.template_path)
+                render_stats = self.template_renderer.render(self.path_project_flash_pipe, values_config_flashpipe,
+                                                             preserve=[os.path.join(values_config_flashpipe['experience_name'], "01_Reference/02_airrflow/assembled_samplesheet.tsv")])
+                self.log(f"Template rendered : {render_stats['written']} files written, {render_stats['unchanged']} files unchanged.")
+                # The samplesheet is recorded by its own action (its content is generated after the rendering)
+                self.rendered_files = [os.path.join(self.path_project_flash_pipe, file_path) for file_path in render_stats['files']
+                                       if os.path.join(self.path_project_flash_pipe, file_path) != self.csv_airrflow_path]
+                record['files'] = len(render_stats['files'])
+                record['files_written'] = render_stats['written']
+
+        with self.profiler.phase("container_link") as record:
+            # Link the Container that was forbidden to import (in the template) into the project, from the shared store :
+            # the images are only copied in the store the first time (or when the template changes), never in the experiment.
+            report = self.container_store.link_containers(self.path_container_template, self.path_container)
+            self.container_links = report['links']
+            record.update(files=report['files'], files_linked=report['files_linked'], files_hashed=report['files_hashed'],
+                          bytes_copied=report['bytes_copied'])
+        if report['bytes_copied']:
+            self.log(f"Containers added to the store {self.container_store.store_path} ({report['bytes_copied'] / 1024 ** 2:.1f} MB copied).")
+
+        with self.profiler.phase("barcode_file") as record:
+            # Create a file barcode (without well ID) for zUMIs (only rewritten if the barcodes changed).
+            _, barcode_well = read_table(self.barcode_well_path)
+            barcodes = ''.join(f"{row['BarcodeSequence']}\n" for row in barcode_well)
+            record['files_written'] = int(write_file_if_changed(self.barcode_path, barcodes.encode('utf-8')))
+            self.rendered_files.append(self.barcode_path)
+
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.7 Copy Index Sorting files and gsf files.
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    def copy_inputs(self):
+        '''
+        Copies the Index Sorting files (if supplied) and the GSF file in the experiment.
+        '''
+        self.copy_index_sort_files()
+        self.build_index_sort_table()
+        self.copy_gsf_file()
+        self.build_gsf_table()
+
+    def copy_index_sort_files(self, plates_list=None):
+        '''
+        Copies the Index Sorting files of the plates (if supplied in the config file).
+
+        plates_list: Plates to process (default: all the plates).
+        '''
+        config = self.file_config_flashpipe
+
+        # Copy Index Sorting files (if not FALSE, which means that the section has been filled (and not empty))
+        if config.get(INDEX_SORT_FILE) != "FALSE":
+            with self.profiler.phase("index_sort_copy") as record:
+                report = copy_index_sort(config.get(INDEX_SORT_FILE), self.path_index_sorting, plates_list=plates_list or self.plates_list)
+                record.update(files=report['files_copied'], files_skipped=report['files_skipped'], bytes_copied=report['bytes_copied'])
+
+    def build_index_sort_table(self):
+        '''
+        Builds the table of the Index Sorting data of all the plates (copied files) and its schema, read by the QC
+        instead of the file of each plate (if Index Sorting files are supplied in the config file).
+        '''
+        if self.file_config_flashpipe.get(INDEX_SORT_FILE) == "FALSE":
+            return
+        with self.profiler.phase("index_sort_table") as record:
+            plate_files = [(plate, os.path.join(self.path_index_sorting, f"{plate}_indexsort.csv")) for plate in self.plates_list]
+            schema = write_index_sort_table(plate_files, self.not_fluorescent_list, self.path_index_sort_table, self.path_index_sort_schema)
+            record.update(plates=len(plate_files), rows=schema['rows'], columns=len(schema['columns']))
+        for plate, plate_schema in schema['plates'].items():
+            if plate_schema['skipped']:
+                self.log(f"Index Sorting : the file of the plate {plate} is empty, the plate is skipped.")
+            elif plate_schema['dropped_wells'] or plate_schema['missing_columns']:
+                self.log(f"Index Sorting : plate {plate}, {len(plate_schema['dropped_wells'])} wells without data removed, "
+                         f"columns added : {', '.join(plate_schema['missing_columns']) or 'none'}.")
+
+    def copy_gsf_file(self):
+        '''
+        Copies the GSF file in the experiment.
+        '''
+        with self.profiler.phase("gsf_copy") as record:
+            report = copy_gsf(self.file_config_flashpipe.get(GSF_FILE), self.path_experiment_reference)
+            record.update(files=report['files_copied'], files_skipped=report['files_skipped'], bytes_copied=report['bytes_copied'])
+
+    def build_gsf_table(self):
+        '''
+        Builds the table of the metadata sheets of the plates of the GSF (copied file) and its schema, read by the QC
+        instead of the Excel file (if the metadata analysis is enabled). Without openpyxl (or for a GSF not in the xlsx
+        format), the table is removed and the QC reads the Excel file.
+        '''
+        if self.metadata != "TRUE":
+            return
+        if not can_read_gsf(self.gsf_file_path):
+            self.log("WARNING: openpyxl is not installed or the GSF is not a .xlsx file, the QC will read the metadata from the GSF file.")
+            for file_path in (self.path_gsf_table, self.path_gsf_schema):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            return
+        with self.profiler.phase("gsf_table") as record:
+            try:
+                schema, parsed = write_gsf_metadata_table(self.gsf_file_path, self.plates_list, self.path_gsf_table, self.path_gsf_schema)
+            except ValueError as e:
+                raise FlashPipeError(str(e))
+            record.update(plates=len(schema['plates']), rows=schema['rows'], files_skipped=int(not parsed))
+        for warning in schema['warnings']:
+            self.log(f"WARNING: {warning}")
+
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.8 Calls the function to generate the file containing the analysis information for Airrflow.
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    def generate_samplesheet(self):
+        '''
+        Fills in the Airrflow samplesheet (copied by the template) with one line per plate.
+        '''
+        with self.profiler.phase("samplesheet") as record:
+            generate_airrflow_samplesheet(path_airrflow_reference=self.csv_airrflow_path, plates_list=self.plates_list,
+                                          fastq_files_read1=self.fastq_files_read1, fastq_files_read2=self.fastq_files_read2,
+                                          species=self.species, file_config_flashpipe=self.file_config_flashpipe)
+            record['files'] = 1
+
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.9 Check if every file is correctly copied/created.
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    def verify(self):
+        '''
+        Checks that the files required by the workflow exist.
+        '''
+        required_files = [
+            self.ercc_path,
+            self.barcode_well_path,
+            self.barcode_path,
+            os.path.join(self.experience_path, '03_Script/01_FlashPipe/03_QC/analysisParams.R'),
+            os.path.join(self.experience_path, '03_Script/01_FlashPipe/projectParams.R'),
+            os.path.join(self.path_experiment_reference, os.path.basename(self.file_config_flashpipe.get(GSF_FILE))),
+            os.path.join(self.path_workflow, '01_snakemake/snakefile.yaml'),
+            self.csv_airrflow_path
+        ]
+        with self.profiler.phase("verification") as record:
+            for file_path in required_files:
+                verify_file_exist(file_path)
+            record['files'] = len(required_files)
+
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    # ## 1.10 Records the actions in the staging manifest, plans and applies the actions required.
+    # •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+    def describe_actions(self):
+        '''
+        Returns the actions of the staging for the current config : action name -> {'config': values of the config keys
+        it depends on, 'inputs': description of its inputs}. The FastQ files are described by their size and modification
+        time only (too big to be hashed at each run).
+        '''
+        config = self.file_config_flashpipe
+        actions = {}
+
+        for plate in self.plates_list:
+            actions[f"fastq:{plate}"] = {
+                'config': {key: config.get(key) for key in (FASTQ_DIRECORIES_FILE, MERGE_LANES, FASTQ_WATCH, FASTQ_INTEGRITY)},
+                'inputs': sorted([fastq['path'], fastq['size'], fastq['mtime']] for fastq in self.plate_fastq[plate]['sources'])
+            }
+            # In watch mode, a plate still being written is checked again at the next run
+            if self.fastq_watch == "TRUE":
+                actions[f"fastq:{plate}"]['inputs'] = {'sources': actions[f"fastq:{plate}"]['inputs'], 'ready': plate not in self.pending_plates}
+
+        if config.get(INDEX_SORT_FILE) != "FALSE":
+            if not os.path.isdir(config.get(INDEX_SORT_FILE)):
+                raise FlashPipeError(f"ERROR: The Index Sorting directory {config.get(INDEX_SORT_FILE)} does not exist.")
+            self.index_sort_files = index_plate_files(config.get(INDEX_SORT_FILE))
+            for plate in self.plates_list:
+                actions[f"index_sort:{plate}"] = {
+                    'config': {INDEX_SORT_FILE: config.get(INDEX_SORT_FILE)},
+                    'inputs': [describe_file(file_path) for file_path in self.index_sort_files.get(plate, [])]
+                }
+
+            actions["index_sort_table"] = {
+                'config': {key: config.get(key) for key in (INDEX_SORT_FILE, NOT_FLUORESCENT, PLATE_NAMES_FILE)},
+                'inputs': [describe_file(file_path) for plate in self.plates_list for file_path in self.index_sort_files.get(plate, [])]
+            }
+
+        actions["gsf"] = {
+            'config': {GSF_FILE: config.get(GSF_FILE)},
+            'inputs': describe_file(config.get(GSF_FILE))
+        }
+        if self.metadata == "TRUE":
+            actions["gsf_table"] = {
+                'config': {key: config.get(key) for key in (GSF_FILE, METADATA, PLATE_NAMES_FILE)},
+                'inputs': {'gsf': describe_file(config.get(GSF_FILE)), 'reader': can_read_gsf(self.gsf_file_path)}
+            }
+        # Almost all the config keys are used by the template, and a change of the template itself is also detected.
+        actions["render"] = {
+            'config': {key: value for key, value in config.items()},
+            'inputs': {'values': self.template_values(), 'template': describe_tree(self.template_path), 'renderer': self.renderer}
+        }
+        actions["samplesheet"] = {
+            'config': {key: config.get(key) for key in SAMPLESHEET_KEYS},
+            'inputs': {'read1': self.fastq_files_read1, 'read2': self.fastq_files_read2}
+        }
+        return actions
+
+    def action_outputs(self, name):
+        '''
+        Returns the list of (file_path, source) produced or linked by an action that has been run.
+
+        name: Name of the action (see describe_actions).
+        '''
+        kind, _, plate = name.partition(':')
+        if kind == "fastq" and self.fastq_watch == "TRUE":
+            return [(file_path, None) for file_path in (self.plate_fastq[plate]['read1'], self.plate_fastq[plate]['read2'],
+                                                         marker_path(self.path_rna, plate)) if os.path.lexists(file_path)]
+        if kind == "fastq":
+            return [(link_path, file_path) for file_path, link_path in self.plate_fastq[plate]['links']] + \
+                [(merged_path, None) for _, merged_path in self.plate_fastq[plate]['merge_jobs']]
+        if kind == "index_sort":
+            return [(os.path.join(self.path_index_sorting, os.path.basename(file_path)), file_path) for file_path in self.index_sort_files.get(plate, [])]
+        if kind == "index_sort_table":
+            return [(self.path_index_sort_table, None), (self.path_index_sort_schema, None)]
+        if kind == "gsf":
+            return [(self.gsf_file_path, self.file_config_flashpipe.get(GSF_FILE))]
+        if kind == "gsf_table":
+            return [(file_path, None) for file_path in (self.path_gsf_table, self.path_gsf_schema) if os.path.exists(file_path)]
+        if kind == "render":
+            return [(file_path, None) for file_path in self.rendered_files] + self.container_links
+        if kind == "samplesheet":
+            return [(self.csv_airrflow_path, None)]
+        return []
+
+    def resolve(self):
+        '''
+        Reads and checks the config, and retrieves the plates, FastQ files and references, without creating anything.
+        Returns the actions of the staging (see describe_actions).
+        '''
+        self.load_config()
+        self.prepare_plates()
+        self.select_references()
+        return self.describe_actions()
+
+    def plan(self):
+        '''
+        Compares the current config and inputs with the staging manifest of the last run, without modifying anything.
+        Returns the list of (action, reason) to run and the list of the recorded actions not required anymore.
+        '''
+        actions = self.resolve()
+        with self.profiler.phase("plan") as record:
+            planned, obsolete = plan_actions(open_manifest(self.path_manifest), actions)
+            record.update(actions=len(actions), actions_planned=len(planned))
+        self.actions = actions
+        return planned, obsolete
+
+    def save_manifest(self, outputs):
+        '''
+        Records the actions that have been run in the staging manifest.
+
+        outputs: Dictionary action name -> list of (file_path, source) produced by the action.
+        '''
+        with self.profiler.phase("manifest") as record:
+            manifest = update_manifest(open_manifest(self.path_manifest), self.actions, outputs)
+            save_manifest(manifest, self.path_manifest)
+            record['files'] = sum(len(files) for files in outputs.values())
+
+    def apply(self):
+        '''
+        Runs only the actions required since the last run (see plan), then checks the structure and updates the manifest.
+        Returns the list of (action, reason) that have been run. Raises FlashPipeError on failure.
+        '''
+        planned, obsolete = self.plan()
+        planned_names = [name for name, _ in planned]
+        for name in obsolete:
+            self.log(f"Not required anymore : {name} (its files are kept)")
+
+        # The samplesheet is generated from the file copied by the template
+        if "samplesheet" in planned_names and "render" not in planned_names and not os.path.exists(self.csv_airrflow_path):
+            planned.append(("render", "required by samplesheet"))
+            planned_names.append("render")
+
+        fastq_plates = [name.partition(':')[2] for name in planned_names if name.startswith("fastq:")]
+        index_sort_plates = [name.partition(':')[2] for name in planned_names if name.startswith("index_sort:")]
+
+        # The catalog is saved at each run (cheap), so that the next runs only re-scan the modified directories
+        self.link_fastq(plates_list=fastq_plates)
+        if "render" in planned_names:
+            self.render()
+        if index_sort_plates:
+            self.copy_index_sort_files(plates_list=index_sort_plates)
+        if "index_sort_table" in planned_names:
+            self.build_index_sort_table()
+        if "gsf" in planned_names:
+            self.copy_gsf_file()
+        if "gsf_table" in planned_names:
+            self.build_gsf_table()
+        if "samplesheet" in planned_names:
+            self.generate_samplesheet()
+        self.verify()
+
+        self.save_manifest({name: self.action_outputs(name) for name in planned_names})
+        self.log(f"Success : {len(planned_names)} of {len(self.actions)} actions run, the project structure is up to date.")
+        return planned
+
+    def check(self):
+        '''
+        Only checks the config file (see load_config), without scanning the FastQ files nor creating anything.
+        '''
+        self.load_config()
+        self.log("Success : The config file is correct.")
+
+    def stage(self):
+        '''
+        Runs all the steps generating the structure of the experiment, and records them in the manifest. Raises FlashPipeError on failure.
+        '''
+        self.actions = self.resolve()
+        self.link_fastq()
+        self.render()
+        self.copy_inputs()
+        self.generate_samplesheet()
+        self.verify()
+        self.save_manifest({name: self.action_outputs(name) for name in self.actions})
+        self.log("Success : The project structure is now in place.")
+
+    def write_profile(self, mode, success, error=None):
+        '''
+        Writes the profile trace of the staging (if the profiler is enabled) in 05_Output/01_FlashPipe/00_Staging/staging_profile.json.
+
+        mode: Mode of the staging (stage, plan or apply).
+        success: True if the staging succeeded.
+        error: Error message (if it failed).
+        '''
+        # The trace is not written in a directory that does not exist (wrong experiment path)
+        if not self.profiler.enabled or not os.path.isdir(self.experience_path):
+            return
+        try:
+            self.profiler.write(self.path_profile, project_name=self.project_name, experience_name=self.experience_name,
+                                experience_path=self.experience_path, renderer=self.renderer, mode=mode, success=success, error=error)
+        except OSError as e:
+            self.log(f"WARNING: The profile trace cannot be written in {self.path_profile} ({e}).")
+            return
+        self.log(f"Profile trace written in {self.path_profile}")
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function stage_experiments : Generates the structure of several experiments at the same time.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def stage_experiment(project, mode="stage"):
+    '''
+    Stages one experiment and returns its result instead of raising the error.
+    Returns a dictionary : experience_path, project_name, experience_name, success, error (message or None), duration (seconds),
+    actions (list of (action, reason) planned or run, for the plan and apply modes).
+
+    project: FlashPipeProject to stage.
+    mode: stage (all the steps), plan (only lists the actions required), apply (only runs the actions required) or check (only
+          checks the config file).
+    '''
+    start = time.monotonic()
+    error = None
+    actions = None
+    try:
+        if mode == "plan":
+            actions, _ = project.plan()
+        elif mode == "check":
+            project.check()
+        elif mode == "apply":
+            actions = project.apply()
+        else:
+            project.stage()
+    except FlashPipeError as e:
+        error = str(e)
+    except Exception as e:
+        # Unexpected error (missing file, permission...) : reported for this experiment only, the others go on.
+        error = f"{type(e).__name__}: {e}"
+    if error:
+        project.log(error)
+    project.write_profile(mode, error is None, error)
+
+    return {
+        'experience_path': project.experience_path,
+        'project_name': project.project_name,
+        'experience_name': project.experience_name,
+        'success': error is None,
+        'error': error,
+        'duration': round(time.monotonic() - start, 3),
+        'actions': actions
+    }
+
+def stage_experiments(experience_paths, template_path, jobs=None, renderer="native", staging_dir=None, mode="stage", profile=False,
+                      container_store=None):
+    '''
+    Generates the structure of several experiments, in a pool of threads.
+    The template is loaded once (native renderer) and shared by all the experiments.
+    A failing experiment does not stop the others.
+    Returns the list of results (see stage_experiment), in the order of experience_paths.
+
+    experience_paths: List of experiment directories (PROJECT_NAME/EXPERIMENT_NAME).
+    template_path: Path to the template directory (01_Template).
+    jobs: Maximum number of experiments staged at the same time (default: one per experiment, limited to the number of CPUs).
+    renderer: Engine used to render the template : native (in-process) or copier (copier copy subprocess).
+    staging_dir: Directory in which the private copy of the template is created for the copier renderer.
+    mode: stage (all the steps), plan (only lists the actions required), apply (only runs the actions required) or check (only
+          checks the config file).
+    profile: If True, a profile trace of the phases is written in each experiment.
+    container_store: Path to the container store shared by the experiments (default: see default_store_path).
+    '''
+    if not experience_paths:
+        return []
+
+    # The template is not needed to plan the actions (only its files are described)
+    template_renderer = TemplateRenderer(os.path.abspath(template_path)) if renderer == "native" and mode not in ("plan", "check") else None
+    projects = [FlashPipeProject(experience_path, template_path, renderer=renderer, staging_dir=staging_dir,
+                                 template_renderer=template_renderer, profiler=StagingProfiler(enabled=profile),
+                                 container_store=container_store)
+                for experience_path in experience_paths]
+
+    if jobs is None:
+        jobs = min(len(projects), os.cpu_count() or 1)
+
+    if jobs <= 1 or len(projects) == 1:
+        return [stage_experiment(project, mode) for project in projects]
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(stage_experiment, projects, [mode] * len(projects)))
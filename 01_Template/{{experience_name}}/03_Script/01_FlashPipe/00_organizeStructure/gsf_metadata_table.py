@@ -0,0 +1,240 @@
+import csv
+import datetime
+import io
+import json
+import os
+from copy_engine import file_digest
+from render_template import write_file_if_changed
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Extracts, at the staging, the metadata of the wells of each plate from the GSF file (one sheet per plate) in a single
+# typed table, read by the QC report (01_prepareData.R, 02_formatCountTable.R, 08_displayMetaData.R) instead of the
+# Excel file. The GSF is read once, with the streaming (read-only) reader of openpyxl, and only read again when its
+# content changes (SHA-256 of the workbook kept in the schema). The errors of the GSF are reported at the staging.
+# openpyxl is optional : without it, no table is written and the QC reads the Excel file, as before.
+# 1. Function read_gsf_workbook : Reads the plate sheets and the General Info sheet of the GSF.
+# 2. Function check_gsf_sheets : Checks the sheets of the plates (same checks as 01_prepareData.R before).
+# 3. Function write_gsf_metadata_table : Writes the table (typed values) and its schema, if the GSF changed.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Sheet of the GSF listing the plates of the run
+GENERAL_INFO_SHEET = "General Info"
+# Columns of the table (same names as COLUMN_HEADER_WELL_ID / COLUMN_HEADER_PLATE_NAME of analysisParams.R)
+COLUMN_WELL_ID = "WellID"
+COLUMN_PLATE_NAME = "Plate_Name"
+# Formats of the GSF read by openpyxl (the other formats, as .xls, are still read by the QC with read_excel)
+SUPPORTED_EXTENSIONS = (".xlsx", ".xlsm")
+# Types of the columns, with the class used by R to read them (colClasses)
+NUMERIC = "numeric"
+LOGICAL = "logical"
+CHARACTER = "character"
+
+def is_openpyxl_available():
+    '''
+    Returns True if openpyxl (reader of the Excel files) can be imported.
+    '''
+    try:
+        import openpyxl  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+def can_read_gsf(gsf_path):
+    '''
+    Returns True if the table can be built from the GSF file (openpyxl installed and format supported).
+
+    gsf_path: Path to the GSF file.
+    '''
+    return gsf_path.lower().endswith(SUPPORTED_EXTENSIONS) and is_openpyxl_available()
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function read_gsf_workbook : Reads the plate sheets and the General Info sheet of the GSF.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def read_sheet(worksheet):
+    '''
+    Reads a sheet as read_excel : the first non-empty row gives the column names (an empty name becomes "...N"),
+    the empty rows are ignored and the empty columns at the end are removed.
+    Returns the column names and the rows (lists of values, None for an empty cell). Returns ([], []) for an empty sheet.
+
+    worksheet: Sheet of the workbook (read-only mode).
+    '''
+    header = None
+    rows = []
+    for values in worksheet.iter_rows(values_only=True):
+        values = [None if isinstance(value, str) and not value.strip() else value for value in values]
+        if not any(value is not None for value in values):
+            continue
+        if header is None:
+            header = values
+        else:
+            rows.append(values)
+    if header is None:
+        return [], []
+
+    width = max([position + 1 for position, value in enumerate(header) if value is not None]
+                + [position + 1 for row in rows for position, value in enumerate(row) if value is not None])
+    columns = [str(value).strip() if value is not None else f"...{position + 1}" for position, value in enumerate(header[:width])]
+    columns += [f"...{position + 1}" for position in range(len(columns), width)]
+    rows = [(list(row[:width]) + [None] * (width - len(row))) for row in rows]
+    return columns, rows
+
+def read_gsf_workbook(gsf_path, plates_list):
+    '''
+    Reads the GSF file with the streaming reader of openpyxl. Returns the names of the sheets, the values of the
+    General Info sheet (set of the cell values, as text) and a dictionary plate -> (columns, rows) of the plates
+    having a sheet.
+
+    gsf_path: Path to the GSF file (.xlsx).
+    plates_list: Names of the plates (plate_names of the config file).
+    '''
+    import openpyxl
+
+    workbook = openpyxl.load_workbook(gsf_path, read_only=True, data_only=True)
+    try:
+        sheet_names = workbook.sheetnames
+        general_info = set()
+        if GENERAL_INFO_SHEET in sheet_names:
+            for values in workbook[GENERAL_INFO_SHEET].iter_rows(values_only=True):
+                general_info.update(str(value).strip() for value in values if value is not None)
+        plates = {plate: read_sheet(workbook[plate]) for plate in plates_list if plate in sheet_names}
+    finally:
+        workbook.close()
+    return sheet_names, general_info, plates
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function check_gsf_sheets : Checks the sheets of the plates.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def check_gsf_sheets(sheet_names, general_info, plates, plates_list):
+    '''
+    Checks the GSF sheets of the plates, as 01_prepareData.R did at each report. Returns the list of errors (no General Info
+    sheet, plate without sheet, sheet with a column not in the sheet of the previous plate, sheet without WellID column) and
+    the list of warnings (plate not listed in the General Info sheet, empty sheet).
+
+    sheet_names: Names of the sheets of the GSF.
+    general_info: Values of the General Info sheet.
+    plates: Dictionary plate -> (columns, rows) (see read_gsf_workbook).
+    plates_list: Names of the plates (plate_names of the config file).
+    '''
+    errors = []
+    warnings = []
+    reference_plate = None
+    if GENERAL_INFO_SHEET not in sheet_names:
+        errors.append(f"The GSF has no '{GENERAL_INFO_SHEET}' sheet.")
+    for plate in plates_list:
+        if GENERAL_INFO_SHEET in sheet_names and plate not in general_info:
+            warnings.append(f"The plate {plate} given in the config file doesn't match the one given in the '{GENERAL_INFO_SHEET}' tab of the GSF.")
+        if plate not in sheet_names:
+            errors.append(f"The plate {plate} given in the config file does not match the GSF sheets ({', '.join(sheet_names)}).")
+            continue
+        columns, _ = plates[plate]
+        if not columns:
+            warnings.append(f"The metadata sheet of the plate {plate} is empty, the plate is skipped by the metadata analysis.")
+            continue
+        if reference_plate is not None and not set(columns) <= set(plates[reference_plate][0]):
+            errors.append(f"The columns of the GSF sheets {reference_plate} and {plate} are different, correct the column names between them.")
+        reference_plate = plate
+        if COLUMN_WELL_ID not in columns:
+            errors.append(f"The sheet of the plate {plate} has no {COLUMN_WELL_ID} column.")
+    return errors, warnings
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function write_gsf_metadata_table : Writes the table and its schema, if the GSF changed.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def value_type(value):
+    '''
+    Returns the type of a cell value (NUMERIC, LOGICAL or CHARACTER), None for an empty cell.
+
+    value: Value of the cell read by openpyxl.
+    '''
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return LOGICAL
+    if isinstance(value, (int, float)):
+        return NUMERIC
+    return CHARACTER
+
+def format_value(value, column_type):
+    '''
+    Returns the text written in the table for a value (empty for an empty cell, read as NA by R).
+
+    value: Value of the cell read by openpyxl.
+    column_type: Type of the column.
+    '''
+    if value is None:
+        return ""
+    if column_type == LOGICAL:
+        return "TRUE" if value else "FALSE"
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat(sep=" ") if isinstance(value, datetime.datetime) else value.isoformat()
+    if isinstance(value, float) and column_type == NUMERIC:
+        return repr(value)
+    return str(value)
+
+def write_gsf_metadata_table(gsf_path, plates_list, table_path, schema_path):
+    '''
+    Extracts the metadata sheets of the plates of the GSF in a table (tab separated, one line per well, the columns of
+    the sheets then Plate_Name) and its schema (JSON : SHA-256 of the GSF, type of each column, and for each plate
+    the number of wells or if it is skipped). Nothing is read again when the schema was written for the same GSF content
+    and the same plates. Raises a ValueError listing the errors of the GSF (see check_gsf_sheets).
+    Returns the schema and True if the GSF was read (False if the table was up to date).
+
+    gsf_path: Path to the GSF file (.xlsx).
+    plates_list: Names of the plates (plate_names of the config file).
+    table_path: Path to the table.
+    schema_path: Path to the schema.
+    '''
+    digest = file_digest(gsf_path)
+    try:
+        with open(schema_path, 'r') as file:
+            schema = json.load(file)
+        if schema.get('sha256') == digest and schema.get('plate_names') == list(plates_list) and os.path.isfile(table_path):
+            return schema, False
+    except (OSError, ValueError):
+        pass
+
+    sheet_names, general_info, plates = read_gsf_workbook(gsf_path, plates_list)
+    errors, warnings = check_gsf_sheets(sheet_names, general_info, plates, plates_list)
+    if errors:
+        raise ValueError("\n".join(f"ERROR in the GSF file {gsf_path} : {error}" for error in errors))
+
+    columns = []
+    types = {}
+    for columns_plate, rows in plates.values():
+        columns += [column for column in columns_plate if column not in columns]
+        for position, column in enumerate(columns_plate):
+            for row in rows:
+                row_type = value_type(row[position])
+                if row_type is not None and types.get(column) != CHARACTER:
+                    types[column] = row_type if types.get(column) in (None, row_type) else CHARACTER
+    # Columns without any value are read as logical by read_excel
+    types = {column: types.get(column, LOGICAL) for column in columns}
+
+    output = io.StringIO()
+    writer = csv.writer(output, delimiter="\t", lineterminator="\n")
+    writer.writerow(columns + [COLUMN_PLATE_NAME])
+    schema_plates = {}
+    rows_count = 0
+    for plate in plates_list:
+        columns_plate, rows = plates.get(plate, ([], []))
+        schema_plates[plate] = {'skipped': not columns_plate, 'wells': len(rows)}
+        positions = {column: position for position, column in enumerate(columns_plate)}
+        for row in rows:
+            writer.writerow([format_value(row[positions[column]], types[column]) if column in positions else "" for column in columns] + [plate])
+        rows_count += len(rows)
+
+    types[COLUMN_PLATE_NAME] = CHARACTER
+    schema = {
+        'gsf_file': os.path.abspath(gsf_path),
+        'sha256': digest,
+        'plate_names': list(plates_list),
+        'table': os.path.basename(table_path),
+        'rows': rows_count,
+        'columns': [{'name': column, 'type': types[column]} for column in columns + [COLUMN_PLATE_NAME]],
+        'plates': schema_plates,
+        'warnings': warnings
+    }
+    write_file_if_changed(table_path, output.getvalue().encode('utf-8'))
+    write_file_if_changed(schema_path, (json.dumps(schema, indent=2) + "\n").encode('utf-8'))
+    return schema, True
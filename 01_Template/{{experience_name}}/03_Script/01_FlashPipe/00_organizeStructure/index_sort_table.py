@@ -0,0 +1,203 @@
+import csv
+import io
+import json
+import os
+import re
+from render_template import write_file_if_changed
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Builds, at the staging, a single table with the Index Sorting (FACS) data of all the plates, read by the QC report
+# (07_computeIndexSort.R) in a single read instead of reading and aligning the file of each plate at each report.
+# 1. Function read_index_sort_file : Reads the file of a plate (separator detected once, values stripped).
+# 2. Function infer_column_types : Gives the type (numeric or character) of each column, on all the plates.
+# 3. Function normalize_index_sort : Aligns the plates on the union of their columns and removes the wells without data.
+# 4. Function write_index_sort_table : Writes the table (typed values, R column names) and its schema.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Columns of the table (same names as COLUMN_HEADER_WELL_ID / COLUMN_HEADER_PLATE_NAME of analysisParams.R)
+COLUMN_WELL_ID = "WellID"
+COLUMN_PLATE_NAME = "Plate_Name"
+# Values read as missing (as read.csv)
+MISSING_VALUES = {"", "NA"}
+# Types of the columns, with the class used by R to read them (colClasses)
+NUMERIC = "numeric"
+CHARACTER = "character"
+# Value of a numeric column missing in a plate (the QC filled the missing columns with 0)
+MISSING_COLUMN_NUMERIC_VALUE = "0"
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function read_index_sort_file : Reads the Index Sorting file of a plate.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def detect_separator(first_line):
+    '''
+    Returns the separator of an Index Sorting file : ";" if the header contains one, "," otherwise (as detect_sep_csv in R).
+
+    first_line: First line of the file.
+    '''
+    return ";" if ";" in first_line else ","
+
+def r_column_name(name):
+    '''
+    Returns the name given to a column by R when reading a table (make.names : the characters other than letters, digits,
+    "." and "_" are replaced by ".", and "X" is added before a name which does not start by a letter or a dot).
+
+    name: Name of the column in the file.
+    '''
+    r_name = re.sub(r"[^A-Za-z0-9._]", ".", name)
+    if not re.match(r"[A-Za-z]|\.(?![0-9])", r_name):
+        r_name = "X" + r_name
+    return r_name
+
+def read_index_sort_file(file_path):
+    '''
+    Reads the Index Sorting file of a plate. Returns the separator, the column names (R names) and the rows (one list
+    of stripped values per well). Returns None if the file is empty (plate skipped by the QC).
+
+    file_path: Path to the file ({plate}_indexsort.csv).
+    '''
+    with open(file_path, 'r', newline='', encoding='utf-8-sig', errors='replace') as file:
+        content = file.read()
+    if len(content.strip()) <= 1:
+        return None
+    separator = detect_separator(content.splitlines()[0])
+    reader = csv.reader(io.StringIO(content), delimiter=separator)
+    header = next(reader)
+    columns = [r_column_name(column.strip()) for column in header]
+    rows = []
+    for values in reader:
+        if not any(value.strip() for value in values):
+            continue
+        # Missing fields at the end of a line are empty (as read by R)
+        values = [value.strip() for value in values[:len(columns)]] + [""] * (len(columns) - len(values))
+        rows.append(values)
+    return separator, columns, rows
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function infer_column_types : Gives the type of each column on all the plates.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def is_number(value):
+    '''
+    Returns True if the value is read as a number by R (a missing value is accepted).
+
+    value: Stripped value of the file.
+    '''
+    if value in MISSING_VALUES:
+        return True
+    # Python also reads numbers with "_" between the digits, which are text for R
+    if "_" in value:
+        return False
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
+
+def infer_column_types(plates):
+    '''
+    Returns a dictionary column -> type (NUMERIC if all the values of the column are numbers on all the plates,
+    CHARACTER otherwise). The WellID column is always CHARACTER.
+
+    plates: Dictionary plate -> (separator, columns, rows) of the plates read (see read_index_sort_file).
+    '''
+    types = {}
+    for _, columns, rows in plates.values():
+        for position, column in enumerate(columns):
+            if types.get(column) == CHARACTER:
+                continue
+            numeric = column != COLUMN_WELL_ID and all(is_number(row[position]) for row in rows)
+            types[column] = NUMERIC if numeric else CHARACTER
+    return types
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function normalize_index_sort : Aligns the plates on the union of their columns and removes the empty wells.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def normalize_index_sort(plate_files, not_fluorescent):
+    '''
+    Reads the Index Sorting files of the plates and aligns them on the union of their columns (in the order of
+    appearance; a numeric column missing in a plate is filled with 0, a character column with empty values).
+    The wells without any measure (all the columns except WellID and the not_fluorescent columns missing) are removed.
+    Returns the columns of the table (WellID, measures, Plate_Name), their types, the rows and the schema of the table.
+
+    plate_files: List of (plate, file_path), in the order of the plates.
+    not_fluorescent: Names of the columns which are not fluorescence measures (not_fluorescent of the config file).
+    '''
+    plates = {}
+    schema_plates = {}
+    for plate, file_path in plate_files:
+        plate_table = read_index_sort_file(file_path)
+        schema_plates[plate] = {'file': os.path.basename(file_path), 'skipped': plate_table is None}
+        if plate_table is not None:
+            plates[plate] = plate_table
+
+    columns = []
+    for _, plate_columns, _ in plates.values():
+        columns += [column for column in plate_columns if column not in columns]
+    types = infer_column_types(plates)
+    # The well column is the first one, the plate column the last one (added by the QC before)
+    if COLUMN_WELL_ID in columns:
+        columns.remove(COLUMN_WELL_ID)
+        columns.insert(0, COLUMN_WELL_ID)
+    not_fluorescent_columns = {r_column_name(column) for column in not_fluorescent} | set(not_fluorescent)
+
+    rows = []
+    for plate, (separator, plate_columns, plate_rows) in plates.items():
+        positions = {column: position for position, column in enumerate(plate_columns)}
+        measure_positions = [position for column, position in positions.items()
+                             if column != COLUMN_WELL_ID and column not in not_fluorescent_columns]
+        well_position = positions.get(COLUMN_WELL_ID)
+        missing_columns = [column for column in columns if column not in positions]
+        defaults = {column: MISSING_COLUMN_NUMERIC_VALUE if types.get(column) == NUMERIC else "" for column in missing_columns}
+
+        dropped_wells = []
+        for values in plate_rows:
+            if all(values[position] in MISSING_VALUES for position in measure_positions):
+                dropped_wells.append(values[well_position] if well_position is not None else "")
+                continue
+            row = dict(defaults)
+            for column, position in positions.items():
+                value = values[position]
+                # The missing numbers are written empty (read as NA by R)
+                row[column] = "" if types[column] == NUMERIC and value in MISSING_VALUES else value
+            row[COLUMN_PLATE_NAME] = plate
+            rows.append(row)
+
+        schema_plates[plate].update(separator=separator, wells=len(plate_rows), wells_kept=len(plate_rows) - len(dropped_wells),
+                                    dropped_wells=dropped_wells, missing_columns=missing_columns)
+
+    columns.append(COLUMN_PLATE_NAME)
+    types[COLUMN_PLATE_NAME] = CHARACTER
+    schema = {
+        'columns': [{'name': column, 'type': types[column]} for column in columns],
+        'not_fluorescent': sorted(not_fluorescent_columns & set(columns)),
+        'plates': schema_plates
+    }
+    return columns, types, rows, schema
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function write_index_sort_table : Writes the table of all the plates and its schema.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def write_index_sort_table(plate_files, not_fluorescent, table_path, schema_path):
+    '''
+    Normalizes the Index Sorting files of the plates (see normalize_index_sort) and writes the table (tab separated,
+    one line per well, R column names) and its schema (JSON : type of each column, and for each plate the separator,
+    the wells removed and the columns added). The files are only rewritten if their content changed.
+    Returns the schema.
+
+    plate_files: List of (plate, file_path), in the order of the plates.
+    not_fluorescent: Names of the columns which are not fluorescence measures (not_fluorescent of the config file).
+    table_path: Path to the table.
+    schema_path: Path to the schema.
+    '''
+    columns, _, rows, schema = normalize_index_sort(plate_files, not_fluorescent)
+
+    output = io.StringIO()
+    writer = csv.DictWriter(output, fieldnames=columns, delimiter="\t", restval='', lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows)
+
+    schema['table'] = os.path.basename(table_path)
+    schema['rows'] = len(rows)
+    write_file_if_changed(table_path, output.getvalue().encode('utf-8'))
+    write_file_if_changed(schema_path, (json.dumps(schema, indent=2) + "\n").encode('utf-8'))
+    return schema
@@ -0,0 +1,89 @@
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# 1. Function is_merged_fastq_up_to_date : Checks if a merged FastQ file is still valid for its lane files.
+# 2. Function merge_fastq_lanes : Concatenates the gzip lane files of one plate read into a single file.
+# 3. Function merge_fastq_lanes_in_parallel : Runs the merge of all the plates in a process pool.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Size of the blocks read from the lane files (large sequential reads are better on NFS).
+COPY_BUFFER_SIZE = 16 * 1024 * 1024
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function is_merged_fastq_up_to_date : Checks if a merged FastQ file is still valid for its lanes.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def is_merged_fastq_up_to_date(lane_files, merged_path):
+    '''
+    Checks if the merged file already exists, has the size of all its lane files together and is more recent than all of them.
+
+    lane_files: List of the lane files paths (in the order of the merge).
+    merged_path: Path to the merged FastQ file.
+    '''
+    if not os.path.isfile(merged_path):
+        return False
+
+    merged_stat = os.stat(merged_path)
+    lane_stats = [os.stat(lane_file) for lane_file in lane_files]
+
+    return merged_stat.st_size == sum(stat.st_size for stat in lane_stats) and \
+        merged_stat.st_mtime_ns >= max(stat.st_mtime_ns for stat in lane_stats)
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function merge_fastq_lanes : Concatenates the gzip lane files of one plate read into one file.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def merge_fastq_lanes(lane_files, merged_path):
+    '''
+    Concatenates the lane files (.fastq.gz) of one read of a plate into merged_path.
+    A gzip file can contain several members, so the compressed blocks are copied as they are:
+    nothing is decompressed nor recompressed, and the result is read by zUMIs and TRUST4 as a single FastQ file.
+    Returns the path to the merged file.
+
+    lane_files: List of the lane files paths (in the order of the merge, the same for R1 and R2).
+    merged_path: Path to the merged FastQ file.
+    '''
+    if is_merged_fastq_up_to_date(lane_files, merged_path):
+        print(f"Skipped: Lanes already merged in : {merged_path}")
+        return merged_path
+
+    # Write in a temporary file, renamed at the end, so that a failed merge never leaves a truncated FastQ file.
+    tmp_path = f"{merged_path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, 'wb') as merged_file:
+            for lane_file in lane_files:
+                with open(lane_file, 'rb') as lane:
+                    shutil.copyfileobj(lane, merged_file, COPY_BUFFER_SIZE)
+        os.replace(tmp_path, merged_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+    print(f"Merged {len(lane_files)} lanes in : {merged_path}")
+    return merged_path
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function merge_fastq_lanes_in_parallel : Runs the merge of all the plates in a process pool.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def merge_fastq_lanes_in_parallel(merge_jobs, processes=None):
+    '''
+    Merges the lanes of several plates/reads at the same time.
+    Returns the list of merged file paths (in the order of merge_jobs).
+
+    merge_jobs: List of tuples (lane_files, merged_path), one for each plate and read.
+    processes: Maximum number of processes (default: one per job, limited to the number of CPUs).
+    '''
+    if not merge_jobs:
+        return []
+
+    if processes is None:
+        processes = min(len(merge_jobs), os.cpu_count() or 1)
+
+    # A single job is not worth starting a pool
+    if processes <= 1 or len(merge_jobs) == 1:
+        return [merge_fastq_lanes(lane_files, merged_path) for lane_files, merged_path in merge_jobs]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(merge_fastq_lanes, lane_files, merged_path) for lane_files, merged_path in merge_jobs]
+        return [future.result() for future in futures]
@@ -0,0 +1,205 @@
+import fnmatch
+import hashlib
+import os
+import re
+import yaml
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# 1. Function write_file_if_changed : Writes a file only if its content changed (keeps the modification time otherwise).
+# 2. Class TemplateRenderer : Loads the template once (files, Jinja templates and copier.yml default values)
+#    and renders it in a project directory, as "copier copy" does, without rewriting the unchanged files.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Files that are never rendered (same list as Copier), plus the containers copied separately.
+TEMPLATE_EXCLUDE = ["copier.yaml", "copier.yml", "~*", "*.py[co]", "__pycache__", ".git", ".DS_Store", ".svn", "02_Container"]
+# Suffix of the files whose content is a Jinja template (removed from the name of the rendered file)
+TEMPLATE_SUFFIX = ".jinja"
+# YAML loader written in C (libyaml), several times faster than the pure Python one, when PyYAML was built with it
+YAML_LOADER = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# Copier extension used in directory names to create one directory per element of a list.
+# Example : {% yield plate_name from plate_names.split(',') %}{{ plate_name }}{% endyield %}
+YIELD_PATTERN = re.compile(r'^(?P<prefix>.*?){%-?\s*yield\s+(?P<variable>\w+)\s+from\s+(?P<expression>.+?)\s*-?%}(?P<body>.*?){%-?\s*endyield\s*-?%}(?P<suffix>.*)$', re.DOTALL)
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function write_file_if_changed : Writes a file only if its content changed.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def write_file_if_changed(file_path, content, mode=None):
+    '''
+    Writes content (bytes) in file_path, unless the file already contains exactly the same content (compared by hash).
+    An unchanged file keeps its modification time, so that Snakemake does not rerun the jobs depending on it.
+    Returns True if the file has been written.
+
+    file_path: Path to the file to write.
+    content: Content of the file (bytes).
+    mode: Permissions to apply on the file (optional).
+    '''
+    if os.path.isfile(file_path) and os.path.getsize(file_path) == len(content):
+        with open(file_path, 'rb') as file:
+            unchanged = hashlib.sha256(file.read()).digest() == hashlib.sha256(content).digest()
+        if unchanged:
+            if mode is not None and (os.stat(file_path).st_mode & 0o7777) != mode:
+                os.chmod(file_path, mode)
+            return False
+
+    # Write in a temporary file then rename it, so that the file is never seen half written.
+    tmp_path = f"{file_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as file:
+        file.write(content)
+    if mode is not None:
+        os.chmod(tmp_path, mode)
+    os.replace(tmp_path, file_path)
+    return True
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Class TemplateRenderer : Loads the template once and renders it in a project directory.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+class TemplateRenderer:
+    '''
+    In-process replacement of "copier copy -f" for the FlashPipe template.
+    The template tree, the Jinja templates (*.jinja files and directory/file names) and the default values of copier.yml
+    are loaded once when the object is created; render() can then be called for any number of experiments.
+
+    template_path: Path to the template directory (containing copier.yml).
+    '''
+
+    def __init__(self, template_path):
+        self.template_path = template_path
+        # Imported here : Jinja is only needed by the native renderer (not by --plan or the copier renderer)
+        from jinja2.sandbox import SandboxedEnvironment
+        # Same Jinja options as Copier (sandboxed environment, trailing new lines kept)
+        self.environment = SandboxedEnvironment(keep_trailing_newline=True)
+        self.defaults = self.load_copier_defaults(os.path.join(template_path, 'copier.yml'))
+        self.tree = self.load_directory(template_path)
+
+    def load_copier_defaults(self, copier_path):
+        '''
+        Retrieves the default value of each question of copier.yml.
+
+        copier_path: Path to file copier.yml.
+        '''
+        if not os.path.isfile(copier_path):
+            return {}
+        with open(copier_path, 'r') as file:
+            questions = yaml.load(file, Loader=YAML_LOADER) or {}
+        return {key: value.get('default') for key, value in questions.items() if isinstance(value, dict)}
+
+    def is_excluded(self, name):
+        '''
+        Checks if a file or directory name matches one of the excluded patterns.
+
+        name: Name of the file or directory.
+        '''
+        return any(fnmatch.fnmatch(name, pattern) for pattern in TEMPLATE_EXCLUDE)
+
+    def load_directory(self, dir_path):
+        '''
+        Loads recursively a directory of the template.
+        Returns a list of entries (one per file or directory) with the compiled template of its name, and
+        for the files the compiled template of the content (*.jinja files) or the raw content.
+
+        dir_path: Path to the template directory to load.
+        '''
+        entries = []
+        with os.scandir(dir_path) as scanned:
+            for entry in sorted(scanned, key=lambda scanned_entry: scanned_entry.name):
+                if self.is_excluded(entry.name):
+                    continue
+
+                is_template = entry.is_file() and entry.name.endswith(TEMPLATE_SUFFIX)
+                name = entry.name[:-len(TEMPLATE_SUFFIX)] if is_template else entry.name
+                loaded = {'name': name, 'name_yield': YIELD_PATTERN.match(name)}
+                if not loaded['name_yield']:
+                    loaded['name_template'] = self.environment.from_string(name)
+
+                if entry.is_dir():
+                    loaded['children'] = self.load_directory(entry.path)
+                else:
+                    with open(entry.path, 'rb') as file:
+                        raw_content = file.read()
+                    loaded['mode'] = entry.stat().st_mode & 0o7777
+                    if is_template:
+                        loaded['template'] = self.environment.from_string(raw_content.decode('utf-8'))
+                    else:
+                        loaded['content'] = raw_content
+                entries.append(loaded)
+        return entries
+
+    def render_names(self, entry, context):
+        '''
+        Renders the name of a file or directory.
+        Returns a list of (name, context) : a name using "{% yield %}" gives one name per element of the list,
+        the element being added to the context used for the content.
+
+        entry: Loaded entry (see load_directory).
+        context: Values available in the templates.
+        '''
+        name_yield = entry['name_yield']
+        if not name_yield:
+            return [(entry['name_template'].render(context), context)]
+
+        names = []
+        elements = self.environment.compile_expression(name_yield.group('expression'))(**context)
+        name_template = self.environment.from_string(name_yield.group('prefix') + name_yield.group('body') + name_yield.group('suffix'))
+        for element in elements:
+            element_context = dict(context)
+            element_context[name_yield.group('variable')] = element
+            names.append((name_template.render(element_context), element_context))
+        return names
+
+    def render(self, destination, values, preserve=()):
+        '''
+        Renders the template in destination.
+        A file is only written when its rendered content is different from the existing one.
+        Returns a dictionary with the number of files written and unchanged, and the list of the rendered files
+        (paths relative to destination).
+
+        destination: Directory in which the template is rendered (the project directory).
+        values: Dictionary of values replacing the default values of copier.yml.
+        preserve: Relative paths (in destination) of the files not overwritten if they already exist
+                  (files generated from the template by another step, example : the Airrflow samplesheet).
+        '''
+        context = dict(self.defaults)
+        context.update(values)
+        stats = {'written': 0, 'unchanged': 0, 'files': []}
+        self.render_directory(self.tree, destination, '', context, set(preserve), stats)
+        return stats
+
+    def render_directory(self, entries, dir_path, relative_dir, context, preserve, stats):
+        '''
+        Renders a list of loaded entries in dir_path (recursive).
+
+        entries: Entries of the template directory (see load_directory).
+        dir_path: Destination directory.
+        relative_dir: Path of dir_path relative to the destination of the render.
+        context: Values available in the templates.
+        preserve: Relative paths of the files not overwritten if they already exist.
+        stats: Dictionary counting the files written and unchanged, and listing the rendered files.
+        '''
+        for entry in entries:
+            for name, entry_context in self.render_names(entry, context):
+                # As in Copier, an entry whose name is rendered empty is skipped
+                if not name:
+                    continue
+                path = os.path.join(dir_path, name)
+                relative_path = os.path.join(relative_dir, name)
+
+                if 'children' in entry:
+                    os.makedirs(path, exist_ok=True)
+                    self.render_directory(entry['children'], path, relative_path, entry_context, preserve, stats)
+                    continue
+
+                stats['files'].append(relative_path)
+                if relative_path in preserve and os.path.exists(path):
+                    stats['unchanged'] += 1
+                    continue
+
+                if 'template' in entry:
+                    content = entry['template'].render(entry_context).encode('utf-8')
+                else:
+                    content = entry['content']
+
+                if write_file_if_changed(path, content, entry['mode']):
+                    stats['written'] += 1
+                else:
+                    stats['unchanged'] += 1
@@ -0,0 +1,142 @@
+import math
+import os
+import zlib
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Estimates the workload of each plate from its FastQ files, to give Snakemake the threads, memory and runtime of the
+# zUMIs and TRUST4 jobs of the plate (written in config.yaml and in the zUMIs config of the plate).
+# Small plates then use a few cores, so that the scheduler runs several of them at the same time.
+# 1. Function sample_bytes_per_read : Measures the compressed size of a read in the first block of a FastQ file.
+# 2. Function estimate_plate_reads : Estimates the number of reads of a plate from the size of its R1 files (all lanes).
+# 3. Function plan_plate_resources : Computes the threads, memory and runtime of the zUMIs and TRUST4 jobs of a plate.
+# 4. Function plan_resources : Plans the resources of all the plates.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Resources of each plate written in the config of the workflow (config.yaml, one comma separated list per key in copier.yml)
+RESOURCE_KEYS = ["zumis_threads", "zumis_mem_mb", "zumis_runtime", "trust4_threads", "trust4_mem_mb", "trust4_runtime"]
+# Compressed bytes read at the start of a FastQ file to measure the size of a read
+SAMPLE_BYTES = 256 * 1024
+# Compressed size of a R1 read (cDNA 114 bases) used when the file cannot be sampled
+DEFAULT_BYTES_PER_READ = 70
+
+# Model of the jobs (estimates from FlashFB5p-seq runs, the memory of zUMIs is mostly the STAR genome index)
+# zUMIs : one thread per 10 million reads (between 4 and the maximum), STAR index + sorting memory, 10 CPU minutes per million reads
+ZUMIS_READS_PER_THREAD = 10_000_000
+ZUMIS_MIN_THREADS = 4
+ZUMIS_BASE_MEM_MB = 32000
+ZUMIS_MEM_MB_PER_MILLION_READS = 50
+ZUMIS_BASE_RUNTIME = 30
+ZUMIS_CPU_MINUTES_PER_MILLION_READS = 10
+# TRUST4 : one thread per 20 million reads (between 2 and 24, the value used before), 4 CPU minutes per million reads
+TRUST4_READS_PER_THREAD = 20_000_000
+TRUST4_MIN_THREADS = 2
+TRUST4_MAX_THREADS = 24
+TRUST4_BASE_MEM_MB = 4000
+TRUST4_MEM_MB_PER_MILLION_READS = 16
+TRUST4_BASE_RUNTIME = 15
+TRUST4_CPU_MINUTES_PER_MILLION_READS = 4
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function sample_bytes_per_read : Measures the compressed size of a read in a FastQ file.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def sample_bytes_per_read(file_path, sample_bytes=SAMPLE_BYTES):
+    '''
+    Decompresses the first sample_bytes bytes of a gzip FastQ file and returns the number of compressed bytes per read
+    (4 lines per read). Files made of several gzip members (concatenated lanes) are supported.
+    Returns None if the file cannot be read or does not contain a complete read.
+
+    file_path: Path to the .fastq.gz file.
+    sample_bytes: Number of compressed bytes read.
+    '''
+    try:
+        with open(file_path, 'rb') as file:
+            data = file.read(sample_bytes)
+    except OSError:
+        return None
+
+    sample_size = len(data)
+    lines = 0
+    try:
+        while data:
+            decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            lines += decompressor.decompress(data).count(b'\n')
+            data = decompressor.unused_data
+    except zlib.error:
+        return None
+
+    reads = lines // 4
+    return sample_size / reads if reads else None
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function estimate_plate_reads : Estimates the number of reads of a plate.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def estimate_plate_reads(sources):
+    '''
+    Estimates the number of reads of a plate : size of each R1 file (one per lane) divided by the compressed size of a read,
+    measured at the start of the file. The size is read again on the file (it may have grown since the catalog was updated,
+    in watch mode), the measure is kept in the FastQ catalog entry ('bytes_per_read'), so that the files are only sampled
+    again when they are new or modified.
+
+    sources: FastQ files of the plate (entries of the FastQ catalog, see resolve_fastq_files).
+    '''
+    reads = 0
+    for fastq in sources:
+        if fastq['read_type'] != "R1":
+            continue
+        if fastq.get('bytes_per_read') is None:
+            fastq['bytes_per_read'] = sample_bytes_per_read(fastq['path'])
+        try:
+            size = os.stat(fastq['path']).st_size
+        except OSError:
+            size = fastq['size']
+        reads += size / (fastq['bytes_per_read'] or DEFAULT_BYTES_PER_READ)
+    return int(reads)
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function plan_plate_resources : Computes the resources of the jobs of a plate.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def plan_plate_resources(reads, max_threads, max_mem_mb):
+    '''
+    Computes the threads, memory (MB) and runtime (minutes) of the zUMIs and TRUST4 jobs of a plate of reads reads.
+    Returns a dictionary : reads, zumis_threads, zumis_mem_mb, zumis_runtime, trust4_threads, trust4_mem_mb, trust4_runtime.
+
+    reads: Estimated number of reads of the plate.
+    max_threads: Maximum number of threads of a job.
+    max_mem_mb: Maximum memory of a job (MB).
+    '''
+    million_reads = reads / 1_000_000
+
+    zumis_threads = min(max(math.ceil(reads / ZUMIS_READS_PER_THREAD), ZUMIS_MIN_THREADS), max_threads)
+    trust4_threads = min(max(math.ceil(reads / TRUST4_READS_PER_THREAD), TRUST4_MIN_THREADS), TRUST4_MAX_THREADS, max_threads)
+
+    return {
+        'reads': reads,
+        'zumis_threads': zumis_threads,
+        'zumis_mem_mb': min(ZUMIS_BASE_MEM_MB + math.ceil(million_reads * ZUMIS_MEM_MB_PER_MILLION_READS), max_mem_mb),
+        'zumis_runtime': ZUMIS_BASE_RUNTIME + math.ceil(million_reads * ZUMIS_CPU_MINUTES_PER_MILLION_READS / zumis_threads),
+        'trust4_threads': trust4_threads,
+        'trust4_mem_mb': min(TRUST4_BASE_MEM_MB + math.ceil(million_reads * TRUST4_MEM_MB_PER_MILLION_READS), max_mem_mb),
+        'trust4_runtime': TRUST4_BASE_RUNTIME + math.ceil(million_reads * TRUST4_CPU_MINUTES_PER_MILLION_READS / trust4_threads)
+    }
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function plan_resources : Plans the resources of all the plates.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def plan_resources(plate_fastq, plates_list, max_threads, max_mem_mb, pending_plates=()):
+    '''
+    Returns a dictionary plate -> resources of its jobs (see plan_plate_resources), in the order of plates_list.
+    The FastQ files of the pending plates (watch mode, see fastq_watch.py) are still being written : their jobs get the
+    resources of the largest complete plate, or the maximum threads of zUMIs if no plate is complete yet.
+
+    plate_fastq: Dictionary returned by resolve_fastq_files (FastQ files of each plate).
+    plates_list: List of plates.
+    max_threads: Maximum number of threads of a job.
+    max_mem_mb: Maximum memory of a job (MB).
+    pending_plates: Plates whose FastQ files are not complete yet.
+    '''
+    reads = {plate: estimate_plate_reads(plate_fastq[plate]['sources']) for plate in plates_list}
+    complete_reads = [reads[plate] for plate in plates_list if plate not in pending_plates]
+    pending_reads = max(complete_reads) if complete_reads else max_threads * ZUMIS_READS_PER_THREAD
+    return {plate: plan_plate_resources(max(reads[plate], pending_reads) if plate in pending_plates else reads[plate], max_threads, max_mem_mb)
+            for plate in plates_list}
@@ -0,0 +1,96 @@
+import contextlib
+import os
+import shutil
+import tempfile
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# 1. Function link_or_copy : Hardlinks (or reflinks) a file when the filesystem allows it, copies it otherwise.
+# 2. Function staged_template : Creates a private copy of the template for one run, removed at the end of the run (even on failure).
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Prefix of the staging directories (one per run)
+STAGING_PREFIX = "FlashPipe_"
+# ioctl request to clone a file on Linux filesystems supporting it (btrfs, xfs...)
+FICLONE = 0x40049409
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function link_or_copy : Hardlinks (or reflinks) a file when possible, copies it otherwise.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def reflink(source_file, destination_file):
+    '''
+    Clones source_file in destination_file (copy-on-write, no data is copied). Raises OSError if not supported.
+
+    source_file: Path to the file to clone.
+    destination_file: Path to the clone.
+    '''
+    import fcntl
+
+    with open(source_file, 'rb') as source, open(destination_file, 'wb') as destination:
+        try:
+            fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+        except OSError:
+            destination.close()
+            os.remove(destination_file)
+            raise
+    shutil.copystat(source_file, destination_file)
+
+def link_or_copy(source_file, destination_file):
+    '''
+    Creates destination_file without copying the bytes of source_file when the filesystem allows it:
+    a hardlink is tried first, then a reflink (copy-on-write clone), and the file is copied as a last resort.
+    Used as copy_function of shutil.copytree.
+    Warning: a hardlinked file shares its content with the source, it must be replaced (not modified in place) to be changed.
+
+    source_file: Path to the file to link or copy.
+    destination_file: Path to the new file.
+    '''
+    try:
+        os.link(source_file, destination_file)
+        return destination_file
+    except OSError:
+        pass
+
+    try:
+        reflink(source_file, destination_file)
+        return destination_file
+    except (OSError, ImportError):
+        pass
+
+    return shutil.copy2(source_file, destination_file)
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function staged_template : Creates a private copy of the template for one run.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+@contextlib.contextmanager
+def staged_template(template_path, staging_dir=None, private_files=("copier.yml",), ignore=("02_Container",)):
+    '''
+    Context manager creating a staging copy of the template, private to the current run.
+    The staging directory is created atomically with a unique name (several runs on the same node never share it)
+    and is deleted when leaving the context, even if the run failed.
+    The template files are hardlinked/reflinked when possible (see link_or_copy), except private_files which are
+    really copied because the run modifies them.
+    Yields the path to the template copy.
+
+    template_path: Path to the template directory.
+    staging_dir: Directory in which the staging directory is created (default: TMPDIR or /tmp).
+    private_files: Template files (relative paths) copied byte by byte, to be modified by the run.
+    ignore: Names of the files and directories not copied.
+    '''
+    if staging_dir and not os.path.exists(staging_dir):
+        os.makedirs(staging_dir)
+    run_dir = tempfile.mkdtemp(prefix=STAGING_PREFIX, dir=staging_dir)
+    try:
+        staged_template_path = os.path.join(run_dir, "01_Template")
+        shutil.copytree(template_path, staged_template_path, ignore=shutil.ignore_patterns(*ignore), copy_function=link_or_copy)
+
+        # Replace the links of the files modified by the run by real copies (the template itself must never be modified)
+        for private_file in private_files:
+            staged_file = os.path.join(staged_template_path, private_file)
+            if os.path.exists(staged_file):
+                os.remove(staged_file)
+                shutil.copy2(os.path.join(template_path, private_file), staged_file)
+
+        yield staged_template_path
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
@@ -0,0 +1,194 @@
+import hashlib
+import json
+import os
+from copy_engine import file_digest
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# The staging of an experiment is divided in actions (links of the FastQ files of one plate, copy of the Index Sorting
+# files of one plate, copy of the GSF file, rendering of the template, Airrflow samplesheet).
+# The manifest records, for each action, the config keys it depends on, a fingerprint of its inputs and the files it produced.
+# 1. Function describe_file : Describes a file produced or linked (source, size, modification time, content hash).
+# 2. Function fingerprint : Computes the fingerprint of the inputs of an action (config values and input files).
+# 3. Function open_manifest / save_manifest : Loads and writes the manifest of an experiment.
+# 4. Function plan_actions : Compares the actions of the current config with the manifest and returns the actions to run.
+# 5. Function update_manifest : Records the actions that have been run.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Version of the manifest format (a manifest with another version is ignored : every action is run)
+MANIFEST_VERSION = 1
+# Files bigger than this size are described by their size and modification time only (FastQ files, containers)
+HASH_SIZE_LIMIT = 64 * 1024 * 1024
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function describe_file : Describes a file produced or linked by an action.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def describe_file(file_path, source=None, hash_size_limit=HASH_SIZE_LIMIT):
+    '''
+    Returns the description of a file : path, source, size, modification time and content hash
+    (None for the files bigger than hash_size_limit). A symbolic link is described by its target.
+    Returns None if the file does not exist.
+
+    file_path: Path to the file.
+    source: Path to the file it was copied or linked from (optional).
+    hash_size_limit: Size above which the content hash is not computed.
+    '''
+    if os.path.islink(file_path):
+        return {'path': file_path, 'source': source, 'link': os.readlink(file_path)}
+    if not os.path.isfile(file_path):
+        return None
+
+    stat = os.stat(file_path)
+    return {
+        'path': file_path,
+        'source': source,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime_ns,
+        'sha256': file_digest(file_path) if stat.st_size <= hash_size_limit else None
+    }
+
+def is_file_unchanged(description):
+    '''
+    Checks if a file recorded in the manifest is still the same on disk.
+    The content hash is only computed again when the size is the same but the modification time changed.
+
+    description: Description of the file recorded in the manifest (see describe_file).
+    '''
+    file_path = description['path']
+    if 'link' in description:
+        return os.path.islink(file_path) and os.readlink(file_path) == description['link']
+    if not os.path.isfile(file_path) or os.path.islink(file_path):
+        return False
+
+    stat = os.stat(file_path)
+    if stat.st_size != description['size']:
+        return False
+    if stat.st_mtime_ns == description['mtime']:
+        return True
+    return description['sha256'] is not None and file_digest(file_path) == description['sha256']
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function fingerprint : Computes the fingerprint of the inputs of an action.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def fingerprint(inputs):
+    '''
+    Returns the SHA-256 of the JSON representation of the inputs of an action (keys sorted, so the order does not matter).
+
+    inputs: JSON serializable description of the inputs (config values, file descriptions...).
+    '''
+    return hashlib.sha256(json.dumps(inputs, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def describe_tree(dir_path):
+    '''
+    Describes all the files of a directory by their relative path, size and modification time (no content read).
+    Used to detect a modification of the template.
+
+    dir_path: Directory to describe.
+    '''
+    files = []
+    for root, dirs, file_names in os.walk(dir_path):
+        dirs.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(root, file_name)
+            stat = os.stat(file_path)
+            files.append([os.path.relpath(file_path, dir_path), stat.st_size, stat.st_mtime_ns])
+    return files
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function open_manifest / save_manifest : Loads and writes the manifest.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def open_manifest(manifest_path):
+    '''
+    Loads the manifest of an experiment. An empty manifest is returned if it does not exist or cannot be read.
+
+    manifest_path: Path to the JSON manifest file.
+    '''
+    empty_manifest = {'version': MANIFEST_VERSION, 'actions': {}}
+    if not os.path.isfile(manifest_path):
+        return empty_manifest
+
+    try:
+        with open(manifest_path, 'r') as file:
+            manifest = json.load(file)
+    except (OSError, ValueError) as e:
+        print(f"WARNING: The staging manifest {manifest_path} cannot be read, every action will be run ({e}).")
+        return empty_manifest
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return empty_manifest
+    return manifest
+
+def save_manifest(manifest, manifest_path):
+    '''
+    Writes the manifest in a temporary file then renames it, so that an interrupted run never leaves a truncated manifest.
+
+    manifest: Manifest dictionary.
+    manifest_path: Path to the JSON manifest file.
+    '''
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function plan_actions : Returns the actions to run, comparing the current config with the manifest.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def plan_actions(manifest, actions):
+    '''
+    Compares the actions required by the current config with the ones recorded in the manifest.
+    An action is run if it is not in the manifest, if one of the config keys it depends on or one of its inputs changed,
+    or if one of the files it produced was deleted or modified.
+    Returns the list of (action name, reason) to run, in the order of actions, and the list of the recorded actions
+    that are not required anymore (example: a plate removed from plate_names; their files are kept).
+
+    manifest: Manifest dictionary (see open_manifest).
+    actions: Dictionary action name -> {'config': values of the config keys it depends on, 'inputs': description of its inputs}.
+    '''
+    recorded_actions = manifest.get('actions', {})
+    planned = []
+    for name, action in actions.items():
+        recorded = recorded_actions.get(name)
+        if recorded is None:
+            planned.append((name, "new"))
+            continue
+
+        changed_keys = sorted(key for key in set(action['config']) | set(recorded.get('config', {}))
+                              if action['config'].get(key) != recorded.get('config', {}).get(key))
+        if changed_keys:
+            planned.append((name, f"config changed ({', '.join(changed_keys)})"))
+        elif fingerprint(action['inputs']) != recorded.get('fingerprint'):
+            planned.append((name, "inputs changed"))
+        else:
+            modified = [description['path'] for description in recorded.get('files', []) if not is_file_unchanged(description)]
+            if modified:
+                planned.append((name, f"{len(modified)} files missing or modified (first : {modified[0]})"))
+
+    obsolete = sorted(name for name in recorded_actions if name not in actions)
+    return planned, obsolete
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 5. Function update_manifest : Records the actions that have been run.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def update_manifest(manifest, actions, outputs):
+    '''
+    Records in the manifest the actions that have been run (config values, fingerprint of the inputs and files produced),
+    and removes the actions that are not required anymore. The other actions are kept as they are.
+    Returns the updated manifest.
+
+    manifest: Manifest dictionary (see open_manifest).
+    actions: Dictionary of all the actions required by the current config (see plan_actions).
+    outputs: Dictionary action name -> list of (file_path, source) produced or linked by the actions that have been run.
+    '''
+    recorded_actions = {name: recorded for name, recorded in manifest.get('actions', {}).items() if name in actions}
+    for name, files in outputs.items():
+        descriptions = [describe_file(file_path, source) for file_path, source in files]
+        recorded_actions[name] = {
+            'depends_on': sorted(actions[name]['config']),
+            'config': actions[name]['config'],
+            'fingerprint': fingerprint(actions[name]['inputs']),
+            'files': [description for description in descriptions if description is not None]
+        }
+
+    manifest['version'] = MANIFEST_VERSION
+    manifest['actions'] = recorded_actions
+    return manifest
@@ -0,0 +1,138 @@
+import contextlib
+import json
+import os
+import resource
+import time
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# 1. Function read_process_io : Reads the I/O counters of the process (bytes and system calls, Linux /proc/self/io).
+# 2. Class StagingProfiler : Measures each phase of the staging (wall time, CPU time, files, bytes read/written,
+#    read/write system calls) and writes the trace in a JSON file. When disabled, the phases cost nothing.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Version of the trace format
+TRACE_VERSION = 1
+# Counters of /proc/self/io kept in the trace :
+# rchar/wchar : bytes read/written by the process (including the page cache), read_bytes/write_bytes : bytes really read/written on the storage,
+# syscr/syscw : number of read/write system calls.
+PROCESS_IO_FIELDS = ["rchar", "wchar", "read_bytes", "write_bytes", "syscr", "syscw"]
+# Number of lines of the error output of a subprocess kept in the trace (copier writes one line per file, the error is at the end)
+STDERR_MAX_LINES = 200
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function read_process_io : Reads the I/O counters of the process.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def read_process_io():
+    '''
+    Returns the I/O counters of the current process (see PROCESS_IO_FIELDS), or an empty dictionary if the system
+    does not provide them (not Linux, or /proc not readable).
+    '''
+    try:
+        with open('/proc/self/io', 'r') as file:
+            counters = dict(line.split(':', 1) for line in file if ':' in line)
+    except OSError:
+        return {}
+    return {field: int(counters[field]) for field in PROCESS_IO_FIELDS if field in counters}
+
+def read_cpu_times():
+    '''
+    Returns the CPU times (user, system) of the process and of its finished child processes (copier, lanes merge).
+    '''
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {'cpu_user': own.ru_utime, 'cpu_system': own.ru_stime,
+            'children_cpu_user': children.ru_utime, 'children_cpu_system': children.ru_stime}
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Class StagingProfiler : Measures each phase of the staging.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+class StagingProfiler:
+    '''
+    Trace of the phases of the staging of one experiment.
+    Usage : with profiler.phase("render") as record: ... record['files'] = 42
+    Each phase records its wall time, the CPU time and the I/O counters of the process spent during the phase, plus the
+    values set by the code in the record (number of files, bytes copied...).
+    The I/O counters are the ones of the whole process : with several experiments staged at the same time (--batch),
+    a phase also counts the I/O of the other experiments.
+
+    enabled: If False, nothing is measured (phase() yields a record that is not kept).
+    '''
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []
+        self.subprocesses = []
+        self.start = time.time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        '''
+        Context manager measuring one phase. The phase is recorded even if it raises an error (with the error).
+
+        name: Name of the phase.
+        '''
+        record = {'name': name}
+        if not self.enabled:
+            yield record
+            return
+
+        io_start = read_process_io()
+        cpu_start = read_cpu_times()
+        wall_start = time.monotonic()
+        try:
+            yield record
+        except BaseException as e:
+            record['error'] = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record['wall_time'] = round(time.monotonic() - wall_start, 6)
+            cpu_end = read_cpu_times()
+            for key, value in cpu_end.items():
+                record[key] = round(value - cpu_start[key], 6)
+            io_end = read_process_io()
+            for field, value in io_end.items():
+                record[field] = value - io_start.get(field, 0)
+            self.phases.append(record)
+
+    def record_subprocess(self, name, command, completed_process):
+        '''
+        Records the command, exit code and the last STDERR_MAX_LINES lines of the error output of a subprocess
+        (always kept, even if the profiler is disabled).
+
+        name: Name of the subprocess (example: copier).
+        command: Command line.
+        completed_process: Result of subprocess.run (with captured output).
+        '''
+        stderr_lines = (completed_process.stderr or '').splitlines()
+        self.subprocesses.append({
+            'name': name,
+            'command': command,
+            'returncode': completed_process.returncode,
+            'stderr': '\n'.join(stderr_lines[-STDERR_MAX_LINES:])
+        })
+
+    def trace(self, **metadata):
+        '''
+        Returns the trace as a dictionary.
+
+        metadata: Values added at the top of the trace (experiment, renderer...).
+        '''
+        trace = {'version': TRACE_VERSION, 'started': self.start, 'total_wall_time': round(time.time() - self.start, 6)}
+        trace.update(metadata)
+        trace['phases'] = self.phases
+        trace['subprocesses'] = self.subprocesses
+        return trace
+
+    def write(self, trace_path, **metadata):
+        '''
+        Writes the trace in a JSON file (the directory is created if needed).
+
+        trace_path: Path to the JSON file.
+        metadata: Values added at the top of the trace.
+        '''
+        os.makedirs(os.path.dirname(trace_path), exist_ok=True)
+        tmp_path = f"{trace_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(self.trace(**metadata), file, indent=2)
+        os.replace(tmp_path, trace_path)
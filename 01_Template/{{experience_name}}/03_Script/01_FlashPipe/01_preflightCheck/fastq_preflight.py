@@ -0,0 +1,257 @@
+import csv
+import gzip
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Quick check of the FastQ files of each plate before launching zUMIs/TRUST4 (a wrong read assignment or
+# a swapped sample is otherwise only noticed hours later).
+# 1. Function load_barcode_whitelist : Reads the well barcodes (cell_barcode_well.csv).
+# 2. Function read_fastq_records : Streams the first records of a gzip FastQ file (the rest of the file is never read).
+# 3. Function check_plate : Checks the pairing of R1/R2 read names, the read lengths and the barcode hit rate of one plate.
+# 4. Function check_plates_in_parallel : Runs the check of several plates in a process pool.
+# 5. Writes one JSON summary per plate, and exits with an error if one plate does not pass the checks.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Layout of the reads, as defined in the zUMIs YAML file (R2 : BC(1-8) UMI(9-16), R1 : cDNA(1-114))
+# and in the trust4 rule (--barcodeRange 0 7, --umiRange 8 15).
+BARCODE_LENGTH = 8
+UMI_LENGTH = 8
+CDNA_LENGTH = 114
+# Default number of read pairs checked per plate
+DEFAULT_READS = 10000
+# Default minimal fraction of R2 barcodes found in the well whitelist
+DEFAULT_MIN_BARCODE_HIT_RATE = 0.5
+# Maximal fraction of reads shorter than the layout
+MAX_SHORT_READ_FRACTION = 0.5
+# Columns of the barcode file
+COLUMN_WELL_ID = "WellID"
+COLUMN_BARCODE = "BarcodeSequence"
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function load_barcode_whitelist : Reads the well barcodes.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def load_barcode_whitelist(barcode_well_path):
+    '''
+    Reads the barcode file and returns a dictionary barcode -> well ID.
+
+    barcode_well_path: Path to the csv file with the columns WellID and BarcodeSequence (cell_barcode_well.csv).
+    '''
+    with open(barcode_well_path, 'r', newline='') as file:
+        return {row[COLUMN_BARCODE].strip(): row[COLUMN_WELL_ID].strip() for row in csv.DictReader(file)}
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function read_fastq_records : Streams the first records of a gzip FastQ file.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def read_name(header):
+    '''
+    Returns the name of a read from its header line, without the read number (" 1:N:0:1" or "/1"), to compare R1 and R2.
+
+    header: Header line of the record (starting with @).
+    '''
+    name = header[1:].split(maxsplit=1)[0] if len(header) > 1 else ""
+    if name.endswith(("/1", "/2")):
+        name = name[:-2]
+    return name
+
+def read_fastq_records(fastq_path, max_records):
+    '''
+    Yields (name, sequence) for the first max_records records of a gzip FastQ file.
+    The file is decompressed as it is read, so only the beginning of the file is read whatever its size.
+
+    fastq_path: Path to the FastQ file (.fastq.gz).
+    max_records: Maximum number of records to read.
+    '''
+    with gzip.open(fastq_path, 'rt') as fastq:
+        for _ in range(max_records):
+            header = fastq.readline().rstrip('\n')
+            if not header:
+                return
+            sequence = fastq.readline().rstrip('\n')
+            separator = fastq.readline()
+            fastq.readline()
+            if not header.startswith('@') or not separator.startswith('+'):
+                raise ValueError(f"The file {fastq_path} is not a valid FastQ file (record : {header}).")
+            yield read_name(header), sequence
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function check_plate : Checks the read names, the read lengths and the barcode hit rate of a plate.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def check_plate(plate_name, fastq_read1, fastq_read2, barcode_well_path, max_reads=DEFAULT_READS,
+                min_barcode_hit_rate=DEFAULT_MIN_BARCODE_HIT_RATE):
+    '''
+    Reads the first records of R1 and R2 of a plate together and checks that :
+    - the read names of R1 and R2 are the same (files of the same sample, in the same order),
+    - the reads are long enough for the layout (R2 : barcode + UMI, R1 : cDNA),
+    - enough barcodes (first bases of R2) are found in the well whitelist.
+    Returns the summary of the plate (dictionary), with the list of errors (empty if the plate passes the checks).
+
+    plate_name: Name of the plate.
+    fastq_read1: Path to the FastQ Read1 file (cDNA).
+    fastq_read2: Path to the FastQ Read2 file (barcode and UMI).
+    barcode_well_path: Path to the barcode file (cell_barcode_well.csv).
+    max_reads: Number of read pairs checked.
+    min_barcode_hit_rate: Minimal fraction of R2 barcodes found in the whitelist.
+    '''
+    whitelist = load_barcode_whitelist(barcode_well_path)
+    barcode_read2_length = BARCODE_LENGTH + UMI_LENGTH
+    summary = {
+        'plate_name': plate_name,
+        'fastq_read1': fastq_read1,
+        'fastq_read2': fastq_read2,
+        'reads_checked': 0,
+        'name_mismatches': 0,
+        'first_name_mismatch': None,
+        'read1_length': {'min': None, 'max': None, 'expected': CDNA_LENGTH, 'short_fraction': 0.0},
+        'read2_length': {'min': None, 'max': None, 'expected': barcode_read2_length, 'short_fraction': 0.0},
+        'barcode_hits': 0,
+        'barcode_hit_rate': 0.0,
+        'read1_barcode_hit_rate': 0.0,
+        'min_barcode_hit_rate': min_barcode_hit_rate,
+        'wells_detected': 0,
+        'errors': []
+    }
+    errors = summary['errors']
+
+    short_read1 = short_read2 = read1_hits = 0
+    wells = set()
+    lengths = {'read1_length': [], 'read2_length': []}
+    try:
+        records_read2 = read_fastq_records(fastq_read2, max_reads)
+        for (name1, sequence1), record2 in zip(read_fastq_records(fastq_read1, max_reads), records_read2):
+            name2, sequence2 = record2
+            summary['reads_checked'] += 1
+
+            if name1 != name2:
+                summary['name_mismatches'] += 1
+                if summary['first_name_mismatch'] is None:
+                    summary['first_name_mismatch'] = {'read1': name1, 'read2': name2}
+
+            lengths['read1_length'].append(len(sequence1))
+            lengths['read2_length'].append(len(sequence2))
+            short_read1 += len(sequence1) < CDNA_LENGTH
+            short_read2 += len(sequence2) < barcode_read2_length
+
+            well = whitelist.get(sequence2[:BARCODE_LENGTH])
+            if well is not None:
+                summary['barcode_hits'] += 1
+                wells.add(well)
+            # Barcodes found at the start of R1 mean that R1 and R2 are probably swapped
+            read1_hits += sequence1[:BARCODE_LENGTH] in whitelist
+    except (OSError, EOFError, ValueError) as e:
+        errors.append(f"ERROR: Cannot read the FastQ files of the plate {plate_name} : {e}")
+        return summary
+
+    reads_checked = summary['reads_checked']
+    if reads_checked == 0:
+        errors.append(f"ERROR: No read found in the FastQ files of the plate {plate_name}.")
+        return summary
+
+    for key, short_reads in (('read1_length', short_read1), ('read2_length', short_read2)):
+        summary[key]['min'] = min(lengths[key])
+        summary[key]['max'] = max(lengths[key])
+        summary[key]['short_fraction'] = round(short_reads / reads_checked, 4)
+    summary['barcode_hit_rate'] = round(summary['barcode_hits'] / reads_checked, 4)
+    summary['read1_barcode_hit_rate'] = round(read1_hits / reads_checked, 4)
+    summary['wells_detected'] = len(wells)
+
+    if summary['name_mismatches']:
+        errors.append(f"ERROR: {summary['name_mismatches']} read names are different between R1 and R2 (first : {summary['first_name_mismatch']}). "
+                      "The files are not from the same sample, or are not in the same order.")
+    if summary['read1_length']['short_fraction'] > MAX_SHORT_READ_FRACTION:
+        errors.append(f"ERROR: R1 reads are shorter than expected (max {summary['read1_length']['max']}, expected cDNA({CDNA_LENGTH})).")
+    if summary['read2_length']['short_fraction'] > MAX_SHORT_READ_FRACTION:
+        errors.append(f"ERROR: R2 reads are shorter than expected (max {summary['read2_length']['max']}, expected BC({BARCODE_LENGTH}) + UMI({UMI_LENGTH})).")
+    if summary['barcode_hit_rate'] < min_barcode_hit_rate:
+        message = f"ERROR: Only {summary['barcode_hit_rate']:.1%} of the R2 barcodes are in {os.path.basename(barcode_well_path)} (minimum {min_barcode_hit_rate:.1%})."
+        if summary['read1_barcode_hit_rate'] >= min_barcode_hit_rate:
+            message += f" {summary['read1_barcode_hit_rate']:.1%} of R1 reads start with a barcode : R1 and R2 seem swapped."
+        errors.append(message)
+
+    return summary
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function check_plates_in_parallel : Runs the check of several plates in a process pool.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def check_plates_in_parallel(plates, barcode_well_path, max_reads=DEFAULT_READS,
+                             min_barcode_hit_rate=DEFAULT_MIN_BARCODE_HIT_RATE, processes=None):
+    '''
+    Checks several plates at the same time.
+    Returns the list of summaries (in the order of plates).
+
+    plates: List of tuples (plate_name, fastq_read1, fastq_read2).
+    barcode_well_path: Path to the barcode file (cell_barcode_well.csv).
+    max_reads: Number of read pairs checked per plate.
+    min_barcode_hit_rate: Minimal fraction of R2 barcodes found in the whitelist.
+    processes: Maximum number of processes (default: one per plate, limited to the number of CPUs).
+    '''
+    if processes is None:
+        processes = min(len(plates), os.cpu_count() or 1)
+
+    arguments = [(plate_name, read1, read2, barcode_well_path, max_reads, min_barcode_hit_rate) for plate_name, read1, read2 in plates]
+    if processes <= 1 or len(plates) <= 1:
+        return [check_plate(*plate_arguments) for plate_arguments in arguments]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(check_plate, *plate_arguments) for plate_arguments in arguments]
+        return [future.result() for future in futures]
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 5. Writes the JSON summaries
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def write_summary(summary, output_dir):
+    '''
+    Writes the summary of a plate in output_dir/{plate_name}_preflight.json and returns its path.
+
+    summary: Summary of the plate (see check_plate).
+    output_dir: Output directory.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    summary_path = os.path.join(output_dir, f"{summary['plate_name']}_preflight.json")
+    tmp_path = f"{summary_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(summary, file, indent=2)
+    os.replace(tmp_path, summary_path)
+    return summary_path
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog -b cell_barcode_well.csv -o OUTPUT_DIR -p PLATE -1 R1.fastq.gz -2 R2.fastq.gz [-p PLATE -1 ... -2 ...]")
+    parser.add_option("-p", "--plate_name", dest="plate_names", action="append", default=[], help="Name of a plate (repeat for each plate)", metavar="PLATE_NAME")
+    parser.add_option("-1", "--read1", dest="read1", action="append", default=[], help="FastQ Read1 file of the plate (cDNA)", metavar="READ1")
+    parser.add_option("-2", "--read2", dest="read2", action="append", default=[], help="FastQ Read2 file of the plate (barcode and UMI)", metavar="READ2")
+    parser.add_option("-b", "--barcode_well", dest="barcode_well", help="Barcode file with WellID and BarcodeSequence columns", metavar="BARCODE_WELL")
+    parser.add_option("-o", "--output_dir", dest="output_dir", help="Directory of the JSON summaries", metavar="OUTPUT_DIR")
+    parser.add_option("-n", "--reads", dest="reads", type="int", default=DEFAULT_READS, help=f"Number of read pairs checked per plate (default: {DEFAULT_READS})", metavar="READS")
+    parser.add_option("-m", "--min_barcode_hit_rate", dest="min_barcode_hit_rate", type="float", default=DEFAULT_MIN_BARCODE_HIT_RATE,
+                      help=f"Minimal fraction of R2 barcodes found in the barcode file (default: {DEFAULT_MIN_BARCODE_HIT_RATE})", metavar="RATE")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=None, help="Number of plates checked at the same time (default: number of CPUs)", metavar="JOBS")
+    (options, args) = parser.parse_args()
+
+    if not options.plate_names or not options.barcode_well or not options.output_dir or \
+            not len(options.plate_names) == len(options.read1) == len(options.read2):
+        print("Error: You must provide a barcode file, an output directory, and a Read1 and Read2 file for each plate.")
+        parser.print_help()
+        sys.exit(1)
+
+    summaries = check_plates_in_parallel(list(zip(options.plate_names, options.read1, options.read2)), options.barcode_well,
+                                         max_reads=options.reads, min_barcode_hit_rate=options.min_barcode_hit_rate, processes=options.jobs)
+
+    failed = False
+    for summary in summaries:
+        summary_path = write_summary(summary, options.output_dir)
+        print(json.dumps(summary, indent=2))
+        if summary['errors']:
+            failed = True
+            print(f"Plate {summary['plate_name']} FAILED the pre-flight check ({summary_path}) :")
+            for error in summary['errors']:
+                print(error)
+        else:
+            print(f"Plate {summary['plate_name']} : {summary['reads_checked']} reads checked, {summary['barcode_hit_rate']:.1%} barcodes in the whitelist, "
+                  f"{summary['wells_detected']} wells detected.")
+
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,299 @@
+import csv
+import gzip
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from optparse import OptionParser
+import numpy as np
+from fastq_preflight import BARCODE_LENGTH, COLUMN_WELL_ID, COLUMN_BARCODE
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Estimates the number of reads of each well of a plate from the barcodes of R2, before launching zUMIs.
+# 1. Function build_barcode_index : Builds a lookup table from each 8-mer (packed in an integer) to its well,
+#    for the barcodes of cell_barcode_well.csv and all their Hamming distance 1 neighbours.
+# 2. Function read_barcode_codes : Reads R2 by large blocks and extracts the packed barcode of every read with NumPy.
+# 3. Function count_plate_wells : Counts the reads of each well of one plate (exact and corrected barcodes).
+# 4. Function count_plates_in_parallel : Runs one worker per plate.
+# 5. Writes one count table per plate (one line per well, WellID layout of the QC).
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Size of the decompressed blocks read from the FastQ file (bounds the memory used per plate)
+DEFAULT_CHUNK_SIZE = 64 * 1024 * 1024
+# Code of each base on 2 bits (any other character, as N, gives an invalid code)
+BASES = b"ACGT"
+INVALID_BASE = 4
+NEWLINE = ord("\n")
+# Columns of the count table
+COLUMN_PLATE_NAME = "Plate_Name"
+COUNT_COLUMNS = [COLUMN_PLATE_NAME, COLUMN_WELL_ID, COLUMN_BARCODE, "ExactReads", "CorrectedReads", "Reads"]
+
+# Table converting a character (byte) to its 2 bits code
+BASE_CODES = np.full(256, INVALID_BASE, dtype=np.uint8)
+for code, base in enumerate(BASES):
+    BASE_CODES[base] = code
+    BASE_CODES[ord(chr(base).lower())] = code
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function build_barcode_index : Builds the lookup table from each 8-mer to its well.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def load_wells(barcode_well_path):
+    '''
+    Reads the barcode file and returns the list of (WellID, BarcodeSequence), in the order of the file.
+
+    barcode_well_path: Path to the csv file with the columns WellID and BarcodeSequence (cell_barcode_well.csv).
+    '''
+    with open(barcode_well_path, 'r', newline='') as file:
+        wells = [(row[COLUMN_WELL_ID].strip(), row[COLUMN_BARCODE].strip().upper()) for row in csv.DictReader(file)]
+
+    for well_id, barcode in wells:
+        if len(barcode) != BARCODE_LENGTH or any(base not in BASES.decode() for base in barcode):
+            raise ValueError(f"The barcode {barcode} of the well {well_id} is not a sequence of {BARCODE_LENGTH} bases (A, C, G, T).")
+    if len({barcode for _, barcode in wells}) != len(wells):
+        raise ValueError(f"The barcode file {barcode_well_path} contains the same barcode for several wells.")
+    return wells
+
+def encode_barcode(barcode):
+    '''
+    Packs a barcode in an integer (2 bits per base, the first base in the high bits).
+
+    barcode: Sequence of the barcode (A, C, G, T).
+    '''
+    code = 0
+    for base in barcode.encode():
+        code = (code << 2) | int(BASE_CODES[base])
+    return code
+
+def build_barcode_index(barcodes):
+    '''
+    Builds the lookup table of the barcodes : the index of the table is a packed 8-mer, the value is
+    - the well index (0 to n-1) if the 8-mer is the barcode of the well,
+    - n + the well index if the 8-mer is at Hamming distance 1 of the barcode of a single well (corrected barcode),
+    - 2n (ambiguous) if it is at distance 1 of several barcodes, 2n + 1 (unassigned) otherwise.
+    The last element of the table (index 4^8) is the unassigned value, used for the reads without a valid barcode.
+    The table takes 128 KB for 8-mers, whatever the number of wells.
+
+    barcodes: List of the barcodes of the wells (in the order of the wells).
+    '''
+    well_number = len(barcodes)
+    ambiguous = 2 * well_number
+    unassigned = 2 * well_number + 1
+    index = np.full(4 ** BARCODE_LENGTH + 1, unassigned, dtype=np.int16)
+
+    codes = [encode_barcode(barcode) for barcode in barcodes]
+    for well, code in enumerate(codes):
+        for position in range(BARCODE_LENGTH):
+            shift = 2 * (BARCODE_LENGTH - 1 - position)
+            base = (code >> shift) & 3
+            for other_base in range(4):
+                if other_base == base:
+                    continue
+                neighbour = code ^ ((base ^ other_base) << shift)
+                if index[neighbour] == unassigned:
+                    index[neighbour] = well_number + well
+                elif index[neighbour] != well_number + well:
+                    index[neighbour] = ambiguous
+
+    # The exact barcodes are set last : an exact match always wins over a neighbour of another barcode
+    for well, code in enumerate(codes):
+        index[code] = well
+    return index
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function read_barcode_codes : Reads R2 by large blocks and extracts the packed barcodes with NumPy.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def open_fastq_stream(fastq_path):
+    '''
+    Opens a gzip FastQ file for reading. The decompression is done by pigz in another process when it is installed
+    (as for zUMIs), by the gzip module otherwise. Returns the stream and the pigz process (or None).
+
+    fastq_path: Path to the FastQ file (.fastq.gz).
+    '''
+    pigz = shutil.which("pigz")
+    if pigz:
+        process = subprocess.Popen([pigz, "-dc", fastq_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return process.stdout, process
+    return gzip.open(fastq_path, 'rb'), None
+
+def read_barcode_codes(fastq_path, chunk_size=DEFAULT_CHUNK_SIZE, max_reads=None):
+    '''
+    Yields, for each block of the FastQ file, the array of the packed barcodes (first bases of the sequence) of its reads.
+    A read whose barcode is too short or contains another base than A, C, G, T gets the code 4^8 (unassigned).
+    Only complete records are processed; the end of a block is kept for the next one.
+
+    fastq_path: Path to the FastQ Read2 file (.fastq.gz).
+    chunk_size: Size of the decompressed blocks read at once.
+    max_reads: Maximum number of reads (default: all the reads of the file).
+    '''
+    shifts = (2 * np.arange(BARCODE_LENGTH - 1, -1, -1)).astype(np.uint32)
+    invalid_code = 4 ** BARCODE_LENGTH
+    reads = 0
+    stream, process = open_fastq_stream(fastq_path)
+    try:
+        remainder = b""
+        end_of_file = False
+        while not end_of_file and (max_reads is None or reads < max_reads):
+            data = stream.read(chunk_size)
+            end_of_file = not data
+            block = remainder + data
+            # The last record of a file may not end by a new line
+            if end_of_file and block and not block.endswith(b"\n"):
+                block += b"\n"
+            buffer = np.frombuffer(block, dtype=np.uint8)
+
+            newlines = np.flatnonzero(buffer == NEWLINE)
+            record_number = len(newlines) // 4
+            if max_reads is not None:
+                record_number = min(record_number, max_reads - reads)
+            if record_number == 0:
+                remainder = block
+                continue
+
+            # Positions of the 4 new lines of each record : the sequence starts after the first one
+            record_newlines = newlines[:4 * record_number].reshape(-1, 4)
+            header_starts = np.concatenate(([0], record_newlines[:-1, 3] + 1))
+            if not np.all(buffer[header_starts] == ord("@")):
+                raise ValueError(f"The file {fastq_path} is not a valid FastQ file (record not starting with @).")
+            sequence_starts = record_newlines[:, 0] + 1
+            sequence_lengths = record_newlines[:, 1] - sequence_starts
+
+            positions = np.minimum(sequence_starts[:, None] + np.arange(BARCODE_LENGTH), len(buffer) - 1)
+            bases = BASE_CODES[buffer[positions]]
+            codes = (bases.astype(np.uint32) << shifts).sum(axis=1, dtype=np.uint32)
+            valid = (sequence_lengths >= BARCODE_LENGTH) & np.all(bases != INVALID_BASE, axis=1)
+            codes[~valid] = invalid_code
+
+            reads += record_number
+            remainder = block[record_newlines[-1, 3] + 1:]
+            yield codes
+
+        if end_of_file and remainder.strip():
+            raise ValueError(f"The file {fastq_path} is truncated (incomplete last record).")
+    finally:
+        stream.close()
+        if process is not None:
+            # pigz is stopped if the file was not read until the end (max_reads)
+            stopped = process.poll() is None
+            if stopped:
+                process.kill()
+            process.wait()
+            if not stopped and process.returncode != 0:
+                raise OSError(f"pigz failed on {fastq_path} : {process.stderr.read().decode(errors='replace').strip()}")
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function count_plate_wells : Counts the reads of each well of one plate.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def count_plate_wells(plate_name, fastq_read2, barcode_well_path, chunk_size=DEFAULT_CHUNK_SIZE, max_reads=None):
+    '''
+    Counts the reads of each well of a plate, from the barcode at the start of R2.
+    Returns a dictionary with the plate name, the count table rows (one per well, in the order of the barcode file)
+    and the number of reads total, ambiguous and unassigned.
+
+    plate_name: Name of the plate.
+    fastq_read2: Path to the FastQ Read2 file of the plate (barcode and UMI).
+    barcode_well_path: Path to the barcode file (cell_barcode_well.csv).
+    chunk_size: Size of the decompressed blocks read at once.
+    max_reads: Maximum number of reads counted (default: all the reads, a smaller value gives an estimation).
+    '''
+    start = time.monotonic()
+    wells = load_wells(barcode_well_path)
+    well_number = len(wells)
+    index = build_barcode_index([barcode for _, barcode in wells])
+
+    counts = np.zeros(2 * well_number + 2, dtype=np.int64)
+    for codes in read_barcode_codes(fastq_read2, chunk_size=chunk_size, max_reads=max_reads):
+        counts += np.bincount(index[codes], minlength=len(counts))
+
+    rows = []
+    for well, (well_id, barcode) in enumerate(wells):
+        exact = int(counts[well])
+        corrected = int(counts[well_number + well])
+        rows.append({COLUMN_PLATE_NAME: plate_name, COLUMN_WELL_ID: well_id, COLUMN_BARCODE: barcode,
+                     "ExactReads": exact, "CorrectedReads": corrected, "Reads": exact + corrected})
+
+    return {
+        'plate_name': plate_name,
+        'rows': rows,
+        'reads': int(counts.sum()),
+        'ambiguous': int(counts[2 * well_number]),
+        'unassigned': int(counts[2 * well_number + 1]),
+        'duration': round(time.monotonic() - start, 1)
+    }
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function count_plates_in_parallel : Runs one worker per plate.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def count_plates_in_parallel(plates, barcode_well_path, chunk_size=DEFAULT_CHUNK_SIZE, max_reads=None, processes=None):
+    '''
+    Counts the reads per well of several plates at the same time (one process per plate).
+    Returns the list of results (see count_plate_wells), in the order of plates.
+
+    plates: List of tuples (plate_name, fastq_read2).
+    barcode_well_path: Path to the barcode file (cell_barcode_well.csv).
+    chunk_size: Size of the decompressed blocks read at once (per process).
+    max_reads: Maximum number of reads counted per plate (default: all).
+    processes: Maximum number of processes (default: one per plate, limited to the number of CPUs).
+    '''
+    if processes is None:
+        processes = min(len(plates), os.cpu_count() or 1)
+
+    arguments = [(plate_name, read2, barcode_well_path, chunk_size, max_reads) for plate_name, read2 in plates]
+    if processes <= 1 or len(plates) <= 1:
+        return [count_plate_wells(*plate_arguments) for plate_arguments in arguments]
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        futures = [executor.submit(count_plate_wells, *plate_arguments) for plate_arguments in arguments]
+        return [future.result() for future in futures]
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 5. Writes the count tables
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def write_well_counts(result, output_dir):
+    '''
+    Writes the count table of a plate in output_dir/{plate_name}_well_counts.csv and returns its path.
+
+    result: Result of the plate (see count_plate_wells).
+    output_dir: Output directory.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    counts_path = os.path.join(output_dir, f"{result['plate_name']}_well_counts.csv")
+    tmp_path = f"{counts_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=COUNT_COLUMNS)
+        writer.writeheader()
+        writer.writerows(result['rows'])
+    os.replace(tmp_path, counts_path)
+    return counts_path
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog -b cell_barcode_well.csv -o OUTPUT_DIR -p PLATE -2 R2.fastq.gz [-p PLATE -2 ...]")
+    parser.add_option("-p", "--plate_name", dest="plate_names", action="append", default=[], help="Name of a plate (repeat for each plate)", metavar="PLATE_NAME")
+    parser.add_option("-2", "--read2", dest="read2", action="append", default=[], help="FastQ Read2 file of the plate (barcode and UMI)", metavar="READ2")
+    parser.add_option("-b", "--barcode_well", dest="barcode_well", help="Barcode file with WellID and BarcodeSequence columns", metavar="BARCODE_WELL")
+    parser.add_option("-o", "--output_dir", dest="output_dir", help="Directory of the count tables", metavar="OUTPUT_DIR")
+    parser.add_option("-n", "--max_reads", dest="max_reads", type="int", default=None, help="Number of reads counted per plate (default: all the reads)", metavar="READS")
+    parser.add_option("-c", "--chunk_size", dest="chunk_size", type="int", default=DEFAULT_CHUNK_SIZE,
+                      help=f"Size in bytes of the blocks read at once per plate (default: {DEFAULT_CHUNK_SIZE})", metavar="BYTES")
+    parser.add_option("-j", "--jobs", dest="jobs", type="int", default=None, help="Number of plates counted at the same time (default: number of CPUs)", metavar="JOBS")
+    (options, args) = parser.parse_args()
+
+    if not options.plate_names or not options.barcode_well or not options.output_dir or len(options.plate_names) != len(options.read2):
+        print("Error: You must provide a barcode file, an output directory, and a Read2 file for each plate.")
+        parser.print_help()
+        sys.exit(1)
+
+    results = count_plates_in_parallel(list(zip(options.plate_names, options.read2)), options.barcode_well,
+                                       chunk_size=options.chunk_size, max_reads=options.max_reads, processes=options.jobs)
+
+    for result in results:
+        counts_path = write_well_counts(result, options.output_dir)
+        reads = max(result['reads'], 1)
+        assigned = sum(row['Reads'] for row in result['rows'])
+        corrected = sum(row['CorrectedReads'] for row in result['rows'])
+        empty_wells = sum(row['Reads'] == 0 for row in result['rows'])
+        print(f"Plate {result['plate_name']} : {result['reads']} reads in {result['duration']} s, {assigned / reads:.1%} assigned to a well "
+              f"({corrected / reads:.1%} with a corrected barcode), {result['ambiguous'] / reads:.1%} ambiguous, {result['unassigned'] / reads:.1%} unassigned, "
+              f"{empty_wells} wells without reads ({counts_path}).")
@@ -0,0 +1,118 @@
+import os
+import sys
+from optparse import OptionParser
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Merges the AIRR tables written by TRUST4 on the shards of a plate (*_barcode_airr.tsv) in the AIRR table of the plate,
+# read by the QC as the table of a TRUST4 run on the whole plate.
+# 1. Function read_airr_table : Reads the header and the lines of a shard table.
+# 2. Function merge_airr_tables : Concatenates the shard tables with a single header and removes the duplicated lines.
+# 3. Writes the merged table.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Column of the AIRR tables identifying a contig
+COLUMN_SEQUENCE_ID = "sequence_id"
+# Columns of the AIRR table written by TRUST4 (--barcode), used as header when no shard has a table (plate without reads),
+# so that the table of the plate is always a table with its header as when TRUST4 runs on the whole plate
+TRUST4_AIRR_COLUMNS = ["sequence_id", "sequence", "rev_comp", "productive", "v_call", "d_call", "j_call", "c_call",
+                       "sequence_alignment", "germline_alignment", "cdr1", "cdr2", "junction", "junction_aa",
+                       "v_cigar", "d_cigar", "j_cigar", "v_identity", "j_identity", "cell_id", "complete_vdj", "consensus_count"]
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function read_airr_table : Reads the header and the lines of a shard table.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def read_airr_table(airr_path):
+    '''
+    Returns the header and the lines (without the end of line) of an AIRR table.
+    An empty file (shard without reads, TRUST4 not launched) gives (None, []).
+
+    airr_path: Path to the *_barcode_airr.tsv file of a shard.
+    '''
+    with open(airr_path, 'r') as file:
+        lines = file.read().splitlines()
+    if not lines:
+        return None, []
+    return lines[0], [line for line in lines[1:] if line]
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function merge_airr_tables : Concatenates the shard tables with a single header.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def merge_airr_tables(airr_paths):
+    '''
+    Concatenates the AIRR tables of the shards, in the order of airr_paths, and removes the lines present several times.
+    Returns the header (None if all the tables are empty), the lines, the number of duplicated lines removed and the
+    number of contigs (sequence_id) found with different lines in several shards.
+
+    airr_paths: Paths to the *_barcode_airr.tsv files of the shards.
+    '''
+    header = None
+    lines = []
+    seen_lines = set()
+    duplicated = 0
+    for airr_path in airr_paths:
+        shard_header, shard_lines = read_airr_table(airr_path)
+        if shard_header is None:
+            continue
+        if header is None:
+            header = shard_header
+        elif shard_header != header:
+            raise ValueError(f"The columns of {airr_path} are not the columns of the other shards.")
+        for line in shard_lines:
+            if line in seen_lines:
+                duplicated += 1
+                continue
+            seen_lines.add(line)
+            lines.append(line)
+
+    # The wells are split between the shards : a contig found in several shards indicates shards of different runs
+    conflicts = 0
+    if header is not None and COLUMN_SEQUENCE_ID in header.split("\t"):
+        position = header.split("\t").index(COLUMN_SEQUENCE_ID)
+        sequence_ids = set()
+        for line in lines:
+            sequence_id = line.split("\t")[position]
+            if sequence_id in sequence_ids:
+                conflicts += 1
+            sequence_ids.add(sequence_id)
+    return header, lines, duplicated, conflicts
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Writes the merged table
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def write_airr_table(header, lines, output_path):
+    '''
+    Writes the merged AIRR table. The header is always written (columns of TRUST4 if no shard has a table), the table
+    is read by split_airr_table.py and by the checks of 01_prepareData.R.
+
+    header: Header of the table (None if all the tables are empty).
+    lines: Lines of the table.
+    output_path: Path to the merged table ({plate_name}_barcode_airr.tsv).
+    '''
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    tmp_path = f"{output_path}.{os.getpid()}.tmp"
+    if header is None:
+        header = "\t".join(TRUST4_AIRR_COLUMNS)
+    with open(tmp_path, 'w') as file:
+        file.write("\n".join([header] + lines) + "\n")
+    os.replace(tmp_path, output_path)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog -o PLATE_barcode_airr.tsv SHARD_barcode_airr.tsv [SHARD_barcode_airr.tsv ...]")
+    parser.add_option("-o", "--output", dest="output", help="Path to the merged AIRR table of the plate", metavar="OUTPUT")
+    (options, args) = parser.parse_args()
+
+    if not options.output or not args:
+        print("Error: You must provide the merged table and the AIRR tables of the shards.")
+        parser.print_help()
+        sys.exit(1)
+
+    header, lines, duplicated, conflicts = merge_airr_tables(args)
+    write_airr_table(header, lines, options.output)
+    if header is None:
+        print(f"WARNING: The AIRR tables of the shards are all empty, {options.output} only contains the header of the TRUST4 tables.")
+    if conflicts:
+        print(f"WARNING: {conflicts} contigs ({COLUMN_SEQUENCE_ID}) are found in several shards with different lines.")
+    print(f"{len(lines)} lines from {len(args)} shards written in {options.output} ({duplicated} duplicated lines removed).")
@@ -0,0 +1,263 @@
+import gzip
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import zlib
+from optparse import OptionParser
+
+# The barcode functions are shared with the pre-flight scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "01_preflightCheck"))
+from fastq_preflight import BARCODE_LENGTH
+from well_read_counts import BASES, load_wells, build_barcode_index, open_fastq_stream
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Splits the FastQ pair of a plate in K shards by well, so that TRUST4 runs on the shards as separate jobs.
+# The FastQ files are read once; all the reads of a well (exact or corrected barcode) go to the same shard,
+# so that each cell is assembled in a single shard and the merged AIRR table is the one of the whole plate.
+# 1. Function build_shard_table : Gives the shard of each barcode of the wells and of their Hamming distance 1 neighbours.
+# 2. Class ShardWriter : Writes the compressed FastQ files of a shard (pigz in another process when installed).
+# 3. Function shard_plate : Reads the R1/R2 pair once and writes the reads in the shards.
+# 4. Writes the summary of the shards (reads and wells per shard).
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Number of reads kept in memory for a shard before writing them
+BUFFER_READS = 4096
+# Compression level of the shards (temporary files, read once by TRUST4)
+COMPRESS_LEVEL = 1
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function build_shard_table : Gives the shard of each barcode.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def decode_barcode(code):
+    '''
+    Returns the sequence (bytes) of a barcode packed in an integer (see encode_barcode).
+
+    code: Packed barcode (2 bits per base, the first base in the high bits).
+    '''
+    return bytes(BASES[(code >> (2 * (BARCODE_LENGTH - 1 - position))) & 3] for position in range(BARCODE_LENGTH))
+
+def build_shard_table(barcodes, shards):
+    '''
+    Returns a dictionary barcode sequence (bytes) -> shard, for the barcodes of the wells and their Hamming distance 1
+    neighbours assigned to a single well (same rule as the well counts). The wells are given to the shards in turn
+    (well index modulo the number of shards). The other barcodes are not in the table (see get_shard).
+
+    barcodes: List of the barcodes of the wells (in the order of the wells).
+    shards: Number of shards.
+    '''
+    well_number = len(barcodes)
+    index = build_barcode_index(barcodes)
+    table = {}
+    for code, value in enumerate(index[:-1].tolist()):
+        if value < 2 * well_number:
+            table[decode_barcode(code)] = (value % well_number) % shards
+    return table
+
+def get_shard(barcode, shard_table, shards):
+    '''
+    Returns the shard of a read from its barcode. A barcode which is not assigned to a well always goes to the same
+    shard (checksum of the barcode), so that TRUST4 sees all its reads together as on the whole plate.
+
+    barcode: First bases of the R2 sequence (bytes).
+    shard_table: Dictionary returned by build_shard_table.
+    shards: Number of shards.
+    '''
+    shard = shard_table.get(barcode)
+    if shard is None:
+        shard = zlib.crc32(barcode) % shards
+    return shard
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Class ShardWriter : Writes the compressed FastQ files of a shard.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+class ShardWriter:
+    '''
+    Writes a gzip FastQ file in a temporary file, renamed at the end (close). The compression is done by pigz in
+    another process when it is installed, by the gzip module otherwise. The records are written by blocks.
+
+    path: Path to the FastQ file (.fastq.gz).
+    threads: Number of compression threads of pigz.
+    '''
+    def __init__(self, path, threads=1):
+        self.path = path
+        self.tmp_path = f"{path}.{os.getpid()}.tmp"
+        self.records = []
+        self.reads = 0
+        self.file = open(self.tmp_path, 'wb')
+        pigz = shutil.which("pigz")
+        if pigz:
+            self.process = subprocess.Popen([pigz, f"-{COMPRESS_LEVEL}", "-p", str(threads), "-c"], stdin=subprocess.PIPE,
+                                            stdout=self.file, stderr=subprocess.PIPE)
+            self.stream = self.process.stdin
+        else:
+            self.process = None
+            self.stream = gzip.GzipFile(fileobj=self.file, mode='wb', compresslevel=COMPRESS_LEVEL)
+
+    def add(self, record):
+        '''
+        Adds a FastQ record (4 lines, bytes) to the file.
+
+        record: FastQ record.
+        '''
+        self.records.append(record)
+        if len(self.records) >= BUFFER_READS:
+            self.flush()
+
+    def flush(self):
+        '''
+        Writes the records kept in memory.
+        '''
+        self.stream.write(b"".join(self.records))
+        self.reads += len(self.records)
+        self.records = []
+
+    def close(self, keep=True):
+        '''
+        Writes the last records, ends the compression and renames the temporary file (removed if keep is False).
+
+        keep: Keep the file (False when the sharding failed).
+        '''
+        try:
+            if keep:
+                self.flush()
+            self.stream.close()
+            if self.process is not None:
+                self.process.wait()
+                if self.process.returncode != 0 and keep:
+                    raise OSError(f"pigz failed on {self.path} : {self.process.stderr.read().decode(errors='replace').strip()}")
+        finally:
+            self.file.close()
+            if keep:
+                os.replace(self.tmp_path, self.path)
+            elif os.path.exists(self.tmp_path):
+                os.remove(self.tmp_path)
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function shard_plate : Reads the R1/R2 pair once and writes the reads in the shards.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def shard_paths(output_dir, plate_name, shard):
+    '''
+    Returns the paths of the R1 and R2 files of a shard (names used by the trust4_shard rule of the workflow).
+
+    output_dir: Directory of the shards.
+    plate_name: Name of the plate.
+    shard: Index of the shard (0 to K-1).
+    '''
+    return (os.path.join(output_dir, f"{plate_name}_shard{shard}_R1.fastq.gz"),
+            os.path.join(output_dir, f"{plate_name}_shard{shard}_R2.fastq.gz"))
+
+def shard_plate(plate_name, fastq_read1, fastq_read2, barcode_well_path, output_dir, shards, threads=1):
+    '''
+    Splits the reads of a plate in shards by well. R1 and R2 are read together, record by record, and each read pair
+    is written in the shard of its barcode (start of R2). Returns the summary of the shards.
+
+    plate_name: Name of the plate.
+    fastq_read1: Path to the FastQ Read1 file of the plate (cDNA).
+    fastq_read2: Path to the FastQ Read2 file of the plate (barcode and UMI).
+    barcode_well_path: Path to the barcode file (cell_barcode_well.csv).
+    output_dir: Directory of the shards.
+    shards: Number of shards.
+    threads: Number of threads used by the compression of each shard file.
+    '''
+    start = time.monotonic()
+    wells = load_wells(barcode_well_path)
+    if shards < 1 or shards > len(wells):
+        raise ValueError(f"The number of shards ({shards}) must be between 1 and the number of wells ({len(wells)}).")
+    shard_table = build_shard_table([barcode for _, barcode in wells], shards)
+
+    os.makedirs(output_dir, exist_ok=True)
+    writers = []
+    stream1, process1 = open_fastq_stream(fastq_read1)
+    stream2, process2 = open_fastq_stream(fastq_read2)
+    success = False
+    try:
+        for shard in range(shards):
+            path1, path2 = shard_paths(output_dir, plate_name, shard)
+            writers.append((ShardWriter(path1, threads), ShardWriter(path2, threads)))
+
+        reads = 0
+        while True:
+            record2 = [stream2.readline(), stream2.readline(), stream2.readline(), stream2.readline()]
+            record1 = [stream1.readline(), stream1.readline(), stream1.readline(), stream1.readline()]
+            if not record2[0] or not record1[0]:
+                if record2[0] or record1[0]:
+                    raise ValueError(f"The FastQ files of the plate {plate_name} do not have the same number of reads ({reads} reads in the shortest one).")
+                break
+            if not record2[3] or not record1[3] or record1[0][:1] != b"@" or record2[0][:1] != b"@":
+                raise ValueError(f"The FastQ files of the plate {plate_name} are not valid (truncated or malformed record after {reads} reads).")
+            writer1, writer2 = writers[get_shard(record2[1][:BARCODE_LENGTH], shard_table, shards)]
+            writer1.add(b"".join(record1))
+            writer2.add(b"".join(record2))
+            reads += 1
+        success = True
+    finally:
+        # The shards are only kept if the decompression of both files succeeded
+        pigz_error = None
+        for stream, process, fastq_path in ((stream1, process1, fastq_read1), (stream2, process2, fastq_read2)):
+            stream.close()
+            if process is not None:
+                process.wait()
+                if success and process.returncode != 0 and pigz_error is None:
+                    pigz_error = f"pigz failed on {fastq_path} : {process.stderr.read().decode(errors='replace').strip()}"
+        success = success and pigz_error is None
+        for writer1, writer2 in writers:
+            writer1.close(keep=success)
+            writer2.close(keep=success)
+    if pigz_error:
+        raise OSError(pigz_error)
+
+    shard_wells = [[] for _ in range(shards)]
+    for well, (well_id, _) in enumerate(wells):
+        shard_wells[well % shards].append(well_id)
+
+    return {
+        'plate_name': plate_name,
+        'shards': shards,
+        'reads': reads,
+        'shard_reads': [writer1.reads for writer1, _ in writers],
+        'shard_wells': shard_wells,
+        'duration': round(time.monotonic() - start, 1)
+    }
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Writes the summary of the shards
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def write_shard_summary(summary, output_dir):
+    '''
+    Writes the summary of the shards in output_dir/{plate_name}_shards.json and returns its path.
+
+    summary: Summary returned by shard_plate.
+    output_dir: Directory of the shards.
+    '''
+    summary_path = os.path.join(output_dir, f"{summary['plate_name']}_shards.json")
+    tmp_path = f"{summary_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(summary, file, indent=2)
+    os.replace(tmp_path, summary_path)
+    return summary_path
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog -p PLATE -1 R1.fastq.gz -2 R2.fastq.gz -b cell_barcode_well.csv -k SHARDS -o OUTPUT_DIR")
+    parser.add_option("-p", "--plate_name", dest="plate_name", help="Name of the plate", metavar="PLATE_NAME")
+    parser.add_option("-1", "--read1", dest="read1", help="FastQ Read1 file of the plate (cDNA)", metavar="READ1")
+    parser.add_option("-2", "--read2", dest="read2", help="FastQ Read2 file of the plate (barcode and UMI)", metavar="READ2")
+    parser.add_option("-b", "--barcode_well", dest="barcode_well", help="Barcode file with WellID and BarcodeSequence columns", metavar="BARCODE_WELL")
+    parser.add_option("-k", "--shards", dest="shards", type="int", help="Number of shards", metavar="SHARDS")
+    parser.add_option("-o", "--output_dir", dest="output_dir", help="Directory of the shards", metavar="OUTPUT_DIR")
+    parser.add_option("-t", "--threads", dest="threads", type="int", default=1, help="Compression threads per shard file (default: 1)", metavar="THREADS")
+    (options, args) = parser.parse_args()
+
+    if not options.plate_name or not options.read1 or not options.read2 or not options.barcode_well or not options.shards or not options.output_dir:
+        print("Error: You must provide the plate name, the FastQ files, the barcode file, the number of shards and the output directory.")
+        parser.print_help()
+        sys.exit(1)
+
+    summary = shard_plate(options.plate_name, options.read1, options.read2, options.barcode_well, options.output_dir,
+                          options.shards, threads=options.threads)
+    summary_path = write_shard_summary(summary, options.output_dir)
+    print(f"Plate {summary['plate_name']} : {summary['reads']} reads split in {summary['shards']} shards in {summary['duration']} s "
+          f"(reads per shard : {', '.join(str(reads) for reads in summary['shard_reads'])}), summary written in {summary_path}.")
@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+from optparse import OptionParser
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Prepares the TRUST4 results of a plate for the QC : the AIRR table of the plate (*_barcode_airr.tsv, with the contig
+# sequences when TRUST4 is run with --repseq) is read once, line by line, and split in a BCR table and a TCR table
+# with only the columns used by the QC scripts (09_computeTrust4BCR.R, 10_computeTrust4TCR.R).
+# The QC then reads small tables instead of the whole AIRR table of each plate.
+# 1. Function find_columns : Checks the header of the AIRR table and gives the position of the columns kept.
+# 2. Function split_airr_table : Streams the AIRR table and writes the BCR and TCR tables.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Columns of the AIRR table used by the QC (COLUMN_HEADER_* of analysisParams.R), in the order of the tables written
+COLUMN_CELL_ID = "cell_id"
+COLUMN_V_CALL = "v_call"
+COLUMN_PRODUCTIVE = "productive"
+KEPT_COLUMNS = [COLUMN_CELL_ID, "c_call", COLUMN_V_CALL, "j_call", COLUMN_PRODUCTIVE]
+# Chain types : a line goes in a table if its v_call contains the pattern (same selection as the QC before : grepl on v_call)
+CHAIN_PATTERNS = {"BCR": "IG", "TCR": "TR"}
+# Values of the productive column meaning a productive contig (read as TRUE by R)
+PRODUCTIVE_VALUES = {"T", "TRUE", "True", "true"}
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function find_columns : Gives the position of the columns kept.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def find_columns(header_line, airr_path):
+    '''
+    Returns the position of each column of KEPT_COLUMNS in the header of the AIRR table.
+    Raises a ValueError (as the column checks of 01_prepareData.R) if a column is missing.
+
+    header_line: First line of the AIRR table.
+    airr_path: Path to the AIRR table (for the error message).
+    '''
+    columns = header_line.rstrip("\r\n").split("\t")
+    missing = [column for column in KEPT_COLUMNS if column not in columns]
+    if missing:
+        raise ValueError(f"The columns {', '.join(missing)} are not found in the AIRR table {airr_path} (TRUST4 output).")
+    return [columns.index(column) for column in KEPT_COLUMNS]
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function split_airr_table : Streams the AIRR table and writes the BCR and TCR tables.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def split_airr_table(plate_name, airr_path, output_dir):
+    '''
+    Reads the AIRR table of a plate line by line and writes output_dir/{plate_name}_BCR.tsv and {plate_name}_TCR.tsv
+    (columns of KEPT_COLUMNS, lines whose v_call contains IG or TR). The tables are always written, with a header only
+    if the plate has no contig of this type. Returns the summary of the plate, printed in the log
+    of the rule (number of contigs, and number of contigs, productive contigs and cells of each chain type).
+
+    plate_name: Name of the plate.
+    airr_path: Path to the AIRR table of the plate (*_barcode_airr.tsv).
+    output_dir: Directory of the tables.
+    '''
+    start = time.monotonic()
+    os.makedirs(output_dir, exist_ok=True)
+    summary = {"Contigs": 0}
+    cells = {chain: set() for chain in CHAIN_PATTERNS}
+    paths = {chain: os.path.join(output_dir, f"{plate_name}_{chain}.tsv") for chain in CHAIN_PATTERNS}
+    tmp_paths = {chain: f"{path}.{os.getpid()}.tmp" for chain, path in paths.items()}
+    files = {}
+    success = False
+    try:
+        for chain in CHAIN_PATTERNS:
+            files[chain] = open(tmp_paths[chain], 'w', newline='')
+            files[chain].write("\t".join(KEPT_COLUMNS) + "\n")
+            summary[f"{chain}_Contigs"] = 0
+            summary[f"{chain}_Productive"] = 0
+
+        with open(airr_path, 'r') as airr_file:
+            header_line = airr_file.readline()
+            if not header_line.strip():
+                raise ValueError(f"The AIRR table {airr_path} (TRUST4 output) is empty.")
+            positions = find_columns(header_line, airr_path)
+            cell_position = KEPT_COLUMNS.index(COLUMN_CELL_ID)
+            v_call_position = KEPT_COLUMNS.index(COLUMN_V_CALL)
+            productive_position = KEPT_COLUMNS.index(COLUMN_PRODUCTIVE)
+            last_position = max(positions)
+
+            for line in airr_file:
+                # The columns after the last column kept (sequences of --repseq) are not split
+                fields = line.rstrip("\r\n").split("\t", last_position + 1)
+                if len(fields) == 1 and not fields[0]:
+                    continue
+                # Missing fields at the end of a line are empty (as read by R)
+                if len(fields) <= last_position:
+                    fields += [""] * (last_position + 1 - len(fields))
+                values = [fields[position] for position in positions]
+                summary["Contigs"] += 1
+                for chain, pattern in CHAIN_PATTERNS.items():
+                    if pattern in values[v_call_position]:
+                        files[chain].write("\t".join(values) + "\n")
+                        summary[f"{chain}_Contigs"] += 1
+                        summary[f"{chain}_Productive"] += values[productive_position] in PRODUCTIVE_VALUES
+                        cells[chain].add(values[cell_position])
+        success = True
+    finally:
+        for chain, file in files.items():
+            file.close()
+            if success:
+                os.replace(tmp_paths[chain], paths[chain])
+            else:
+                os.remove(tmp_paths[chain])
+
+    for chain in CHAIN_PATTERNS:
+        summary[f"{chain}_Cells"] = len(cells[chain])
+    summary['duration'] = round(time.monotonic() - start, 1)
+    return summary
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog -p PLATE -i PLATE_barcode_airr.tsv -o OUTPUT_DIR")
+    parser.add_option("-p", "--plate_name", dest="plate_name", help="Name of the plate", metavar="PLATE_NAME")
+    parser.add_option("-i", "--input", dest="input", help="AIRR table of the plate (TRUST4 output)", metavar="AIRR_TSV")
+    parser.add_option("-o", "--output_dir", dest="output_dir", help="Directory of the BCR/TCR tables", metavar="OUTPUT_DIR")
+    (options, args) = parser.parse_args()
+
+    if not options.plate_name or not options.input or not options.output_dir:
+        print("Error: You must provide the plate name, the AIRR table and the output directory.")
+        parser.print_help()
+        sys.exit(1)
+
+    summary = split_airr_table(options.plate_name, options.input, options.output_dir)
+    print(f"Plate {options.plate_name} : {summary['Contigs']} contigs read in {summary['duration']} s, "
+          + ", ".join(f"{chain} {summary[f'{chain}_Contigs']} contigs / {summary[f'{chain}_Cells']} cells" for chain in CHAIN_PATTERNS)
+          + ".")
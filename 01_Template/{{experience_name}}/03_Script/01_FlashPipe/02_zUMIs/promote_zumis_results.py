@@ -0,0 +1,205 @@
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from optparse import OptionParser
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Promotes the results of zUMIs of a plate from the temporary directory of zUMIs (outdir_temp, local scratch) to the
+# project (05_Output/01_FlashPipe/01_zUMIs/{plate}) : only the files declared in PROMOTED_ARTIFACTS are kept
+# (expression tables and statistics, the BAM files on demand), instead of a copy of the whole output of zUMIs.
+# 1. Function select_artifacts : Lists the files of the zUMIs output to promote, and checks the required ones.
+# 2. Function promote_file : Moves a file (rename on the same filesystem), or copies it with a checksum on another one.
+# 3. Function promote_results : Promotes the files of a plate (copies in parallel), writes the promotion manifest
+#    of the plate and frees the scratch directory.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Files of the zUMIs output promoted to the project, by group (patterns relative to the output directory of the plate)
+PROMOTED_ARTIFACTS = {
+    # Count tables read by the QC (01_prepareData.R, 02_formatCountTable.R) and the other expression files
+    "expression": ["zUMIs_output/expression/*"],
+    # Statistics and logs of the run (reads per cell, features, barcodes kept)
+    "stats": ["zUMIs_output/stats/*", "zUMIs_output/*.txt", "*.txt", "*.log"],
+    # Aligned reads, only promoted with --keep_bam (zumis_keep_bam in the config file)
+    "bam": ["*.bam", "*.bam.bai", "*.bai"]
+}
+# Files required by the QC : the promotion fails (scratch kept) if one is missing
+REQUIRED_ARTIFACTS = ["zUMIs_output/expression/{plate_name}.dgecounts.rds", "zUMIs_output/expression/{plate_name}.gene_names.txt"]
+# Promotion manifest of the plate (written in the output directory of the plate)
+MANIFEST_NAME = "{plate_name}_promotion.json"
+# Size of the blocks copied
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function select_artifacts : Lists the files to promote.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def select_artifacts(plate_name, source_dir, groups):
+    '''
+    Returns the list of (relative path, group) of the files of source_dir matching the patterns of the groups.
+    A pattern only matches the files of its directory (no recursion). Raises a ValueError if a required file is missing.
+
+    plate_name: Name of the plate.
+    source_dir: Output directory of zUMIs for the plate.
+    groups: Groups of PROMOTED_ARTIFACTS to promote.
+    '''
+    missing = [path.format(plate_name=plate_name) for path in REQUIRED_ARTIFACTS
+               if not os.path.isfile(os.path.join(source_dir, path.format(plate_name=plate_name)))]
+    if missing:
+        raise ValueError(f"The zUMIs output of the plate {plate_name} is not complete, missing in {source_dir} : {', '.join(missing)}.")
+
+    selected = {}
+    for group in groups:
+        for pattern in PROMOTED_ARTIFACTS[group]:
+            directory, file_pattern = os.path.split(pattern)
+            directory_path = os.path.join(source_dir, directory)
+            if not os.path.isdir(directory_path):
+                continue
+            for file_name in sorted(os.listdir(directory_path)):
+                relative_path = os.path.join(directory, file_name)
+                if fnmatch.fnmatch(file_name, file_pattern) and os.path.isfile(os.path.join(source_dir, relative_path)):
+                    selected.setdefault(relative_path, group)
+    return sorted(selected.items())
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function promote_file : Moves or copies a file to the project.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def file_digest(file_path):
+    '''
+    Returns the SHA-256 hash of the content of a file (read by blocks).
+
+    file_path: Path to the file.
+    '''
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(BUFFER_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def copy_with_digest(source_file, destination_file):
+    '''
+    Copies source_file in destination_file and returns the SHA-256 of the data read (computed during the copy).
+
+    source_file: Path to the file to copy.
+    destination_file: Path to the copy.
+    '''
+    digest = hashlib.sha256()
+    with open(source_file, 'rb') as source, open(destination_file, 'wb') as destination:
+        for block in iter(lambda: source.read(BUFFER_SIZE), b''):
+            digest.update(block)
+            destination.write(block)
+    shutil.copystat(source_file, destination_file)
+    return digest.hexdigest()
+
+def promote_file(source_file, destination_file):
+    '''
+    Promotes a file to the project. On the same filesystem, the file is renamed (no data written). On another
+    filesystem, it is copied in a temporary file, the copy is read again and compared with the checksum of the source,
+    then renamed : the destination is never a partial copy. Returns a dictionary : size, method (rename or copy),
+    sha256 (None for a rename).
+
+    source_file: Path to the file in the zUMIs output.
+    destination_file: Path to the file in the project.
+    '''
+    os.makedirs(os.path.dirname(destination_file), exist_ok=True)
+    size = os.path.getsize(source_file)
+    if os.stat(source_file).st_dev == os.stat(os.path.dirname(destination_file)).st_dev:
+        os.replace(source_file, destination_file)
+        return {'size': size, 'method': "rename", 'sha256': None}
+
+    tmp_path = f"{destination_file}.{os.getpid()}.tmp"
+    try:
+        source_digest = copy_with_digest(source_file, tmp_path)
+        if file_digest(tmp_path) != source_digest:
+            raise OSError(f"The copy of {source_file} in {destination_file} is corrupted (checksum mismatch).")
+        os.replace(tmp_path, destination_file)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return {'size': size, 'method': "copy", 'sha256': source_digest}
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function promote_results : Promotes the files of a plate and frees the scratch directory.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def promote_results(plate_name, source_dir, destination_dir, keep_bam=False, threads=1, free_scratch=True):
+    '''
+    Promotes the declared files of the zUMIs output of a plate (see PROMOTED_ARTIFACTS) to destination_dir, with the
+    same relative paths. The copies (other filesystem) run in parallel. Once all the files are promoted, the promotion
+    manifest ({plate}_promotion.json : files, groups, sizes, methods, checksums) is written and the scratch directory
+    is removed (with the files not promoted). On failure, the scratch directory is kept.
+    Returns the manifest.
+
+    plate_name: Name of the plate.
+    source_dir: Output directory of zUMIs for the plate (outdir_temp/{plate}).
+    destination_dir: Directory of the plate in the project (05_Output/01_FlashPipe/01_zUMIs/{plate}).
+    keep_bam: If True, the BAM files are also promoted.
+    threads: Number of files copied at the same time.
+    free_scratch: If True, source_dir is removed once the files are promoted.
+    '''
+    start = time.monotonic()
+    groups = [group for group in PROMOTED_ARTIFACTS if keep_bam or group != "bam"]
+    artifacts = select_artifacts(plate_name, source_dir, groups)
+    os.makedirs(destination_dir, exist_ok=True)
+
+    def promote(artifact):
+        relative_path, group = artifact
+        result = promote_file(os.path.join(source_dir, relative_path), os.path.join(destination_dir, relative_path))
+        return dict(result, path=relative_path, group=group)
+
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as executor:
+        files = list(executor.map(promote, artifacts))
+
+    scratch_bytes = 0
+    if free_scratch:
+        for root, _, file_names in os.walk(source_dir):
+            scratch_bytes += sum(os.path.getsize(os.path.join(root, file_name)) for file_name in file_names
+                                 if not os.path.islink(os.path.join(root, file_name)))
+        shutil.rmtree(source_dir)
+
+    manifest = {
+        'plate_name': plate_name,
+        'source_dir': os.path.abspath(source_dir),
+        'groups': groups,
+        'files': files,
+        'bytes_promoted': sum(file['size'] for file in files),
+        'bytes_copied': sum(file['size'] for file in files if file['method'] == "copy"),
+        'scratch_freed': free_scratch,
+        'scratch_bytes_freed': scratch_bytes,
+        'duration': round(time.monotonic() - start, 1)
+    }
+    manifest_path = os.path.join(destination_dir, MANIFEST_NAME.format(plate_name=plate_name))
+    tmp_path = f"{manifest_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(tmp_path, manifest_path)
+    return manifest
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog -p PLATE -i ZUMIS_OUTPUT_DIR -o PLATE_OUTPUT_DIR [--keep_bam] [-t THREADS] [--keep_scratch]")
+    parser.add_option("-p", "--plate_name", dest="plate_name", help="Name of the plate", metavar="PLATE_NAME")
+    parser.add_option("-i", "--input_dir", dest="input_dir", help="Output directory of zUMIs for the plate (outdir_temp/PLATE)", metavar="ZUMIS_OUTPUT_DIR")
+    parser.add_option("-o", "--output_dir", dest="output_dir", help="Directory of the plate in the project (05_Output/01_FlashPipe/01_zUMIs/PLATE)", metavar="PLATE_OUTPUT_DIR")
+    parser.add_option("--keep_bam", dest="keep_bam", action="store_true", default=False, help="Also promote the BAM files")
+    parser.add_option("-t", "--threads", dest="threads", type="int", default=4, help="Number of files copied at the same time (other filesystem)", metavar="THREADS")
+    parser.add_option("--keep_scratch", dest="keep_scratch", action="store_true", default=False,
+                      help="Keep the output directory of zUMIs after the promotion (the files promoted are moved or copied)")
+    (options, args) = parser.parse_args()
+
+    if not options.plate_name or not options.input_dir or not options.output_dir:
+        print("Error: You must provide the plate name, the zUMIs output directory and the output directory.")
+        parser.print_help()
+        sys.exit(1)
+
+    try:
+        manifest = promote_results(options.plate_name, options.input_dir, options.output_dir, keep_bam=options.keep_bam,
+                                   threads=options.threads, free_scratch=not options.keep_scratch)
+    except (ValueError, OSError) as e:
+        print(f"ERROR: {e}")
+        sys.exit(1)
+    print(f"Plate {options.plate_name} : {len(manifest['files'])} files promoted ({manifest['bytes_promoted'] / 1024 ** 2:.1f} MB, "
+          f"{manifest['bytes_copied'] / 1024 ** 2:.1f} MB copied) in {manifest['duration']} s"
+          + (f", {manifest['scratch_bytes_freed'] / 1024 ** 2:.1f} MB of scratch freed." if manifest['scratch_freed'] else "."))
@@ -0,0 +1,341 @@
+import contextlib
+import glob
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import threading
+import time
+import zipfile
+from optparse import OptionParser
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Prepares the zUMIs tool (zUMIs-2.9.7.zip and its miniconda environment in zUMIs-miniconda.parta*) in a cache local
+# to the node, shared by all the experiments : the tool is extracted once per archive (directory named by the SHA-256
+# of the archive), and the next jobs only point the zUMIs directory of the workflow ({outdir_temp}/zUMIs-2.9.7) to it.
+# 1. Function archive_hash : SHA-256 of the archive, cached by device, inode, size and modification time.
+# 2. Function extract_tool : Extracts the archive in a temporary directory, inflates the miniconda environment
+#    (parts streamed to a parallel bzip2 when available, no intermediate .tar.bz2) and renames the directory when complete.
+# 3. Function prepare_tool : Under the lock of the cache (the concurrent jobs wait instead of extracting again),
+#    extracts the tool if not already in the cache and points the zUMIs directory to it.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# File written in a tool directory once completely extracted
+READY_MARKER = ".flashpipe_tool.json"
+# Hashes of the archives already read
+HASH_CACHE_FILE = "archive_hashes.json"
+# Parts of the miniconda environment of zUMIs, inflated in ENVIRONMENT_DIRECTORY
+MINICONDA_PARTS = "zUMIs-miniconda.parta*"
+ENVIRONMENT_DIRECTORY = "zUMIs-env"
+# Decompressors of bzip2 (in order of preference, the first ones use several threads) : command and option for the threads
+BZIP2_DECOMPRESSORS = [("lbzip2", "-n"), ("pbzip2", "-p"), ("bzip2", None)]
+# Size of the blocks read from the parts
+BUFFER_SIZE = 4 * 1024 * 1024
+
+@contextlib.contextmanager
+def locked(lock_path):
+    '''
+    Context manager holding an exclusive lock (flock) on lock_path : the other jobs of the node wait until it is released.
+    The lock is released when the process dies (no stale lock after a killed job).
+
+    lock_path: Path to the lock file (created if it does not exist).
+    '''
+    import fcntl
+
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function archive_hash : SHA-256 of the archive (cached).
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def archive_hash(archive_path, cache_dir):
+    '''
+    Returns the SHA-256 of the archive. The hash is kept in the cache with the device, inode, size and modification time
+    of the file, so that the archive is only read again when it changed (the archives of the experiments linked to the
+    same file of the container store share their inode, the hash is computed once). Must be called under the lock.
+
+    archive_path: Path to the zUMIs archive.
+    cache_dir: Directory of the tool cache.
+    '''
+    stat = os.stat(archive_path)
+    key = f"{stat.st_dev}:{stat.st_ino}:{stat.st_size}:{stat.st_mtime_ns}"
+    hash_cache_path = os.path.join(cache_dir, HASH_CACHE_FILE)
+    try:
+        with open(hash_cache_path, 'r') as file:
+            hashes = json.load(file)
+    except (OSError, ValueError):
+        hashes = {}
+    if key in hashes:
+        return hashes[key]
+
+    digest = hashlib.sha256()
+    with open(archive_path, 'rb') as file:
+        for block in iter(lambda: file.read(BUFFER_SIZE), b''):
+            digest.update(block)
+    hashes[key] = digest.hexdigest()
+    tmp_path = f"{hash_cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as file:
+        json.dump(hashes, file, indent=1, sort_keys=True)
+    os.replace(tmp_path, hash_cache_path)
+    return hashes[key]
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function extract_tool : Extracts the archive and inflates the miniconda environment.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def extract_zip(archive_path, output_dir):
+    '''
+    Extracts the zip archive in output_dir, with the permissions of its files (lost by zipfile.extractall).
+    Returns the directory of the tool : the top directory of the archive if it has only one (zUMIs-main), output_dir otherwise.
+
+    archive_path: Path to the zip archive.
+    output_dir: Directory in which the archive is extracted.
+    '''
+    with zipfile.ZipFile(archive_path) as archive:
+        for member in archive.infolist():
+            extracted_path = archive.extract(member, output_dir)
+            mode = member.external_attr >> 16
+            if mode and not member.is_dir():
+                os.chmod(extracted_path, mode & 0o7777)
+    top_entries = os.listdir(output_dir)
+    if len(top_entries) == 1 and os.path.isdir(os.path.join(output_dir, top_entries[0])):
+        return os.path.join(output_dir, top_entries[0])
+    return output_dir
+
+def inflate_parts(parts, output_dir, threads):
+    '''
+    Extracts the tar.bz2 archive split in parts in output_dir. The parts are streamed (in order) to the first bzip2
+    decompressor available (lbzip2 and pbzip2 use several threads) piped to tar : the concatenated archive is never written.
+    Without any decompressor, the archive is read by the tarfile module (members kept in output_dir). Returns the decompressor used.
+
+    parts: Paths to the parts of the archive, in order.
+    output_dir: Directory in which the archive is extracted.
+    threads: Number of threads of the decompressor.
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    decompressor = next(((command, threads_option) for command, threads_option in BZIP2_DECOMPRESSORS if shutil.which(command)), None)
+    if decompressor is None or not shutil.which("tar"):
+        with ConcatenatedFiles(parts) as stream, tarfile.open(fileobj=stream, mode="r|bz2") as archive:
+            # The members (and the targets of the links) must stay in output_dir : the "data" filter when available
+            # (Python >= 3.9.17), otherwise each member is checked before being extracted
+            if hasattr(tarfile, "data_filter"):
+                archive.extractall(output_dir, filter="data")
+            else:
+                archive.extractall(output_dir, members=checked_members(archive, output_dir))
+        return "tarfile"
+
+    command, threads_option = decompressor
+    decompress_command = [command, "-dc"] + ([threads_option, str(threads)] if threads_option else [])
+    decompress_process = subprocess.Popen(decompress_command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    tar_process = subprocess.Popen(["tar", "-x", "--overwrite", "-f", "-", "-C", output_dir], stdin=decompress_process.stdout)
+    # Only tar reads the output of the decompressor (so that it gets the end of the stream when the decompressor stops)
+    decompress_process.stdout.close()
+
+    # The parts are written by a thread, a stopped tar (error) then stops the decompressor instead of blocking the writer
+    feed_error = []
+    def feed():
+        try:
+            for part in parts:
+                with open(part, 'rb') as file:
+                    shutil.copyfileobj(file, decompress_process.stdin, BUFFER_SIZE)
+        except (OSError, ValueError) as e:
+            feed_error.append(e)
+        finally:
+            with contextlib.suppress(OSError):
+                decompress_process.stdin.close()
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+    tar_returncode = tar_process.wait()
+    if tar_returncode != 0:
+        decompress_process.kill()
+    decompress_returncode = decompress_process.wait()
+    feeder.join()
+
+    if tar_returncode != 0 or decompress_returncode != 0 or feed_error:
+        raise RuntimeError(f"The miniconda environment of zUMIs cannot be inflated ({command} exit code {decompress_returncode}, "
+                           f"tar exit code {tar_returncode}{', ' + str(feed_error[0]) if feed_error else ''}).")
+    return command
+
+def checked_members(archive, output_dir):
+    '''
+    Yields the members of the tar archive (read in order), after checking that they are extracted in output_dir :
+    raises RuntimeError for an absolute path, a path leaving output_dir ('..') or a link pointing outside of it.
+
+    archive: Tar archive opened by tarfile (stream mode).
+    output_dir: Directory in which the archive is extracted.
+    '''
+    output_dir = os.path.realpath(output_dir)
+
+    def inside(path):
+        return os.path.commonpath([output_dir, path]) == output_dir
+
+    for member in archive:
+        member_path = os.path.realpath(os.path.join(output_dir, member.name))
+        if os.path.isabs(member.name) or not inside(member_path):
+            raise RuntimeError(f"The miniconda environment of zUMIs cannot be inflated (member {member.name} outside of the directory).")
+        if member.issym() or member.islnk():
+            # Target of a symbolic link relative to its directory, of a hard link relative to the archive
+            link_dir = os.path.dirname(member_path) if member.issym() else output_dir
+            link_path = os.path.realpath(os.path.join(link_dir, member.linkname))
+            if os.path.isabs(member.linkname) or not inside(link_path):
+                raise RuntimeError(f"The miniconda environment of zUMIs cannot be inflated "
+                                   f"(link {member.name} -> {member.linkname} outside of the directory).")
+        yield member
+
+class ConcatenatedFiles:
+    '''
+    Read-only file object reading several files one after the other (parts of the miniconda archive), for tarfile.
+
+    file_paths: Paths to the files, in order.
+    '''
+
+    def __init__(self, file_paths):
+        self.file_paths = list(file_paths)
+        self.file = None
+
+    def read(self, size=-1):
+        data = b''
+        while size < 0 or len(data) < size:
+            if self.file is None:
+                if not self.file_paths:
+                    break
+                self.file = open(self.file_paths.pop(0), 'rb')
+            block = self.file.read(-1 if size < 0 else size - len(data))
+            if not block:
+                self.file.close()
+                self.file = None
+                continue
+            data += block
+        return data
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def extract_tool(archive_path, tool_dir, digest, threads):
+    '''
+    Extracts the tool in a temporary directory next to tool_dir, inflates its miniconda environment, writes the ready
+    marker and renames the directory to tool_dir : tool_dir is either absent or complete, even if the job is killed.
+    Returns the decompressor used for the environment (None if the archive has no environment).
+
+    archive_path: Path to the zUMIs archive.
+    tool_dir: Directory of the tool in the cache.
+    digest: SHA-256 of the archive.
+    threads: Number of threads of the bzip2 decompressor.
+    '''
+    start = time.monotonic()
+    tmp_dir = f"{tool_dir}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    try:
+        extracted_dir = extract_zip(archive_path, tmp_dir)
+        parts = sorted(glob.glob(os.path.join(extracted_dir, MINICONDA_PARTS)))
+        decompressor = inflate_parts(parts, os.path.join(extracted_dir, ENVIRONMENT_DIRECTORY), threads) if parts else None
+        # Same rights as before (the tool is shared by the users of the node)
+        os.chmod(extracted_dir, 0o777)
+        for root, dirs, file_names in os.walk(extracted_dir):
+            for name in dirs + file_names:
+                path = os.path.join(root, name)
+                if not os.path.islink(path):
+                    os.chmod(path, 0o777)
+        with open(os.path.join(extracted_dir, READY_MARKER), 'w') as file:
+            json.dump({'archive': os.path.abspath(archive_path), 'sha256': digest, 'decompressor': decompressor,
+                       'duration': round(time.monotonic() - start, 1)}, file, indent=1)
+        os.rename(extracted_dir, tool_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return decompressor
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function prepare_tool : Extracts the tool if not in the cache and points the zUMIs directory to it.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def point_link(link_path, tool_dir):
+    '''
+    Points link_path (zUMIs directory used by the workflow) to tool_dir, with an atomic replacement of the symbolic link.
+    A directory extracted by the previous versions of the workflow is renamed (not removed : jobs may still use it).
+
+    link_path: Path to the zUMIs directory of the workflow.
+    tool_dir: Directory of the tool in the cache.
+    '''
+    if os.path.islink(link_path) and os.readlink(link_path) == tool_dir:
+        return
+    if os.path.isdir(link_path) and not os.path.islink(link_path):
+        old_path = f"{link_path}.{os.getpid()}.old"
+        os.rename(link_path, old_path)
+        print(f"The zUMIs directory {link_path} extracted before the tool cache is renamed {old_path} (to remove when unused).")
+    os.makedirs(os.path.dirname(link_path), exist_ok=True)
+    tmp_path = f"{link_path}.{os.getpid()}.tmp"
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(tmp_path)
+    os.symlink(tool_dir, tmp_path)
+    os.replace(tmp_path, link_path)
+
+def prepare_tool(archive_path, cache_dir, link_path, threads=1):
+    '''
+    Makes the zUMIs tool of the archive available in link_path. Under the lock of the cache, the tool is extracted in
+    cache_dir/zUMIs-<hash of the archive> if not already there (left-overs of killed extractions are removed),
+    then link_path is pointed to it. Returns a dictionary : archive, sha256, tool_dir, extracted (True if extracted
+    by this call), decompressor, duration (seconds).
+
+    archive_path: Path to the zUMIs archive (zUMIs-2.9.7.zip).
+    cache_dir: Directory of the tool cache (local to the node).
+    link_path: Path to the zUMIs directory used by the workflow ({outdir_temp}/zUMIs-2.9.7).
+    threads: Number of threads of the bzip2 decompressor.
+    '''
+    start = time.monotonic()
+    cache_dir = os.path.abspath(cache_dir)
+    os.makedirs(cache_dir, exist_ok=True)
+    with locked(os.path.join(cache_dir, ".lock")):
+        digest = archive_hash(archive_path, cache_dir)
+        tool_dir = os.path.join(cache_dir, f"zUMIs-{digest[:16]}")
+        extracted = not os.path.isfile(os.path.join(tool_dir, READY_MARKER))
+        decompressor = None
+        if extracted:
+            # A directory without marker or a temporary directory is left by a killed job (the lock is held)
+            for stale_path in [tool_dir] + glob.glob(f"{tool_dir}.*.tmp"):
+                shutil.rmtree(stale_path, ignore_errors=True)
+            decompressor = extract_tool(archive_path, tool_dir, digest, threads)
+        point_link(os.path.abspath(link_path), tool_dir)
+
+    return {'archive': os.path.abspath(archive_path), 'sha256': digest, 'tool_dir': tool_dir, 'extracted': extracted,
+            'decompressor': decompressor, 'duration': round(time.monotonic() - start, 1)}
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog -a zUMIs-2.9.7.zip -c CACHE_DIR -l ZUMIS_DIR [-r READY_FILE] [-t THREADS]")
+    parser.add_option("-a", "--archive", dest="archive", help="zUMIs archive (02_Container/zUMIs/zUMIs-2.9.7.zip)", metavar="ARCHIVE")
+    parser.add_option("-c", "--cache_dir", dest="cache_dir", help="Directory of the tool cache, local to the node", metavar="CACHE_DIR")
+    parser.add_option("-l", "--link", dest="link", help="zUMIs directory used by the workflow, pointed to the tool of the cache", metavar="ZUMIS_DIR")
+    parser.add_option("-r", "--ready_file", dest="ready_file", default=None,
+                      help="File written when the tool is ready (output of the Snakemake rule)", metavar="READY_FILE")
+    parser.add_option("-t", "--threads", dest="threads", type="int", default=1, help="Threads of the bzip2 decompressor (lbzip2/pbzip2)", metavar="THREADS")
+    (options, args) = parser.parse_args()
+
+    if not options.archive or not options.cache_dir or not options.link:
+        print("Error: You must provide the zUMIs archive, the cache directory and the zUMIs directory.")
+        parser.print_help()
+        sys.exit(1)
+
+    result = prepare_tool(options.archive, options.cache_dir, options.link, threads=options.threads)
+    if result['extracted']:
+        print(f"zUMIs extracted in {result['tool_dir']} in {result['duration']} s (environment inflated with {result['decompressor']}).")
+    else:
+        print(f"zUMIs already in the cache ({result['tool_dir']}), extraction skipped.")
+    if options.ready_file:
+        tmp_path = f"{options.ready_file}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as file:
+            json.dump(result, file, indent=1)
+        os.replace(tmp_path, options.ready_file)
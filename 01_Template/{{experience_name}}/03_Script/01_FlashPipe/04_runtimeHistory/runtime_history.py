@@ -0,0 +1,576 @@
+import json
+import os
+import sqlite3
+import statistics
+import sys
+import time
+from optparse import OptionParser
+import yaml
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Runtime history of the workflow : each rule of the workflow writes a Snakemake benchmark file (wall time, CPU time,
+# max RSS and I/O of the job) in 05_Output/01_FlashPipe/04_Benchmark. The collector ingests the benchmark files of an
+# experiment in a SQLite database shared by the experiments, with the reads of the plate and the resources planned by the
+# structure generation (config.yaml), and reports the throughput of each rule (reads/s/core), the memory outliers and
+# the regressions of an experiment compared with the previous ones, to size the resources of the jobs from the data.
+# The workflow ingests its benchmark files at the end of each run (onsuccess / onerror).
+# 1. Function read_benchmark_file : Reads a Snakemake benchmark file.
+# 2. Function list_benchmark_files : Lists the benchmark files of an experiment (rule, plate, shard).
+# 3. Function plate_reads : Returns the reads of a plate (zUMIs statistics, or estimated at the structure generation).
+# 4. Function job_resources : Returns the reads, threads and memory planned of a job.
+# 5. Function open_history : Opens (and creates) the history database.
+# 6. Function ingest_experiment : Records the benchmark files of an experiment in the history.
+# 7. Function rule_throughput : Throughput and memory of each rule.
+# 8. Function memory_outliers : Jobs whose memory is far from the other jobs of the rule, or from the memory planned.
+# 9. Function experiment_regressions : Compares an experiment with the previous ones.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Directory of the benchmark files in the experiment : {rule}.tsv (rules of the experiment), {rule}/{plate}.tsv
+# (rules of a plate) and {rule}/{plate}/{shard}.tsv (TRUST4 shards), see the benchmark directives of snakefile.yaml
+BENCHMARK_DIR = "05_Output/01_FlashPipe/04_Benchmark"
+CONFIG_PATH = "04_Workflow/01_snakemake/config.yaml"
+# Reads per cell written by zUMIs (promoted to the project with the statistics of the plate)
+ZUMIS_READS_PER_CELL = "05_Output/01_FlashPipe/01_zUMIs/{plate_name}/zUMIs_output/stats/{plate_name}.readspercell.txt"
+# History database : FLASHPIPE_RUNTIME_HISTORY if defined, 00_RuntimeHistory.sqlite next to the template directory otherwise
+HISTORY_ENVIRONMENT_VARIABLE = "FLASHPIPE_RUNTIME_HISTORY"
+HISTORY_FILE_NAME = "00_RuntimeHistory.sqlite"
+SCHEMA_VERSION = 1
+
+# Columns of the Snakemake benchmark files kept in the history (seconds, MB, MB, MB, percent, seconds)
+BENCHMARK_COLUMNS = {'s': 'wall_seconds', 'max_rss': 'max_rss_mb', 'io_in': 'io_in_mb', 'io_out': 'io_out_mb',
+                     'mean_load': 'mean_load', 'cpu_time': 'cpu_seconds'}
+# Reads processed by the job of each rule : all the reads of the plate, of a shard, of the pre-flight check or of the
+# experiment. The throughput of the other rules is not computed.
+RULE_READS = {'zUMIs': "plate", 'trust4': "plate", 'trust4_shard_fastq': "plate", 'trust4_shard': "shard",
+              'well_counts': "plate", 'preflight': "preflight", 'airrflow': "experiment"}
+# Threads and memory planned of the jobs of a plate (keys of plate_resources in config.yaml, the TRUST4 threads are
+# shared between the shards) and threads of the other rules (1 if not listed). Same values as snakefile.yaml.
+RULE_RESOURCES = {'zUMIs': ("zumis_threads", "zumis_mem_mb"), 'trust4': ("trust4_threads", "trust4_mem_mb"),
+                  'trust4_shard': ("trust4_threads", "trust4_mem_mb")}
+RULE_THREADS = {'copy_zUMIS': 8}
+# Parameters of config.yaml recorded with the experiment
+CONFIG_KEYS = ["method", "index_sort_analysis", "bcr_repertoire_analysis", "tcr_repertoire_analysis", "tools_bcr_tcr_analysis",
+               "preflight_reads", "zumis_keep_bam", "fastq_watch", "trust4_shards"]
+# Default factors of the reports : a job using more than OUTLIER_FACTOR times the median memory of its rule, and a rule
+# more than REGRESSION_FACTOR times slower (or using more memory) than in the previous experiments
+OUTLIER_FACTOR = 2.0
+REGRESSION_FACTOR = 1.2
+# A job using less than this part of the memory planned is reported as over-reserved
+OVER_RESERVED_RATIO = 0.25
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS experiments (
+    experiment_id INTEGER PRIMARY KEY,
+    project TEXT NOT NULL,
+    experiment TEXT NOT NULL,
+    path TEXT NOT NULL UNIQUE,
+    config TEXT NOT NULL,
+    ingested_at TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id INTEGER PRIMARY KEY,
+    experiment_id INTEGER NOT NULL REFERENCES experiments (experiment_id),
+    rule TEXT NOT NULL,
+    plate TEXT NOT NULL,
+    shard TEXT NOT NULL,
+    finished_at TEXT NOT NULL,
+    benchmark_mtime INTEGER NOT NULL,
+    reads INTEGER,
+    reads_source TEXT,
+    threads INTEGER NOT NULL,
+    planned_mem_mb INTEGER,
+    wall_seconds REAL,
+    cpu_seconds REAL,
+    max_rss_mb REAL,
+    io_in_mb REAL,
+    io_out_mb REAL,
+    mean_load REAL,
+    UNIQUE (experiment_id, rule, plate, shard, benchmark_mtime)
+);
+CREATE INDEX IF NOT EXISTS jobs_rule ON jobs (rule);
+"""
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function read_benchmark_file : Reads a Snakemake benchmark file.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def read_benchmark_file(file_path):
+    '''
+    Reads a benchmark file written by Snakemake (tab separated, one line per repeat of the job).
+    Returns a dictionary with the columns of BENCHMARK_COLUMNS (mean of the repeats, None if not measured), or None if
+    the file has no measure.
+
+    file_path: Path to the benchmark file.
+    '''
+    with open(file_path, 'r') as file:
+        lines = [line.rstrip('\n').split('\t') for line in file if line.strip()]
+    if len(lines) < 2:
+        return None
+
+    header = lines[0]
+    measures = {}
+    for column, key in BENCHMARK_COLUMNS.items():
+        values = []
+        if column in header:
+            index = header.index(column)
+            for line in lines[1:]:
+                try:
+                    values.append(float(line[index]))
+                # NA or - when the measure is not available (job too short, no access to /proc)
+                except (IndexError, ValueError):
+                    pass
+        measures[key] = sum(values) / len(values) if values else None
+    return measures
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function list_benchmark_files : Lists the benchmark files of an experiment.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def list_benchmark_files(experience_path):
+    '''
+    Lists the benchmark files of the experiment.
+    Returns a list of (rule, plate, shard, file path), plate and shard being '' when the job is not one of a plate / shard.
+
+    experience_path: Path to the experiment directory.
+    '''
+    benchmark_dir = os.path.join(experience_path, BENCHMARK_DIR)
+    if not os.path.isdir(benchmark_dir):
+        return []
+
+    benchmark_files = []
+    for root, dirs, files in os.walk(benchmark_dir):
+        dirs.sort()
+        parts = os.path.relpath(root, benchmark_dir).split(os.sep)
+        for file_name in sorted(files):
+            if not file_name.endswith('.tsv'):
+                continue
+            name = file_name[:-len('.tsv')]
+            file_path = os.path.join(root, file_name)
+            if parts == ['.']:
+                benchmark_files.append((name, '', '', file_path))
+            elif len(parts) == 1:
+                benchmark_files.append((parts[0], name, '', file_path))
+            elif len(parts) == 2:
+                benchmark_files.append((parts[0], parts[1], name, file_path))
+    return benchmark_files
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function plate_reads : Returns the reads of a plate.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def plate_reads(experience_path, plate, config):
+    '''
+    Returns (reads, source) : the reads counted by zUMIs (sum of the reads per cell) when the statistics of the plate are
+    in the project, the reads estimated from the size of the FastQ files at the structure generation otherwise.
+
+    experience_path: Path to the experiment directory.
+    plate: Name of the plate.
+    config: Content of config.yaml.
+    '''
+    reads_per_cell = os.path.join(experience_path, ZUMIS_READS_PER_CELL.format(plate_name=plate))
+    if os.path.isfile(reads_per_cell):
+        try:
+            with open(reads_per_cell, 'r') as file:
+                header = file.readline().rstrip('\n').split('\t')
+                index = header.index('N')
+                return sum(int(float(line.split('\t')[index])) for line in file if line.strip()), "zUMIs"
+        except (OSError, ValueError, IndexError) as e:
+            print(f"WARNING: The reads of the plate {plate} cannot be read in {reads_per_cell} ({e}), the estimate is used.")
+
+    reads = config.get('plate_resources', {}).get(plate, {}).get('reads')
+    if reads is None:
+        return None, None
+    return int(reads), "estimate"
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function job_resources : Returns the reads, threads and memory planned of a job.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def job_resources(rule, plate, reads_by_plate, config):
+    '''
+    Returns (reads, reads source, threads, memory planned in MB) of a job (None when not known or not relevant).
+
+    rule: Name of the rule.
+    plate: Name of the plate ('' for the rules of the experiment).
+    reads_by_plate: Dictionary plate -> (reads, source), see plate_reads.
+    config: Content of config.yaml.
+    '''
+    trust4_shards = int(config.get('trust4_shards') or 1)
+    resources = config.get('plate_resources', {}).get(plate, {})
+
+    threads, planned_mem_mb = RULE_THREADS.get(rule, 1), None
+    if rule in RULE_RESOURCES and resources:
+        threads_key, mem_key = RULE_RESOURCES[rule]
+        threads, planned_mem_mb = int(resources[threads_key]), int(resources[mem_key])
+        if rule == "trust4_shard":
+            threads = max(1, (threads + trust4_shards - 1) // trust4_shards)
+
+    reads, source = None, None
+    scope = RULE_READS.get(rule)
+    if scope in ("plate", "shard") and plate in reads_by_plate:
+        reads, source = reads_by_plate[plate]
+        if scope == "shard" and reads is not None:
+            reads = reads // trust4_shards
+    elif scope == "preflight" and config.get('preflight_reads'):
+        reads, source = int(config['preflight_reads']), "preflight"
+    elif scope == "experiment" and reads_by_plate:
+        known = [plate_reads for plate_reads, plate_source in reads_by_plate.values() if plate_reads is not None]
+        if len(known) == len(reads_by_plate):
+            reads = sum(known)
+            source = "zUMIs" if all(plate_source == "zUMIs" for _, plate_source in reads_by_plate.values()) else "estimate"
+
+    return reads, source, threads, planned_mem_mb
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 5. Function open_history : Opens (and creates) the history database.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def default_history_path(template_path):
+    '''
+    Returns the path to the history database : FLASHPIPE_RUNTIME_HISTORY if defined, 00_RuntimeHistory.sqlite next to the
+    template directory otherwise (shared by all the experiments staged with this template).
+
+    template_path: Path to the template directory (01_Template), None if not known.
+    '''
+    if os.environ.get(HISTORY_ENVIRONMENT_VARIABLE):
+        return os.environ[HISTORY_ENVIRONMENT_VARIABLE]
+    if template_path:
+        return os.path.join(os.path.dirname(os.path.abspath(template_path)), HISTORY_FILE_NAME)
+    return None
+
+def open_history(db_path):
+    '''
+    Opens the history database, created with its tables if it does not exist.
+    Several workflows can ingest at the same time : SQLite locks the database during the writes.
+
+    db_path: Path to the SQLite database.
+    '''
+    db_dir = os.path.dirname(os.path.abspath(db_path))
+    if not os.path.exists(db_dir):
+        os.makedirs(db_dir)
+
+    connection = sqlite3.connect(db_path, timeout=60)
+    connection.row_factory = sqlite3.Row
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version not in (0, SCHEMA_VERSION):
+        connection.close()
+        raise ValueError(f"The runtime history {db_path} was written with another format (version {version}).")
+    connection.executescript(HISTORY_SCHEMA)
+    connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return connection
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 6. Function ingest_experiment : Records the benchmark files of an experiment in the history.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def read_config(experience_path):
+    '''
+    Returns the content of config.yaml of the experiment.
+
+    experience_path: Path to the experiment directory.
+    '''
+    with open(os.path.join(experience_path, CONFIG_PATH), 'r') as file:
+        return yaml.load(file, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+def ingest_experiment(connection, experience_path, config):
+    '''
+    Records the jobs of the benchmark files of the experiment. A benchmark file already recorded (same modification time)
+    is skipped : the history keeps one record per run of each job.
+    Returns the number of jobs added.
+
+    connection: Connection to the history database (see open_history).
+    experience_path: Path to the experiment directory.
+    config: Content of config.yaml.
+    '''
+    experience_path = os.path.abspath(experience_path)
+    reads_by_plate = {plate: plate_reads(experience_path, plate, config) for plate in str(config['plate_names']).split(',')}
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    with connection:
+        connection.execute(
+            "INSERT INTO experiments (project, experiment, path, config, ingested_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (path) DO UPDATE SET project = excluded.project, experiment = excluded.experiment, "
+            "config = excluded.config, ingested_at = excluded.ingested_at",
+            (str(config['project_name']), str(config['experience_name']), experience_path,
+             json.dumps({key: config.get(key) for key in CONFIG_KEYS}, sort_keys=True), now))
+        experiment_id = connection.execute("SELECT experiment_id FROM experiments WHERE path = ?", (experience_path,)).fetchone()[0]
+
+        added = 0
+        for rule, plate, shard, file_path in list_benchmark_files(experience_path):
+            measures = read_benchmark_file(file_path)
+            if measures is None:
+                continue
+            mtime = os.stat(file_path).st_mtime_ns
+            reads, reads_source, threads, planned_mem_mb = job_resources(rule, plate, reads_by_plate, config)
+            cursor = connection.execute(
+                "INSERT OR IGNORE INTO jobs (experiment_id, rule, plate, shard, finished_at, benchmark_mtime, reads, reads_source, "
+                "threads, planned_mem_mb, wall_seconds, cpu_seconds, max_rss_mb, io_in_mb, io_out_mb, mean_load) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (experiment_id, rule, plate, shard, time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(mtime / 1e9)), mtime,
+                 reads, reads_source, threads, planned_mem_mb, measures['wall_seconds'], measures['cpu_seconds'],
+                 measures['max_rss_mb'], measures['io_in_mb'], measures['io_out_mb'], measures['mean_load']))
+            added += cursor.rowcount
+    return added
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 7. Function rule_throughput : Throughput and memory of each rule.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def job_throughput(job):
+    '''
+    Returns the reads processed per second and per core of a job (None if its reads or its wall time are not known).
+
+    job: Row of the jobs table.
+    '''
+    if not job['reads'] or not job['wall_seconds']:
+        return None
+    return job['reads'] / (job['wall_seconds'] * job['threads'])
+
+def job_memory(job):
+    '''
+    Returns the max RSS of the job per million reads (MB) for the rules processing reads, its max RSS (MB) otherwise.
+
+    job: Row of the jobs table.
+    '''
+    if job['max_rss_mb'] is None:
+        return None
+    if job['reads']:
+        return job['max_rss_mb'] / (job['reads'] / 1_000_000)
+    return job['max_rss_mb']
+
+def median_of(values):
+    '''
+    Returns the median of the values that are not None (None if there is none).
+
+    values: Iterable of numbers or None.
+    '''
+    values = [value for value in values if value is not None]
+    return statistics.median(values) if values else None
+
+def select_jobs(connection, rule=None, experiment_id=None):
+    '''
+    Returns the jobs of the history, with the project and experiment name (optionally of a rule / an experiment).
+
+    connection: Connection to the history database.
+    rule: Name of the rule (default: all the rules).
+    experiment_id: Identifier of the experiment (default: all the experiments).
+    '''
+    query = "SELECT jobs.*, experiments.project, experiments.experiment FROM jobs JOIN experiments USING (experiment_id) WHERE 1 = 1"
+    parameters = []
+    if rule is not None:
+        query += " AND rule = ?"
+        parameters.append(rule)
+    if experiment_id is not None:
+        query += " AND experiment_id = ?"
+        parameters.append(experiment_id)
+    return connection.execute(query + " ORDER BY rule, experiment_id, plate, shard, benchmark_mtime", parameters).fetchall()
+
+def rule_throughput(connection, rule=None):
+    '''
+    Returns one row per rule : number of jobs, median throughput (reads/s/core), median CPU efficiency (CPU time used /
+    wall time x threads), median wall time, median and maximum max RSS, median max RSS per million reads.
+
+    connection: Connection to the history database.
+    rule: Name of the rule (default: all the rules).
+    '''
+    jobs_by_rule = {}
+    for job in select_jobs(connection, rule=rule):
+        jobs_by_rule.setdefault(job['rule'], []).append(job)
+
+    rows = []
+    for rule_name, jobs in jobs_by_rule.items():
+        rss = [job['max_rss_mb'] for job in jobs if job['max_rss_mb'] is not None]
+        rows.append({
+            'rule': rule_name,
+            'jobs': len(jobs),
+            'reads_per_s_core': median_of(job_throughput(job) for job in jobs),
+            'cpu_efficiency': median_of(job['cpu_seconds'] / (job['wall_seconds'] * job['threads'])
+                                        for job in jobs if job['cpu_seconds'] is not None and job['wall_seconds']),
+            'wall_seconds': median_of(job['wall_seconds'] for job in jobs),
+            'max_rss_mb': median_of(rss),
+            'max_rss_mb_max': max(rss) if rss else None,
+            'rss_mb_per_million_reads': median_of(job_memory(job) for job in jobs if job['reads'])
+        })
+    return rows
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 8. Function memory_outliers : Jobs whose memory is far from the other jobs of the rule, or from the planned one.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def memory_outliers(connection, factor=OUTLIER_FACTOR, rule=None):
+    '''
+    Returns the jobs whose max RSS (per million reads for the rules processing reads) is more than factor times the
+    median of their rule, above the memory planned, or below OVER_RESERVED_RATIO of the memory planned.
+
+    connection: Connection to the history database.
+    factor: Ratio to the median of the rule above which a job is an outlier.
+    rule: Name of the rule (default: all the rules).
+    '''
+    jobs_by_rule = {}
+    for job in select_jobs(connection, rule=rule):
+        jobs_by_rule.setdefault(job['rule'], []).append(job)
+
+    rows = []
+    for rule_name, jobs in jobs_by_rule.items():
+        median_memory = median_of(job_memory(job) for job in jobs)
+        for job in jobs:
+            reasons = []
+            memory = job_memory(job)
+            if memory is not None and median_memory and memory > factor * median_memory:
+                reasons.append(f"{memory / median_memory:.1f} x median of the rule")
+            if job['max_rss_mb'] is not None and job['planned_mem_mb']:
+                if job['max_rss_mb'] > job['planned_mem_mb']:
+                    reasons.append("above the memory planned")
+                elif job['max_rss_mb'] < OVER_RESERVED_RATIO * job['planned_mem_mb']:
+                    reasons.append("memory planned over-reserved")
+            if reasons:
+                rows.append({
+                    'rule': rule_name,
+                    'experiment': f"{job['project']}/{job['experiment']}",
+                    'plate': job['plate'] + (f" shard {job['shard']}" if job['shard'] else ""),
+                    'reads': job['reads'],
+                    'max_rss_mb': job['max_rss_mb'],
+                    'planned_mem_mb': job['planned_mem_mb'],
+                    'reason': ", ".join(reasons)
+                })
+    return rows
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 9. Function experiment_regressions : Compares an experiment with the previous ones.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def find_experiment(connection, name=None):
+    '''
+    Returns the row of the experiment PROJECT/EXPERIMENT (default: the last one ingested), None if it is not in the history.
+
+    connection: Connection to the history database.
+    name: PROJECT/EXPERIMENT, or the path to the experiment directory.
+    '''
+    if name is None:
+        return connection.execute("SELECT * FROM experiments ORDER BY ingested_at DESC, experiment_id DESC LIMIT 1").fetchone()
+    if os.path.isdir(name):
+        return connection.execute("SELECT * FROM experiments WHERE path = ?", (os.path.abspath(name),)).fetchone()
+    project, _, experiment = name.partition('/')
+    return connection.execute("SELECT * FROM experiments WHERE project = ? AND experiment = ? ORDER BY experiment_id DESC LIMIT 1",
+                              (project, experiment)).fetchone()
+
+def experiment_regressions(connection, experiment, factor=REGRESSION_FACTOR):
+    '''
+    Compares each rule of the experiment with the jobs of the same rule in the experiments ingested before it (median
+    throughput for the rules processing reads, median wall time otherwise, and median max RSS).
+    Returns one row per rule and metric, with 'regression' True when the experiment is worse by more than factor.
+
+    connection: Connection to the history database.
+    experiment: Row of the experiment (see find_experiment).
+    factor: Ratio above which a rule is reported as a regression.
+    '''
+    reference_jobs = {}
+    for job in connection.execute("SELECT * FROM jobs WHERE experiment_id < ?", (experiment['experiment_id'],)).fetchall():
+        reference_jobs.setdefault(job['rule'], []).append(job)
+    experiment_jobs = {}
+    for job in select_jobs(connection, experiment_id=experiment['experiment_id']):
+        experiment_jobs.setdefault(job['rule'], []).append(job)
+
+    rows = []
+    for rule_name, jobs in experiment_jobs.items():
+        references = reference_jobs.get(rule_name)
+        if not references:
+            continue
+        # Metric, median of the experiment, median of the previous experiments, True if a higher value is better
+        metrics = [("max_rss_mb_per_job" if not any(job['reads'] for job in jobs) else "rss_mb_per_million_reads",
+                    median_of(job_memory(job) for job in jobs), median_of(job_memory(job) for job in references), False)]
+        throughput = median_of(job_throughput(job) for job in jobs)
+        if throughput is not None:
+            metrics.insert(0, ("reads_per_s_core", throughput, median_of(job_throughput(job) for job in references), True))
+        else:
+            metrics.insert(0, ("wall_seconds", median_of(job['wall_seconds'] for job in jobs),
+                               median_of(job['wall_seconds'] for job in references), False))
+
+        for metric, value, reference, higher_is_better in metrics:
+            if value is None or not reference:
+                continue
+            ratio = value / reference
+            rows.append({
+                'rule': rule_name,
+                'metric': metric,
+                'previous': reference,
+                'experiment': value,
+                'ratio': ratio,
+                'regression': ratio * factor < 1 if higher_is_better else ratio > factor
+            })
+    return rows
+
+def format_rows(rows, columns):
+    '''
+    Returns the rows as a text table (numbers rounded, empty values as -).
+
+    rows: List of dictionaries.
+    columns: Keys of the rows to display, in order.
+    '''
+    def format_value(value):
+        if value is None:
+            return "-"
+        if isinstance(value, float):
+            return f"{value:,.2f}" if abs(value) < 100 else f"{value:,.0f}"
+        if isinstance(value, int) and not isinstance(value, bool):
+            return f"{value:,}"
+        return str(value)
+
+    table = [columns] + [[format_value(row[column]) for column in columns] for row in rows]
+    widths = [max(len(line[index]) for line in table) for index in range(len(columns))]
+    return "\n".join("  ".join(value.ljust(width) for value, width in zip(line, widths)).rstrip() for line in table)
+
+if __name__ == "__main__":
+    parser = OptionParser(usage="%prog ingest|throughput|outliers|regressions [-w EXPERIMENT_DIR] [-d HISTORY_DB] "
+                                "[-r RULE] [-e PROJECT/EXPERIMENT] [-f FACTOR]")
+    parser.add_option("-w", "--working_dir", dest="working_dir", default=".",
+                      help="Experiment directory (ingest, and default history database from its config.yaml)", metavar="EXPERIMENT_DIR")
+    parser.add_option("-d", "--database", dest="database",
+                      help=f"History database (default: {HISTORY_ENVIRONMENT_VARIABLE}, or {HISTORY_FILE_NAME} next to the template directory)",
+                      metavar="HISTORY_DB")
+    parser.add_option("-r", "--rule", dest="rule", help="Only report this rule (throughput, outliers)", metavar="RULE")
+    parser.add_option("-e", "--experiment", dest="experiment",
+                      help="Experiment compared with the previous ones (regressions, default: the last one ingested)", metavar="PROJECT/EXPERIMENT")
+    parser.add_option("-f", "--factor", dest="factor", type="float",
+                      help=f"Outlier factor (default: {OUTLIER_FACTOR}) or regression factor (default: {REGRESSION_FACTOR})", metavar="FACTOR")
+    (options, args) = parser.parse_args()
+
+    if len(args) != 1 or args[0] not in ("ingest", "throughput", "outliers", "regressions"):
+        parser.error("One command is required : ingest, throughput, outliers or regressions")
+    command = args[0]
+
+    config = None
+    if command == "ingest" or not options.database:
+        try:
+            config = read_config(options.working_dir)
+        except OSError as e:
+            print(f"ERROR: The config file of the experiment cannot be read ({e}).")
+            sys.exit(1)
+    db_path = options.database or default_history_path(config.get('template_path'))
+    if not db_path:
+        print(f"ERROR: No history database : use -d or define {HISTORY_ENVIRONMENT_VARIABLE}.")
+        sys.exit(1)
+
+    try:
+        connection = open_history(db_path)
+    except (sqlite3.Error, ValueError, OSError) as e:
+        print(f"ERROR: The runtime history {db_path} cannot be opened ({e}).")
+        sys.exit(1)
+
+    with connection:
+        if command == "ingest":
+            added = ingest_experiment(connection, options.working_dir, config)
+            print(f"{config['project_name']}/{config['experience_name']} : {added} jobs added to the runtime history {db_path}")
+
+        elif command == "throughput":
+            print(format_rows(rule_throughput(connection, rule=options.rule),
+                              ['rule', 'jobs', 'reads_per_s_core', 'cpu_efficiency', 'wall_seconds', 'max_rss_mb', 'max_rss_mb_max',
+                               'rss_mb_per_million_reads']))
+
+        elif command == "outliers":
+            rows = memory_outliers(connection, factor=options.factor or OUTLIER_FACTOR, rule=options.rule)
+            print(format_rows(rows, ['rule', 'experiment', 'plate', 'reads', 'max_rss_mb', 'planned_mem_mb', 'reason']) if rows else "No memory outlier.")
+
+        else:
+            experiment = find_experiment(connection, options.experiment)
+            if experiment is None:
+                print(f"ERROR: The experiment {options.experiment or ''} is not in the runtime history {db_path}.")
+                sys.exit(1)
+            rows = experiment_regressions(connection, experiment, factor=options.factor or REGRESSION_FACTOR)
+            print(f"{experiment['project']}/{experiment['experiment']} compared with the previous experiments :")
+            print(format_rows(rows, ['rule', 'metric', 'previous', 'experiment', 'ratio', 'regression']) if rows else "Nothing to compare.")
+            # Return code 1 when a rule regressed (same convention as 03_Benchmark/benchmark_staging.py -c)
+            if any(row['regression'] for row in rows):
+                sys.exit(1)
@@ -0,0 +1,268 @@
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from optparse import OptionParser
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Measures the staging functions (create_folder_structure_function.py and FlashPipeProject) on synthetic runs of
+# increasing size (see generate_synthetic_run.py), and writes the results in a JSON file to compare two versions.
+# 1. Function time_call : Runs a function several times (with an untimed setup before each run) and returns the durations.
+# 2. Function benchmark_scale : Measures each staging function on a synthetic run of a given number of plates.
+# 3. Function run_benchmarks / write_results : Runs all the scales and writes the JSON results.
+# 4. Function compare_results : Compares the results of two versions (ratio of the best durations).
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+from generate_synthetic_run import REPOSITORY_PATH, TEMPLATE_PATH, generate_synthetic_run, write_experiment_config
+
+# Import the staging functions from the template (located in the experiment scripts)
+ORGANIZE_STRUCTURE_PATH = os.path.join(TEMPLATE_PATH, '{{experience_name}}/03_Script/01_FlashPipe/00_organizeStructure')
+sys.path.append(ORGANIZE_STRUCTURE_PATH)
+from create_folder_structure_function import prepare_fastq_symlinks_and_paths, copy_index_sort, replace_value_config_template_copier, generate_airrflow_samplesheet
+from flashpipe_project import FlashPipeProject
+
+# Version of the results format
+RESULTS_VERSION = 1
+# Number of plates of each scale (a FlashFB5p-seq run has a few plates, a large facility run several hundreds)
+DEFAULT_SCALES = [10, 100, 1000]
+# Template files modified by the staging functions (copied before each run of the function)
+COPIER_YML_PATH = os.path.join(TEMPLATE_PATH, 'copier.yml')
+AIRRFLOW_SAMPLESHEET_PATH = os.path.join(TEMPLATE_PATH, '{{experience_name}}/01_Reference/02_airrflow/assembled_samplesheet.tsv')
+# Ratio above which a benchmark is reported as slower by compare_results
+REGRESSION_RATIO = 1.2
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function time_call : Runs a function several times and returns the durations.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def time_call(function, setup=None, repeat=3):
+    '''
+    Runs function repeat times and returns the list of durations (seconds). The messages printed by the function are hidden.
+
+    function: Function to measure (without argument).
+    setup: Function run before each measure, not timed (example: removes the files created by the previous run).
+    repeat: Number of measures.
+    '''
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            function()
+            durations.append(time.perf_counter() - start)
+    return durations
+
+def remove_path(path):
+    '''
+    Removes a file or a directory (nothing is done if it does not exist).
+
+    path: Path to remove.
+    '''
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function benchmark_scale : Measures each staging function on a synthetic run.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def benchmark_scale(work_dir, plates, lanes=1, reads=100, repeat=3, renderer="native"):
+    '''
+    Generates a synthetic run of plates plates in work_dir and measures the staging functions on it.
+    Each function is measured cold (nothing staged before) and, when it can skip work, warm (second run on the same directories).
+    Returns the list of results : benchmark, case, plates, lanes, fastq_files, durations, best, median (seconds).
+
+    work_dir: Directory of the synthetic run and of the staged experiment.
+    plates: Number of plates.
+    lanes: Number of lanes per plate.
+    reads: Number of reads per FastQ file.
+    repeat: Number of measures of each benchmark.
+    renderer: Engine used to render the template in the end-to-end staging (native or copier).
+    '''
+    run = generate_synthetic_run(os.path.join(work_dir, 'run'), plates, lanes=lanes, reads=reads)
+    experience_path = os.path.join(work_dir, 'PROJ', f"EXP_{plates}")
+    results = []
+
+    def add_result(benchmark, case, durations):
+        results.append({
+            'benchmark': benchmark,
+            'case': case,
+            'plates': plates,
+            'lanes': lanes,
+            'fastq_files': run['fastq_files'],
+            'durations': [round(duration, 6) for duration in durations],
+            'best': round(min(durations), 6),
+            'median': round(statistics.median(durations), 6)
+        })
+        print(f"  {benchmark:38} {case:5} {plates:5} plates : best {min(durations):.4f} s, median {statistics.median(durations):.4f} s")
+
+    # FastQ symbolic links (and lanes merge) : cold without catalog and links, warm with the catalog of the previous run
+    rna_dir = os.path.join(work_dir, 'stage_fastq', '00_RNA')
+    catalog_path = os.path.join(work_dir, 'stage_fastq', 'fastq_catalog.json')
+    stage_fastq = lambda: prepare_fastq_symlinks_and_paths(run['fastq_dir'], rna_dir, run['plates'], catalog_path=catalog_path)
+    add_result('prepare_fastq_symlinks_and_paths', 'cold', time_call(stage_fastq, lambda: remove_path(os.path.dirname(rna_dir)), repeat))
+    add_result('prepare_fastq_symlinks_and_paths', 'warm', time_call(stage_fastq, repeat=repeat))
+
+    # Index Sorting copy : cold in an empty directory, warm when the copies are up to date
+    index_sort_dir = os.path.join(work_dir, 'stage_index_sort')
+    copy_files = lambda: copy_index_sort(run['index_sort_dir'], index_sort_dir, plates_list=run['plates'])
+    add_result('copy_index_sort', 'cold', time_call(copy_files, lambda: remove_path(index_sort_dir), repeat))
+    add_result('copy_index_sort', 'warm', time_call(copy_files, repeat=repeat))
+
+    # End-to-end staging of an experiment (FlashPipeProject.stage) : cold in a new experiment directory, warm on the staged one
+    # The containers are linked from a store of the work directory (shared by the cold runs, as by the experiments of a server)
+    container_store = os.path.join(work_dir, 'container_store')
+    stage = lambda: FlashPipeProject(experience_path, TEMPLATE_PATH, renderer=renderer, container_store=container_store).stage()
+    def new_experiment():
+        remove_path(experience_path)
+        write_experiment_config(experience_path, run)
+    add_result('end_to_end', 'cold', time_call(stage, new_experiment, repeat))
+    add_result('end_to_end', 'warm', time_call(stage, repeat=repeat))
+
+    # Values of the template config of the staged experiment (used by the copier renderer)
+    project = FlashPipeProject(experience_path, TEMPLATE_PATH, renderer=renderer, container_store=container_store)
+    with contextlib.redirect_stdout(io.StringIO()):
+        project.load_config()
+        project.prepare_plates()
+        project.select_references()
+    values = project.template_values()
+
+    # Replacement of the values of copier.yml (on a copy of the template file)
+    copier_yml_path = os.path.join(work_dir, 'copier.yml')
+    replace_values = lambda: replace_value_config_template_copier(copier_yml_path, values)
+    add_result('replace_value_config_template_copier', 'cold', time_call(replace_values, lambda: shutil.copyfile(COPIER_YML_PATH, copier_yml_path), repeat))
+
+    # Airrflow samplesheet (on a copy of the template file)
+    samplesheet_path = os.path.join(work_dir, 'assembled_samplesheet.tsv')
+    samplesheet = lambda: generate_airrflow_samplesheet(path_airrflow_reference=samplesheet_path, plates_list=project.plates_list,
+                                                        fastq_files_read1=project.fastq_files_read1, fastq_files_read2=project.fastq_files_read2,
+                                                        species=project.species, file_config_flashpipe=project.file_config_flashpipe)
+    add_result('generate_airrflow_samplesheet', 'cold', time_call(samplesheet, lambda: shutil.copyfile(AIRRFLOW_SAMPLESHEET_PATH, samplesheet_path), repeat))
+
+    return results
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function run_benchmarks / write_results : Runs all the scales.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def git_revision():
+    '''
+    Returns the git commit of the repository (None if git is not available).
+    '''
+    try:
+        completed = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_PATH, stdout=subprocess.PIPE,
+                                   stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return None
+    return completed.stdout.strip() if completed.returncode == 0 else None
+
+def run_benchmarks(work_dir, scales=DEFAULT_SCALES, lanes=1, reads=100, repeat=3, renderer="native"):
+    '''
+    Runs benchmark_scale for each number of plates of scales (one sub-directory of work_dir per scale).
+    Returns the results dictionary : version, date, git revision, machine, parameters and results.
+
+    work_dir: Directory of the synthetic runs.
+    scales: List of numbers of plates.
+    lanes: Number of lanes per plate.
+    reads: Number of reads per FastQ file.
+    repeat: Number of measures of each benchmark.
+    renderer: Engine used to render the template in the end-to-end staging.
+    '''
+    results = []
+    for plates in scales:
+        print(f"Benchmark with {plates} plates ({lanes} lanes)")
+        results.extend(benchmark_scale(os.path.join(work_dir, f"plates_{plates}"), plates, lanes=lanes, reads=reads,
+                                       repeat=repeat, renderer=renderer))
+
+    return {
+        'version': RESULTS_VERSION,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_revision': git_revision(),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'parameters': {'scales': scales, 'lanes': lanes, 'reads': reads, 'repeat': repeat, 'renderer': renderer},
+        'results': results
+    }
+
+def write_results(results, results_path):
+    '''
+    Writes the results in a JSON file (the directory is created if needed).
+
+    results: Results dictionary returned by run_benchmarks.
+    results_path: Path to the JSON file.
+    '''
+    results_dir = os.path.dirname(results_path)
+    if results_dir:
+        os.makedirs(results_dir, exist_ok=True)
+    with open(results_path, 'w') as file:
+        json.dump(results, file, indent=1)
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function compare_results : Compares the results of two versions.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def compare_results(reference, results):
+    '''
+    Prints, for each benchmark measured in both results, the best durations and their ratio (results / reference).
+    Returns the list of the benchmarks slower than REGRESSION_RATIO times the reference.
+
+    reference: Results dictionary of the reference version.
+    results: Results dictionary of the new version.
+    '''
+    # The results without plates (startup benchmarks, see benchmark_startup.py) are compared by benchmark and case only
+    result_key = lambda result: (result['benchmark'], result['case'], result.get('plates'), result.get('lanes'))
+    reference_best = {result_key(result): result['best'] for result in reference['results']}
+    regressions = []
+    print(f"Reference : {reference.get('git_revision')} ({reference.get('date')}), new : {results.get('git_revision')} ({results.get('date')})")
+    for result in results['results']:
+        key = result_key(result)
+        if key not in reference_best:
+            continue
+        ratio = result['best'] / reference_best[key] if reference_best[key] else float('inf')
+        flag = "SLOWER" if ratio > REGRESSION_RATIO else ""
+        scale = f"{result['plates']:5} plates" if result.get('plates') is not None else ""
+        print(f"  {result['benchmark']:38} {result['case']:8} {scale} : {reference_best[key]:.4f} s -> {result['best']:.4f} s (x{ratio:.2f}) {flag}")
+        if flag:
+            regressions.append(key)
+    return regressions
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [-n 10,100,1000] [-o RESULTS_JSON] [-c REFERENCE_JSON]")
+    parser.add_option("-n", "--plates", dest="plates", default=','.join(str(plates) for plates in DEFAULT_SCALES),
+                      help="Comma separated numbers of plates (default: 10,100,1000)", metavar="PLATES")
+    parser.add_option("-l", "--lanes", dest="lanes", type="int", default=1, help="Number of lanes per plate (default: 1)", metavar="LANES")
+    parser.add_option("-r", "--reads", dest="reads", type="int", default=100, help="Number of reads per FastQ file (default: 100)", metavar="READS")
+    parser.add_option("-k", "--repeat", dest="repeat", type="int", default=3, help="Number of measures of each benchmark (default: 3)", metavar="REPEAT")
+    parser.add_option("--renderer", dest="renderer", default="native", choices=["native", "copier"],
+                      help="Engine used to render the template in the end-to-end staging (default: native)", metavar="RENDERER")
+    parser.add_option("-w", "--work_dir", dest="work_dir", default=None,
+                      help="Directory of the synthetic runs, kept after the benchmark (default: temporary directory, removed at the end)", metavar="WORK_DIR")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Path to the JSON results file (default: results/staging_<date>.json next to this script)", metavar="RESULTS_JSON")
+    parser.add_option("-c", "--compare", dest="compare", default=None,
+                      help="JSON results of a reference version to compare with (exit code 1 if a benchmark is slower)", metavar="REFERENCE_JSON")
+    (options, args) = parser.parse_args()
+
+    scales = [int(plates) for plates in options.plates.split(',')]
+    work_dir = options.work_dir or tempfile.mkdtemp(prefix="FlashPipe_benchmark_")
+    try:
+        results = run_benchmarks(work_dir, scales=scales, lanes=options.lanes, reads=options.reads,
+                                 repeat=options.repeat, renderer=options.renderer)
+    finally:
+        if options.work_dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    results_path = options.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', f"staging_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    write_results(results, results_path)
+    print(f"Results written in {results_path}")
+
+    if options.compare:
+        with open(options.compare, 'r') as file:
+            reference = json.load(file)
+        if compare_results(reference, results):
+            sys.exit(1)
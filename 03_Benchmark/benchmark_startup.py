@@ -0,0 +1,182 @@
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+import yaml
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Measures the fixed cost of the staging that does not depend on the run size : start of the interpreter, import of the
+# staging modules and parsing of the YAML files (config_FlashPipe.yml, copier.yml). For small runs this cost dominates.
+# 1. Function time_command : Runs a Python command in new interpreters and returns the durations (import costs).
+# 2. Function benchmark_yaml : Measures the YAML load/dump with the pure Python and the libyaml (C) loader and dumper.
+# 3. Function benchmark_table : Measures the writing of the Airrflow samplesheet with pandas and with the csv writer.
+# 4. Function run_startup_benchmarks : Runs all the measures and returns the JSON results (same format as benchmark_staging.py).
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+from generate_synthetic_run import CONFIG_TEMPLATE_PATH
+from benchmark_staging import ORGANIZE_STRUCTURE_PATH, RESULTS_VERSION, COPIER_YML_PATH, AIRRFLOW_SAMPLESHEET_PATH, time_call, git_revision, write_results, compare_results
+
+# Commands measured in a new interpreter (the import cost is only visible in a process that did not import anything yet)
+STARTUP_COMMANDS = {
+    'interpreter': "pass",
+    'import_pandas': "import pandas",
+    'import_yaml': "import yaml",
+    'import_create_folder_structure_function': "import create_folder_structure_function",
+    'import_flashpipe_project': "import flashpipe_project"
+}
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function time_command : Runs a Python command in new interpreters.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def time_command(command, repeat=5):
+    '''
+    Runs command in repeat new Python interpreters (with the staging scripts in the path) and returns the durations
+    of the whole process (start of the interpreter included). Returns None if the command fails (module not installed).
+
+    command: Python code run with python -c.
+    repeat: Number of measures.
+    '''
+    code = f"import sys; sys.path.insert(0, {ORGANIZE_STRUCTURE_PATH!r}); {command}"
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-c', code], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        durations.append(time.perf_counter() - start)
+        if completed.returncode != 0:
+            return None
+    return durations
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function benchmark_yaml : Measures the YAML load/dump with the pure Python and libyaml classes.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def benchmark_yaml(repeat=5, loops=20):
+    '''
+    Measures loops loads of config_FlashPipe.yml and copier.yml, and loops dumps of copier.yml, with the pure Python
+    (SafeLoader/SafeDumper, used before) and the libyaml (CSafeLoader/CSafeDumper) classes.
+    Returns a dictionary (benchmark, case) -> durations.
+
+    repeat: Number of measures.
+    loops: Number of loads/dumps in a measure.
+    '''
+    with open(CONFIG_TEMPLATE_PATH, 'r') as file:
+        config_text = file.read()
+    with open(COPIER_YML_PATH, 'r') as file:
+        copier_text = file.read()
+    copier_data = yaml.safe_load(copier_text)
+
+    implementations = {'python': (yaml.SafeLoader, yaml.SafeDumper)}
+    if getattr(yaml, '__with_libyaml__', False):
+        implementations['libyaml'] = (yaml.CSafeLoader, yaml.CSafeDumper)
+
+    durations = {}
+    for case, (loader, dumper) in implementations.items():
+        durations[('yaml_load_config', case)] = time_call(lambda: [yaml.load(config_text, Loader=loader) for _ in range(loops)], repeat=repeat)
+        durations[('yaml_load_copier', case)] = time_call(lambda: [yaml.load(copier_text, Loader=loader) for _ in range(loops)], repeat=repeat)
+        durations[('yaml_dump_copier', case)] = time_call(lambda: [yaml.dump(copier_data, Dumper=dumper, default_flow_style=False, allow_unicode=True)
+                                                                   for _ in range(loops)], repeat=repeat)
+    return durations
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function benchmark_table : Measures the writing of the Airrflow samplesheet (pandas and csv).
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def benchmark_table(repeat=5, plates=96):
+    '''
+    Measures the reading of the samplesheet template and the formatting of a samplesheet of plates lines,
+    with pandas (used before, import not included) and with read_table/format_table. pandas is skipped if not installed.
+    Returns a dictionary (benchmark, case) -> durations.
+
+    repeat: Number of measures.
+    plates: Number of lines of the samplesheet.
+    '''
+    sys.path.insert(0, ORGANIZE_STRUCTURE_PATH)
+    from create_folder_structure_function import read_table, format_table
+
+    rows = [{'sample_id': f"P{index}", 'filename_R1': f"/data/P{index}_R1.fastq.gz", 'filename_R2': f"/data/P{index}_R2.fastq.gz",
+             'subject_id': f"S{index}", 'species': 'mouse', 'pcr_target_locus': 'IG', 'single_cell': 'TRUE'} for index in range(plates)]
+
+    def write_csv():
+        columns, _ = read_table(AIRRFLOW_SAMPLESHEET_PATH, sep="\t")
+        return format_table(columns, rows, sep="\t")
+
+    durations = {('airrflow_samplesheet', 'csv'): time_call(write_csv, repeat=repeat)}
+    try:
+        import pandas as pd
+    except ImportError:
+        return durations
+
+    def write_pandas():
+        columns = pd.read_csv(AIRRFLOW_SAMPLESHEET_PATH, sep="\t").columns
+        return pd.DataFrame(rows, columns=columns).to_csv(sep="\t", index=False)
+
+    if write_pandas() != write_csv():
+        print("WARNING: The samplesheets written with pandas and with the csv writer are different.")
+    durations[('airrflow_samplesheet', 'pandas')] = time_call(write_pandas, repeat=repeat)
+    return durations
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function run_startup_benchmarks : Runs all the measures.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def run_startup_benchmarks(repeat=5):
+    '''
+    Runs the import, YAML and samplesheet measures.
+    Returns the results dictionary (same format as benchmark_staging.py, without plates).
+
+    repeat: Number of measures of each benchmark.
+    '''
+    durations = {}
+    for name, command in STARTUP_COMMANDS.items():
+        command_durations = time_command(command, repeat=repeat)
+        if command_durations is None:
+            print(f"  {name:38} skipped (the command failed)")
+            continue
+        durations[(name, 'process')] = command_durations
+    durations.update(benchmark_yaml(repeat=repeat))
+    durations.update(benchmark_table(repeat=repeat))
+
+    results = []
+    for (benchmark, case), benchmark_durations in durations.items():
+        results.append({
+            'benchmark': benchmark,
+            'case': case,
+            'durations': [round(duration, 6) for duration in benchmark_durations],
+            'best': round(min(benchmark_durations), 6),
+            'median': round(statistics.median(benchmark_durations), 6)
+        })
+        print(f"  {benchmark:38} {case:8} : best {min(benchmark_durations):.4f} s, median {statistics.median(benchmark_durations):.4f} s")
+
+    return {
+        'version': RESULTS_VERSION,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'git_revision': git_revision(),
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                    'libyaml': bool(getattr(yaml, '__with_libyaml__', False))},
+        'parameters': {'repeat': repeat},
+        'results': results
+    }
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog [-k REPEAT] [-o RESULTS_JSON] [-c REFERENCE_JSON]")
+    parser.add_option("-k", "--repeat", dest="repeat", type="int", default=5, help="Number of measures of each benchmark (default: 5)", metavar="REPEAT")
+    parser.add_option("-o", "--output", dest="output", default=None,
+                      help="Path to the JSON results file (default: results/startup_<date>.json next to this script)", metavar="RESULTS_JSON")
+    parser.add_option("-c", "--compare", dest="compare", default=None,
+                      help="JSON results of a reference version to compare with (exit code 1 if a benchmark is slower)", metavar="REFERENCE_JSON")
+    (options, args) = parser.parse_args()
+
+    print("Startup benchmark")
+    results = run_startup_benchmarks(repeat=options.repeat)
+
+    results_path = options.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results', f"startup_{time.strftime('%Y%m%d_%H%M%S')}.json")
+    write_results(results, results_path)
+    print(f"Results written in {results_path}")
+
+    if options.compare:
+        with open(options.compare, 'r') as file:
+            reference = json.load(file)
+        if compare_results(reference, results):
+            sys.exit(1)
@@ -0,0 +1,223 @@
+import gzip
+import os
+import random
+import sys
+from optparse import OptionParser
+import yaml
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# General code description :
+# Builds a fake sequencing run on the local disk, to measure the staging scripts on large runs (see benchmark_staging.py).
+# 1. Function write_fastq_file : Writes a small gzip FastQ file (R1 : cDNA, R2 : well barcode + UMI), with the FlashFB5p-seq read lengths.
+# 2. Function write_index_sort_file : Writes the Index Sorting CSV of one plate (one line per well).
+# 3. Function write_experiment_config : Writes the config_FlashPipe.yml of an experiment using the synthetic run.
+# 4. Function generate_synthetic_run : Generates the FastQ files (bcl2fastq layout, several lanes), the Index Sorting files and the GSF file,
+#    and empty references (STAR index, GTF) whose existence is checked by the staging.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+
+# Repository root (the benchmark is not part of the template, it is not copied in the projects)
+REPOSITORY_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEMPLATE_PATH = os.path.join(REPOSITORY_PATH, '01_Template')
+BARCODE_WELL_PATH = os.path.join(TEMPLATE_PATH, '{{experience_name}}/01_Reference/00_Experiment/cell_barcode_well.csv')
+CONFIG_TEMPLATE_PATH = os.path.join(REPOSITORY_PATH, '02_Config/PROJECT_NAME/EXPERIMENT_NAME/01_Reference/config_FlashPipe.yml')
+
+# Read lengths of the FlashFB5p-seq protocol (R1 : cDNA, R2 : barcode 8 + UMI 8 + cDNA)
+CDNA_LENGTH = 114
+UMI_LENGTH = 8
+# Name of the flow cell used in the file names (example: P1_H9C0U2GX_S1_L001_R1_001.fastq.gz)
+FLOW_CELL = "AAGJWKNM5"
+# Fluorescence columns of the Index Sorting files (the others are in not_fluorescent)
+INDEX_SORT_FLUORESCENCE = ["CD19", "CD27", "CD38", "IgD", "IgM"]
+INDEX_SORT_NOT_FLUORESCENT = ["Time", "SortPheno"]
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 1. Function write_fastq_file : Writes a small gzip FastQ file.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def write_fastq_file(file_path, read_type, barcodes, reads, rng):
+    '''
+    Writes a gzip FastQ file with reads random reads (same read names in R1 and R2 if the same seed is used).
+
+    file_path: Path to the .fastq.gz file.
+    read_type: R1 (cDNA) or R2 (well barcode + UMI + cDNA).
+    barcodes: List of the well barcodes.
+    reads: Number of reads.
+    rng: random.Random instance.
+    '''
+    lines = []
+    for read_index in range(reads):
+        if read_type == "R2":
+            sequence = rng.choice(barcodes) + ''.join(rng.choice('ACGT') for _ in range(UMI_LENGTH + CDNA_LENGTH))
+        else:
+            sequence = ''.join(rng.choice('ACGT') for _ in range(CDNA_LENGTH))
+        lines.append(f"@{FLOW_CELL}:1:1101:{read_index}:1000 {read_type[1]}:N:0:1\n{sequence}\n+\n{'F' * len(sequence)}\n")
+
+    # Level 1 : the content is random, a higher level only costs time
+    with gzip.open(file_path, 'wt', compresslevel=1) as file:
+        file.write(''.join(lines))
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 2. Function write_index_sort_file : Writes the Index Sorting CSV of a plate.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def write_index_sort_file(file_path, wells, rng):
+    '''
+    Writes the Index Sorting file of a plate : one line per well, a few not fluorescent columns and fluorescence measures.
+
+    file_path: Path to the CSV file.
+    wells: List of the well IDs.
+    rng: random.Random instance.
+    '''
+    header = ["WellID"] + INDEX_SORT_NOT_FLUORESCENT + INDEX_SORT_FLUORESCENCE
+    lines = [','.join(header)]
+    for well in wells:
+        values = [well, f"{rng.uniform(0, 600):.2f}", rng.choice(["Memory", "Naive", "Plasma"])]
+        values += [f"{rng.lognormvariate(6, 1.5):.1f}" for _ in INDEX_SORT_FLUORESCENCE]
+        lines.append(','.join(values))
+
+    with open(file_path, 'w') as file:
+        file.write('\n'.join(lines) + '\n')
+
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 3. Function write_experiment_config : Writes the config file of an experiment.
+# ••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def write_experiment_config(experience_path, run, species="mouse"):
+    '''
+    Creates the experiment directory (PROJECT_NAME/EXPERIMENT_NAME) and its 01_Reference/config_FlashPipe.yml,
+    filled from the config template of 02_Config with the paths of the synthetic run.
+    Returns the path to the config file.
+
+    experience_path: Path to the experiment directory.
+    run: Dictionary returned by generate_synthetic_run.
+    species: Species of the experiment (human or mouse).
+    '''
+    with open(CONFIG_TEMPLATE_PATH, 'r') as file:
+        config = yaml.safe_load(file)
+
+    # yes/no are written as booleans, as they are read by YAML from a config file filled by the user
+    config.update({
+        'species': species,
+        'experience_name': os.path.basename(os.path.normpath(experience_path)),
+        'plate_names': ','.join(run['plates']),
+        'method_analysis': 'single-cell',
+        'gsf_file': run['gsf_file'],
+        'metadata_analysis': False,
+        'fastq_directories': run['fastq_dir'],
+        'tools_bcr_tcr_analysis': 'trust4',
+        'bcr_repertoire_analysis': True,
+        'tcr_repertoire_analysis': False,
+        'index_sort_analysis': True,
+        'index_sort': run['index_sort_dir'],
+        'not_fluorescent': ','.join(INDEX_SORT_NOT_FLUORESCENT),
+        'merge_lanes': True
+    })
+    # References of the run (the paths of the config template only exist on the cluster)
+    config['star_index'][species] = run['star_index']
+    config['gtf_file'][species] = run['gtf_file']
+
+    reference_path = os.path.join(experience_path, '01_Reference')
+    os.makedirs(reference_path, exist_ok=True)
+    config_path = os.path.join(reference_path, 'config_FlashPipe.yml')
+    with open(config_path, 'w') as file:
+        yaml.dump(config, file, default_flow_style=False, sort_keys=False)
+    return config_path
+
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+# ## 4. Function generate_synthetic_run : Generates the FastQ, Index Sorting and GSF files of a run.
+# •••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••••
+def generate_synthetic_run(output_dir, plates, lanes=1, reads=100, fastq_subdirs=1, gsf_size=256 * 1024, seed=0):
+    '''
+    Generates a fake sequencing run in output_dir :
+    - Analysis/1/Data/fastq : one R1 and one R2 file per plate and lane (bcl2fastq names : PLATE_S1_L001_R1_001.fastq.gz, plate PLATE_S1),
+      spread in fastq_subdirs sub-directories (project directories of the sequencing run), plus a few files of other projects.
+    - IndexSort : one CSV file per plate (one line per well of cell_barcode_well.csv).
+    - GenomicsSubmissionForm.xlsx : GSF file of gsf_size bytes (random content : the staging only copies it).
+    - Reference : empty STAR index directory and GTF file (the staging only checks that they exist).
+    Files that already exist are kept, so that several scales can share the same run.
+    Returns a dictionary : plates, fastq_dir, index_sort_dir, gsf_file, star_index, gtf_file, fastq_files (number of FastQ files).
+
+    output_dir: Directory of the run.
+    plates: Number of plates.
+    lanes: Number of lanes per plate (the staging merges the lanes when there are more than one).
+    reads: Number of reads per FastQ file.
+    fastq_subdirs: Number of sub-directories of the fastq directory.
+    gsf_size: Size of the GSF file, in bytes.
+    seed: Seed of the random generator (the same seed gives the same files).
+    '''
+    with open(BARCODE_WELL_PATH, 'r') as file:
+        barcode_wells = [line.strip().split(',') for line in file.readlines()[1:] if line.strip()]
+    wells = [well for well, _ in barcode_wells]
+    barcodes = [barcode for _, barcode in barcode_wells]
+
+    fastq_dir = os.path.join(output_dir, 'Analysis/1/Data/fastq')
+    index_sort_dir = os.path.join(output_dir, 'IndexSort')
+    os.makedirs(index_sort_dir, exist_ok=True)
+    subdirs = [fastq_dir] if fastq_subdirs <= 1 else [os.path.join(fastq_dir, f"Project_{index:03d}") for index in range(1, fastq_subdirs + 1)]
+    for subdir in subdirs:
+        os.makedirs(subdir, exist_ok=True)
+
+    # The sample number (_S1) is part of the plate name read by the staging (P1_H9C0U2GX_S1_L001_R1_001.fastq.gz -> P1_H9C0U2GX_S1)
+    plate_names = [f"P{index}_{FLOW_CELL}_S{index}" for index in range(1, plates + 1)]
+    fastq_files = 0
+    for plate_index, plate in enumerate(plate_names, start=1):
+        plate_dir = subdirs[plate_index % len(subdirs)]
+        for lane in range(1, lanes + 1):
+            for read_type in ("R1", "R2"):
+                file_path = os.path.join(plate_dir, f"{plate}_L{lane:03d}_{read_type}_001.fastq.gz")
+                if not os.path.exists(file_path):
+                    # Same seed for R1 and R2 of a lane, so that the reads are paired
+                    write_fastq_file(file_path, read_type, barcodes, reads, random.Random(f"{seed}:{plate}:{lane}"))
+                fastq_files += 1
+
+        index_sort_path = os.path.join(index_sort_dir, f"{plate}_indexsort.csv")
+        if not os.path.exists(index_sort_path):
+            write_index_sort_file(index_sort_path, wells, random.Random(f"{seed}:{plate}:indexsort"))
+
+    # Files of other projects of the sequencing run (Undetermined reads), ignored by the staging
+    for read_type in ("R1", "R2"):
+        file_path = os.path.join(fastq_dir, f"Undetermined_S0_L001_{read_type}_001.fastq.gz")
+        if not os.path.exists(file_path):
+            write_fastq_file(file_path, read_type, barcodes, reads, random.Random(f"{seed}:undetermined"))
+
+    gsf_file = os.path.join(output_dir, 'GenomicsSubmissionForm.xlsx')
+    if not os.path.exists(gsf_file) or os.path.getsize(gsf_file) != gsf_size:
+        with open(gsf_file, 'wb') as file:
+            file.write(random.Random(f"{seed}:gsf").randbytes(gsf_size))
+
+    star_index = os.path.join(output_dir, 'Reference/STAR_index')
+    gtf_file = os.path.join(output_dir, 'Reference/genes.gtf')
+    os.makedirs(star_index, exist_ok=True)
+    if not os.path.exists(gtf_file):
+        open(gtf_file, 'w').close()
+
+    return {
+        'plates': plate_names,
+        'fastq_dir': fastq_dir,
+        'index_sort_dir': index_sort_dir,
+        'gsf_file': gsf_file,
+        'star_index': star_index,
+        'gtf_file': gtf_file,
+        'fastq_files': fastq_files
+    }
+
+if __name__ == '__main__':
+    parser = OptionParser(usage="%prog -o OUTPUT_DIR -n PLATES [-l LANES] [-r READS] [-e EXPERIMENT_DIR]")
+    parser.add_option("-o", "--output_dir", dest="output_dir", help="Directory of the synthetic run", metavar="OUTPUT_DIR")
+    parser.add_option("-n", "--plates", dest="plates", type="int", default=10, help="Number of plates (default: 10)", metavar="PLATES")
+    parser.add_option("-l", "--lanes", dest="lanes", type="int", default=1, help="Number of lanes per plate (default: 1)", metavar="LANES")
+    parser.add_option("-r", "--reads", dest="reads", type="int", default=100, help="Number of reads per FastQ file (default: 100)", metavar="READS")
+    parser.add_option("-d", "--fastq_subdirs", dest="fastq_subdirs", type="int", default=1,
+                      help="Number of sub-directories of the fastq directory (default: 1)", metavar="SUBDIRS")
+    parser.add_option("-e", "--experiment_dir", dest="experiment_dir", default=None,
+                      help="Also create an experiment directory (PROJECT_NAME/EXPERIMENT_NAME) with a config file using the run", metavar="EXPERIMENT_DIR")
+    (options, args) = parser.parse_args()
+
+    if not options.output_dir:
+        print("Error: You must provide an output directory.")
+        parser.print_help()
+        sys.exit(1)
+
+    run = generate_synthetic_run(options.output_dir, options.plates, lanes=options.lanes, reads=options.reads,
+                                 fastq_subdirs=options.fastq_subdirs)
+    print(f"Synthetic run : {len(run['plates'])} plates, {run['fastq_files']} FastQ files in {run['fastq_dir']}")
+    if options.experiment_dir:
+        config_path = write_experiment_config(options.experiment_dir, run)
+        print(f"Config file : {config_path}")